@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""每个请求都会调用的函数的性能测试: get_sign, check_sign, xml_to_dict, dict_to_xml, gen_random_str
+
+输出每秒调用次数和每次调用分配的内存(tracemalloc统计的峰值), 可以保存为基线,
+之后的运行与基线对比, 变慢超过阈值时返回非0::
+
+    python benchmarks/bench_hotpaths.py --save baseline.json
+    python benchmarks/bench_hotpaths.py --compare baseline.json --threshold 0.1
+
+    # 只运行名字包含xml的用例
+    python benchmarks/bench_hotpaths.py -k xml
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask  # noqa: E402
+
+from flask_wxpay import WXPay  # noqa: E402
+from flask_wxpay.utils import dict_to_xml, dict_to_xml_bytes, gen_random_str, xml_to_dict  # noqa: E402
+
+KEY = '192006250b4c09247ec02edce69f6a2d'
+
+#: 统一下单的返回结果
+UNIFIED_ORDER_RESULT = dict(
+    return_code='SUCCESS',
+    return_msg='OK',
+    appid='wx2421b1c4370ec43b',
+    mch_id='10000100',
+    device_info='1000',
+    nonce_str='IITRi8Iabbblz1Jc',
+    result_code='SUCCESS',
+    trade_type='JSAPI',
+    prepay_id='wx201411101639507cbf6ffd8b0779950874',
+    code_url='weixin://wxpay/bizpayurl/up?pr=NwY5Mz9&groupid=00',
+)
+
+#: 使用了代金券的支付通知
+NOTIFY_WITH_COUPONS = dict(
+    appid='wx2421b1c4370ec43b',
+    attach='支付测试',
+    bank_type='CFT',
+    fee_type='CNY',
+    is_subscribe='Y',
+    mch_id='10000100',
+    nonce_str='5d2b6c2a8db53831f7eda20af46e531c',
+    openid='oUpF8uMEb4qRXf22hE3X68TekukE',
+    out_trade_no='1409811653',
+    result_code='SUCCESS',
+    return_code='SUCCESS',
+    time_end='20140903131540',
+    total_fee=101,
+    settlement_total_fee=91,
+    cash_fee=91,
+    trade_type='JSAPI',
+    transaction_id='1004400740201409030005092168',
+    coupon_fee=10,
+    coupon_count=3,
+    coupon_type_0='CASH',
+    coupon_id_0='10000',
+    coupon_fee_0=5,
+    coupon_type_1='NO_CASH',
+    coupon_id_1='10001',
+    coupon_fee_1=3,
+    coupon_type_2='CASH',
+    coupon_id_2='10002',
+    coupon_fee_2=2,
+)
+
+#: 100个字段的数据, 与对账单、批量查询的返回结果规模相当
+LARGE_PAYLOAD = dict(
+    ('field_{0:03d}'.format(i), '值{0}-{1}'.format(i, 'x' * (i % 24)) if i % 3 else i * 100)
+    for i in range(100)
+)
+
+
+def make_wxpay(sign_type='MD5'):
+    app = Flask(__name__)
+    app.config.update(
+        WX_APPID='wx2421b1c4370ec43b',
+        WXPAY_MCHID='10000100',
+        WXPAY_KEY=KEY,
+        WXPAY_NOTIFY_URL='https://example.com/notify',
+        WXPAY_SIGN_TYPE=sign_type,
+    )
+    return WXPay(app)
+
+
+def cases():
+    """(名字, 函数) 列表"""
+    md5_wxpay = make_wxpay()
+    hmac_wxpay = make_wxpay('HMAC-SHA256')
+
+    result = []
+    payloads = [
+        ('unified_order', UNIFIED_ORDER_RESULT),
+        ('notify_coupons', NOTIFY_WITH_COUPONS),
+        ('100_fields', LARGE_PAYLOAD),
+    ]
+    for name, data in payloads:
+        md5_signed = dict(data, sign=md5_wxpay.get_sign(data))
+        hmac_signed = dict(data, sign_type='HMAC-SHA256')
+        hmac_signed['sign'] = hmac_wxpay.get_sign(hmac_signed)
+        xml = dict_to_xml(md5_signed)
+        xml_bytes = xml.encode('utf-8')
+        assert md5_wxpay.check_sign(md5_signed) and hmac_wxpay.check_sign(hmac_signed)
+        assert xml_to_dict(xml_bytes) == dict((k, str(v)) for k, v in md5_signed.items())
+
+        result.extend([
+            ('get_sign[md5,{0}]'.format(name), lambda d=data: md5_wxpay.get_sign(d)),
+            ('get_sign[hmac,{0}]'.format(name), lambda d=data: hmac_wxpay.get_sign(d)),
+            ('check_sign[md5,{0}]'.format(name), lambda d=md5_signed: md5_wxpay.check_sign(d)),
+            ('check_sign[hmac,{0}]'.format(name), lambda d=hmac_signed: hmac_wxpay.check_sign(d)),
+            ('xml_to_dict[{0}]'.format(name), lambda x=xml_bytes: xml_to_dict(x)),
+            ('dict_to_xml[{0}]'.format(name), lambda d=md5_signed: dict_to_xml(d)),
+            ('dict_to_xml_bytes[{0}]'.format(name), lambda d=md5_signed: dict_to_xml_bytes(d)),
+        ])
+    result.append(('gen_random_str[16]', gen_random_str))
+    result.append(('gen_random_str[32]', lambda: gen_random_str(32)))
+    return result
+
+
+def measure_ops(func, min_time=0.2, repeat=5):
+    """每秒调用次数, 取repeat次中最快的一次"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / elapsed))
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+
+def measure_alloc(func, number=200):
+    """每次调用分配内存的峰值(字节), 取number次的中位数"""
+    func()
+    peaks = []
+    reset_peak = getattr(tracemalloc, 'reset_peak', None)
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            if reset_peak is not None:
+                reset_peak()
+            else:
+                # Python 3.9之前没有reset_peak, 重新开始跟踪清除记录和峰值
+                tracemalloc.stop()
+                tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    peaks.sort()
+    return peaks[len(peaks) // 2]
+
+
+def run(pattern=None, min_time=0.2):
+    results = {}
+    for name, func in cases():
+        if pattern and pattern not in name:
+            continue
+        results[name] = dict(ops=measure_ops(func, min_time), alloc=measure_alloc(func))
+        print('{0:<36} {1:>12,.0f} ops/sec {2:>9,} B/op'.format(
+            name, results[name]['ops'], results[name]['alloc']))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """与基线对比, 返回变慢超过threshold的用例"""
+    regressions = []
+    print()
+    print('{0:<36} {1:>12} {2:>12} {3:>8}'.format('', 'baseline', 'current', 'change'))
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = current['ops'] / base['ops'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{0:<36} {1:>12,.0f} {2:>12,.0f} {3:>+7.1%}{4}'.format(
+            name, base['ops'], current['ops'], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern', help='只运行名字包含该字符串的用例')
+    parser.add_argument('--min-time', type=float, default=0.2, help='每轮计时的最短时间(秒)')
+    parser.add_argument('--save', metavar='FILE', help='结果保存为基线')
+    parser.add_argument('--compare', metavar='FILE', help='与基线对比')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='ops/sec下降超过该比例时视为性能回退, 默认0.1')
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=platform.python_version(), machine=platform.machine(),
+                           results=results), f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('python') != platform.python_version():
+            print('注意: 基线的Python版本为{0}'.format(baseline.get('python')))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('\n{0}个用例性能回退'.format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""签名的性能对比: 原来的WXPay.get_sign实现与flask_wxpay.sign
+
+运行::
+
+    python benchmarks/bench_sign.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_wxpay.sign import HMACSHA256Signer, MD5Signer  # noqa: E402
+from flask_wxpay.utils import md5  # noqa: E402
+
+KEY = '192006250b4c09247ec02edce69f6a2d'
+
+DATA = dict(
+    appid='wxd930ea5d5a258f4f',
+    mch_id='10000100',
+    nonce_str='ibuaiVcKdpRxkhJA',
+    body='腾讯充值中心-QQ会员充值',
+    out_trade_no='20150806125346',
+    total_fee=88,
+    spbill_create_ip='123.12.12.123',
+    notify_url='http://www.weixin.qq.com/wxpay/pay.php',
+    trade_type='JSAPI',
+    openid='oUpF8uMuAJO_M2pxb1Q9zNjWeS6o',
+    time_start='20091225091010',
+    time_expire='20091227091010',
+)
+
+
+def legacy_get_sign(data, key=KEY):
+    items = sorted(data.items(), key=lambda x: x[0])
+    s = '&'.join('{0}={1}'.format(k, v) for k, v in items)
+    s = '{0}&key={1}'.format(s, key)
+    return md5(s).upper()
+
+
+def main(number=100000):
+    md5_signer = MD5Signer(KEY)
+    hmac_signer = HMACSHA256Signer(KEY)
+    assert md5_signer.sign(DATA) == legacy_get_sign(DATA)
+
+    cases = [
+        ('legacy get_sign (MD5)', lambda: legacy_get_sign(DATA)),
+        ('MD5Signer', lambda: md5_signer.sign(DATA)),
+        ('HMACSHA256Signer', lambda: hmac_signer.sign(DATA)),
+    ]
+    baseline = None
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        ops = number / seconds
+        baseline = baseline or ops
+        print('{0:<24} {1:>12,.0f} ops/sec  x{2:.2f}'.format(name, ops, ops / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from flask import Blueprint, current_app, jsonify, redirect, render_template, request, session, url_for
-from flask_wxpay import now_str, xml_to_dict
+from flask_wxpay import now_str
 
 from .core import wx_oauth, wxpay
 
@@ -38,13 +38,9 @@ def authorized():
 
 
 @bp.route('/wxpay/notify', methods=['POST'])
-def notify():
-    xml = request.get_data()
-    data = xml_to_dict(xml)
+@wxpay.notify_handler
+def notify(data):
     print('notify data', data)
-    resp = wxpay.notify_response()
-    print('notify resp', resp)
-    return resp
 
 
 @bp.route('/show-user-openid')
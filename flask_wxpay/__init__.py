@@ -3,15 +3,104 @@
 
 __version__ = '1.0.5'  # noqa
 
+import functools
 import json
+import logging
+import os
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from xml.etree.ElementTree import ParseError
 
 import requests
+from flask import request
+from urllib3.exceptions import NewConnectionError
 
+from .batch import imap_unordered
+from .bill import BillReader
+from .billstore import BillStore
+from .cache import FileCache, LRUCache
+from .comment import MAX_LIMIT as COMMENT_MAX_LIMIT
+from .comment import CommentReader, parse_comment_page
 from .compat import urljoin
-from .exceptions import CertError, ResultCodeFail, ReturnCodeFail, SignError, WXPayError
-from .utils import dict_to_xml, gen_random_str, md5, now_str, xml_to_dict  # noqa
+from .exceptions import (CertError, NetworkError, RateLimited, ResultCodeFail, ReturnCodeFail,  # noqa
+                         SignError, WXPayError)
+from .hedge import HedgePolicy, hedged_call
+from .hosts import HostPool
+from .metrics import DEFAULT_BUCKETS, Metrics, SignalExporter
+from .poll import PaymentWaiter
+from .ratelimit import FileBackend, LocalBackend, RateLimiter, fcntl
+from .results import RESULT_TYPES
+from .sign import get_signer
+from .tracing import PhaseTracer, add_server_timing, get_otel_tracer
+from .transport import Transport, create_ssl_context
+from .utils import dict_to_xml, dict_to_xml_bytes, gen_random_str, md5, now_str, xml_to_dict  # noqa
+
+SANDBOX_SIGNKEY_PATH = '/sandboxnew/pay/getsignkey'
+COMMENT_PATH = '/billcommentsp/batchquerycomment'
+FUND_FLOW_PATH = '/pay/downloadfundflow'
+
+#: 只支持MD5签名的接口
+MD5_ONLY_PATHS = frozenset([
+    SANDBOX_SIGNKEY_PATH,
+    '/mmpaymkttransfers/sendredpack',
+    '/mmpaymkttransfers/gethbinfo',
+    '/mmpaymkttransfers/promotion/transfers',
+    '/mmpaymkttransfers/gettransferinfo',
+])
+
+#: 只支持HMAC-SHA256签名的接口
+HMAC_ONLY_PATHS = frozenset([
+    COMMENT_PATH,
+    FUND_FLOW_PATH,
+])
+
+#: 查询类接口, 请求失败时可以在其他域名重试
+SAFE_RETRY_PATHS = frozenset([
+    SANDBOX_SIGNKEY_PATH,
+    '/pay/orderquery',
+    '/pay/refundquery',
+    '/pay/closeorder',
+    '/pay/downloadbill',
+    '/mmpaymkttransfers/gethbinfo',
+    '/mmpaymkttransfers/gettransferinfo',
+    COMMENT_PATH,
+    FUND_FLOW_PATH,
+])
+
+#: 可以发送对冲请求的只读接口
+HEDGE_PATHS = frozenset([
+    '/pay/orderquery',
+    '/pay/refundquery',
+    '/mmpaymkttransfers/gethbinfo',
+    '/mmpaymkttransfers/gettransferinfo',
+])
+
+#: 不会再变化的交易状态, query_order的结果可以缓存; SUCCESS的订单退款后变为REFUND,
+#: 通过当前进程的 :meth:`WXPay.refund` 退款时会清除缓存, 其他进程或者商户平台上的退款
+#: 要等缓存过期(WXPAY_QUERY_CACHE_TIMEOUT)后才能查到
+CACHEABLE_TRADE_STATES = frozenset(['SUCCESS', 'CLOSED', 'REVOKED', 'REFUND'])
+
+#: 退款的终态, 所有退款都是终态时query_refund的结果可以缓存
+TERMINAL_REFUND_STATES = frozenset(['SUCCESS', 'REFUNDCLOSE', 'CHANGE'])
+
+#: 成功处理通知时的应答
+_NOTIFY_SUCCESS = dict_to_xml(return_code='SUCCESS', return_msg='OK')
+
+#: notify_cache中正在处理的通知的值, 处理完成后为True
+NOTIFY_PROCESSING = 'processing'
+
+logger = logging.getLogger(__name__)
+
+
+def _is_connect_error(e):
+    """连接未建立的错误, 请求肯定没有发送到服务器"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
 
 
 class WXPay(object):
@@ -25,34 +114,270 @@ class WXPay(object):
         self.base_url = app.config.get('WXPAY_BASE_URL',
                                        'https://api.mch.weixin.qq.com')
         self.request_timeout = app.config.get('WXPAY_REQUEST_TIMEOUT', 10)
+        self.connect_timeout = app.config.get('WXPAY_CONNECT_TIMEOUT')
+        # 配置了多个域名时自动故障切换, 第一个为主域名
+        base_urls = app.config.get('WXPAY_BASE_URLS') or [self.base_url]
+        self.base_url = base_urls[0]
+        self.hosts = HostPool(
+            base_urls,
+            failure_threshold=app.config.get('WXPAY_HOST_FAILURE_THRESHOLD', 3),
+            probe_interval=app.config.get('WXPAY_HOST_PROBE_INTERVAL', 30),
+            probe=self._probe_host,
+        )
+        self.batch_max_in_flight = app.config.get('WXPAY_BATCH_MAX_IN_FLIGHT', 10)
 
         self.appid = app.config['WX_APPID']
         self.mch_id = app.config['WXPAY_MCHID']
-        self.key = app.config['WXPAY_KEY']
+        self.merchant_key = app.config['WXPAY_KEY']
+        self.sign_type = app.config.get('WXPAY_SIGN_TYPE', 'MD5')
+        self._signers = {}
         self.notify_url = app.config['WXPAY_NOTIFY_URL']
+        self.notify_cache = LRUCache(
+            maxsize=app.config.get('WXPAY_NOTIFY_CACHE_SIZE', 10000),
+            default_timeout=app.config.get('WXPAY_NOTIFY_CACHE_TIMEOUT', 86400),
+        )
+        # 处理通知的进程崩溃时, 处理中的标记过期后微信重发的通知可以再次处理
+        self.notify_processing_timeout = app.config.get('WXPAY_NOTIFY_PROCESSING_TIMEOUT', 60)
 
         self.apiclient_cert_path = app.config.get('WXPAY_APICLIENT_CERT_PATH')
         self.apiclient_key_path = app.config.get('WXPAY_APICLIENT_KEY_PATH')
+        # 证书内容(PEM格式的bytes)优先于证书路径
+        apiclient_cert = app.config.get('WXPAY_APICLIENT_CERT') or self.apiclient_cert_path
+        apiclient_key = app.config.get('WXPAY_APICLIENT_KEY') or self.apiclient_key_path
+        verify = app.config.get('WXPAY_ROOTCA_PATH') or True
 
+        if apiclient_cert and apiclient_key:
+            ssl_context = create_ssl_context(apiclient_cert, apiclient_key, verify)
+        else:
+            ssl_context = None
+
+        self.transport = Transport(
+            pool_connections=app.config.get('WXPAY_POOL_CONNECTIONS', 10),
+            pool_maxsize=app.config.get('WXPAY_POOL_MAXSIZE', 10),
+            ssl_context=ssl_context,
+            verify=verify,
+        )
+
+        # 沙箱模式时第一次签名前才获取sandbox_signkey, init_app不会发送网络请求
         self.sandbox = app.config.get('WXPAY_SANDBOX', False)
-        if self.sandbox:  # 沙箱模式时自动获取sandbox_signkey并替换self.key
-            self.key = self.get_sandbox_signkey()
+        self.sandbox_signkey_timeout = app.config.get('WXPAY_SANDBOX_SIGNKEY_TIMEOUT', 3600)
+        self.sandbox_signkey_cache = FileCache(app.config.get(
+            'WXPAY_SANDBOX_SIGNKEY_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'flask_wxpay')))
+        self._sandbox_signkey = None
+        self._sandbox_signkey_lock = threading.Lock()
+
+        # 查询类接口的对冲请求, 默认关闭
+        if app.config.get('WXPAY_HEDGE', False):
+            self.hedge_policy = HedgePolicy(
+                percentile=app.config.get('WXPAY_HEDGE_PERCENTILE', 95),
+                budget=app.config.get('WXPAY_HEDGE_BUDGET', 0.05),
+                default_delay=app.config.get('WXPAY_HEDGE_DELAY', 1.0),
+            )
+        else:
+            self.hedge_policy = None
+        self._hedge_executor = None
+        self._hedge_executor_pid = None
+        self._hedge_executor_lock = threading.Lock()
+
+        # 按接口统计延迟和返回码, 默认开启
+        if app.config.get('WXPAY_METRICS', True):
+            self.metrics = Metrics(app.config.get('WXPAY_METRICS_BUCKETS', DEFAULT_BUCKETS))
+            if app.config.get('WXPAY_METRICS_SIGNALS', False):
+                self.metrics.add_exporter(SignalExporter(self))
+        else:
+            self.metrics = None
+
+        # 各阶段耗时的记录, 默认关闭
+        server_timing = app.config.get('WXPAY_SERVER_TIMING', False)
+        otel = app.config.get('WXPAY_TRACING_OTEL', False)
+        if app.config.get('WXPAY_TRACING', False) or server_timing or otel:
+            self.tracer = PhaseTracer(get_otel_tracer() if otel else None)
+            if server_timing:
+                app.after_request(add_server_timing)
+        else:
+            self.tracer = None
+
+        self.payment_waiter = self._create_payment_waiter(app)
+
+        # 已下载对账单的本地存储, 默认不开启
+        bill_store_dir = app.config.get('WXPAY_BILL_STORE_DIR')
+        self.bill_store = BillStore(self, bill_store_dir) if bill_store_dir else None
+
+        # 按接口path限流, 默认在同一台机器的进程间共享
+        limits = app.config.get('WXPAY_RATE_LIMITS')
+        if limits:
+            backend = app.config.get('WXPAY_RATE_LIMIT_BACKEND', 'file' if fcntl else 'local')
+            if backend == 'file':
+                backend = FileBackend(app.config.get(
+                    'WXPAY_RATE_LIMIT_FILE',
+                    os.path.join(tempfile.gettempdir(), 'flask_wxpay', 'ratelimit')))
+            elif backend == 'local':
+                backend = LocalBackend()
+            self.rate_limiter = RateLimiter(
+                limits, backend,
+                timeout=app.config.get('WXPAY_RATE_LIMIT_TIMEOUT', 1.0),
+                prefix='{0}:'.format(self.mch_id),
+            )
+        else:
+            self.rate_limiter = None
+
+        # 终态的订单和退款查询结果缓存, 默认关闭; 缓存期间查不到其他进程的退款,
+        # 多进程部署时可以替换为共享缓存
+        if app.config.get('WXPAY_QUERY_CACHE', False):
+            self.query_cache = LRUCache(
+                maxsize=app.config.get('WXPAY_QUERY_CACHE_SIZE', 10000),
+                default_timeout=app.config.get('WXPAY_QUERY_CACHE_TIMEOUT', 60),
+            )
+        else:
+            self.query_cache = None
+
+        # 返回按接口区分的结果类型代替dict, 默认关闭
+        self.typed_results = app.config.get('WXPAY_TYPED_RESULTS', False)
+
+        warm_up = app.config.get('WXPAY_POOL_WARM_UP', 0)
+        if warm_up:  # True时预热一个连接, 整数时预热对应个数的连接
+            self.transport.warm_up(self.base_url, self.request_timeout,
+                                   connections=int(warm_up))
+
+    def _create_payment_waiter(self, app, cls=PaymentWaiter):
+        return cls(
+            self.query_order,
+            initial_interval=app.config.get('WXPAY_POLL_INITIAL_INTERVAL', 1.0),
+            max_interval=app.config.get('WXPAY_POLL_MAX_INTERVAL', 5.0),
+        )
+
+    @property
+    def key(self):
+        """签名使用的key, 沙箱模式时为sandbox_signkey"""
+        if self.sandbox:
+            return self._get_sandbox_signkey()
+        return self.merchant_key
+
+    @key.setter
+    def key(self, value):
+        self.merchant_key = value
 
     def _post(self, path, data, use_cert=False, check_result=True):
         """添加发送签名
         处理返回结果成dict, 并检查签名
         """
+        r = self._send(path, data, use_cert)
+        try:
+            return self._handle_result(r.content, use_cert, check_result, path)
+        except (SignError, ReturnCodeFail) as e:
+            if not self._is_sandbox_sign_error(e):
+                raise
+        # sandbox_signkey可能已经失效, 刷新后重试一次
+        self._clear_sandbox_signkey()
         r = self._post_resp(path, data, use_cert)
-        xml = r.text
-        data = xml_to_dict(xml)
-        # 使用证书的接口不检查sign
-        if check_result:
-            check_sign = not use_cert
-            self.check_data(data, check_sign)
-        return data
+        return self._handle_result(r.content, use_cert, check_result, path)
+
+    def _send(self, path, data, use_cert=False):
+        """发送请求, 开启对冲请求时查询类接口可能同时发送两个请求"""
+        if self.hedge_policy is None or path not in HEDGE_PATHS:
+            return self._post_resp(path, data, use_cert)
+
+        def call():
+            start = time.time()
+            # 每个请求使用data的副本, 生成各自的nonce_str和sign
+            r = self._post_resp(path, dict(data), use_cert)
+            self.hedge_policy.record(path, time.time() - start)
+            return r
+        return hedged_call(self._get_hedge_executor(), self.hedge_policy, path, call)
 
-    def _post_resp(self, path, data, use_cert=False):
+    def _get_hedge_executor(self):
+        """对冲请求使用的线程池, fork后重新创建"""
+        pid = os.getpid()
+        if self._hedge_executor is None or self._hedge_executor_pid != pid:
+            with self._hedge_executor_lock:
+                if self._hedge_executor is None or self._hedge_executor_pid != pid:
+                    self._hedge_executor = ThreadPoolExecutor(
+                        max_workers=self.transport.pool_maxsize * 2)
+                    self._hedge_executor_pid = pid
+        return self._hedge_executor
+
+    def _post_resp(self, path, data, use_cert=False, stream=False):
         """post发送请求，返回requests.Response对象"""
+        self._check_cert(use_cert)
+        if self.rate_limiter is not None:
+            wait = self._reserve_rate_limit(path)
+            if wait:
+                time.sleep(wait)
+        metrics = self.metrics
+        if metrics is None:
+            return self._do_post_resp(path, data, use_cert, stream)
+        start = metrics.start(path)
+        error = None
+        try:
+            return self._do_post_resp(path, data, use_cert, stream)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(path, start, error, isinstance(error, requests.Timeout))
+
+    def _check_cert(self, use_cert):
+        """没有配置证书时在发送前抛出CertError, 不计入限流和接口的统计"""
+        if use_cert and self.transport.ssl_context is None:
+            raise CertError()
+
+    def _reserve_rate_limit(self, path):
+        """返回发送前需要等待的秒数
+
+        :raises RateLimited: 需要等待的时间超过WXPAY_RATE_LIMIT_TIMEOUT
+        """
+        try:
+            wait = self.rate_limiter.reserve(path)
+        except RateLimited:
+            if self.metrics is not None:
+                self.metrics.record_limit(path, 0, rejected=True)
+            raise
+        if wait and self.metrics is not None:
+            self.metrics.record_limit(path, wait)
+        return wait
+
+    def _do_post_resp(self, path, data, use_cert=False, stream=False):
+        tracer = self.tracer
+        api_path = path
+        path, xml_data = self._prepare_request(path, data, use_cert)
+        timeout = (self.connect_timeout or self.request_timeout, self.request_timeout)
+        base_urls = self.hosts.candidates()
+        for i, base_url in enumerate(base_urls):
+            start = time.perf_counter()
+            try:
+                r = self.transport.post(urljoin(base_url, path), use_cert=use_cert, data=xml_data,
+                                        timeout=timeout, stream=stream)
+            except requests.RequestException as e:
+                self.hosts.report_failure(base_url)
+                if i + 1 == len(base_urls) or not self._can_retry(path, _is_connect_error(e)):
+                    raise
+                logger.warning('请求%s失败: %s, 切换到%s', base_url, e, base_urls[i + 1])
+                continue
+            finally:
+                if tracer is not None:
+                    tracer.record('network', api_path, start)
+            self.hosts.report_success(base_url, time.perf_counter() - start)
+            break
+        if r.encoding == 'ISO-8859-1':
+            r.encoding = 'UTF-8'
+        return r
+
+    @staticmethod
+    def _can_retry(path, connect_error):
+        """连接没有建立时所有接口都可以在其他域名重试, 否则只重试查询类接口"""
+        if connect_error:
+            return True
+        if path.startswith('/sandboxnew/'):
+            path = path[len('/sandboxnew'):]
+        return path in SAFE_RETRY_PATHS
+
+    def _probe_host(self, base_url):
+        self.transport.session.head(base_url, timeout=self.connect_timeout or self.request_timeout)
+        return True
+
+    def _prepare_request(self, path, data, use_cert=False):
+        """添加公共参数和签名, 返回请求的path和xml数据"""
         base_data = dict(
             appid=self.appid,
             mch_id=self.mch_id,
@@ -65,38 +390,76 @@ class WXPay(object):
             base_data['mchid'] = base_data.pop('mch_id')
         data.update(base_data)
 
-        data['sign'] = self.get_sign(data)
-
-        xml_data = dict_to_xml(data).encode('utf-8')
-        if use_cert:
-            if not (self.apiclient_cert_path and self.apiclient_key_path):
-                raise CertError()
-            apiclient_cert = (self.apiclient_cert_path,
-                              self.apiclient_key_path)
+        # 企业付款, 红包等接口只支持MD5签名, 评价数据和资金账单只支持HMAC-SHA256
+        if path in MD5_ONLY_PATHS:
+            sign_type = 'MD5'
+        elif path in HMAC_ONLY_PATHS:
+            sign_type = 'HMAC-SHA256'
         else:
-            apiclient_cert = None
+            sign_type = self.sign_type
+        if sign_type != 'MD5':
+            data['sign_type'] = sign_type
+        # 获取sandbox_signkey的请求使用商户key签名
+        key = self.merchant_key if path == SANDBOX_SIGNKEY_PATH else self.key
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        data['sign'] = self._get_signer(sign_type, key).sign(data)
+        if tracer is not None:
+            start = tracer.record('sign', path, start)
 
-        if self.sandbox:
+        xml_data = dict_to_xml_bytes(data)
+        if tracer is not None:
+            tracer.record('encode', path, start)
+
+        if self.sandbox and not path.startswith('/sandboxnew/'):
             path = '/sandboxnew' + path
 
-        url = urljoin(self.base_url, path)
-        r = requests.post(url, data=xml_data, timeout=self.request_timeout, cert=apiclient_cert)
-        if r.encoding == 'ISO-8859-1':
-            r.encoding = 'UTF-8'
-        return r
+        return path, xml_data
 
-    def get_sign(self, data):
-        """生成签名"""
-        # 签名步骤一: 按字典序排序参数
-        items = sorted(data.items(), key=lambda x: x[0])
-        # items.sort(key=lambda x: x[0])
-        s = '&'.join('{0}={1}'.format(key, value) for key, value in items)
-        # 签名步骤二: 在string后加入KEY
-        s = '{0}&key={1}'.format(s, self.key)
-        # 签名步骤三: MD5加密
-        result = md5(s)
-        # 签名步骤四: 所有字符转为大写
-        return result.upper()
+    def _handle_result(self, xml, use_cert=False, check_result=True, path=None):
+        """处理返回结果成dict, 并检查签名"""
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        try:
+            data = xml_to_dict(xml)
+        except (ParseError, ValueError):
+            # defusedxml拒绝DTD和实体时的异常, 以及非utf-8的内容都是ValueError
+            raise WXPayError('返回数据不是合法的xml: {0!r}'.format(xml[:200]))
+        if tracer is not None:
+            start = tracer.record('decode', path, start)
+        if self.metrics is not None and path is not None:
+            self.metrics.record_result(path, data)
+        # 使用证书的接口不检查sign
+        if check_result:
+            check_sign = not use_cert
+            try:
+                self.check_data(data, check_sign)
+            finally:
+                if tracer is not None:
+                    tracer.record('verify', path, start)
+        return self._wrap_result(path, data)
+
+    def _wrap_result(self, path, data):
+        """开启WXPAY_TYPED_RESULTS时转换成 :data:`~flask_wxpay.results.RESULT_TYPES` 中的结果类型"""
+        if not self.typed_results:
+            return data
+        cls = RESULT_TYPES.get(path)
+        return cls(data) if cls is not None else data
+
+    def get_sign(self, data, sign_type=None):
+        """生成签名, 值为空的参数不参与签名
+
+        :params sign_type: MD5, HMAC-SHA256, 默认使用WXPAY_SIGN_TYPE的配置
+        """
+        return self._get_signer(sign_type or self.sign_type, self.key).sign(data)
+
+    def _get_signer(self, sign_type, key):
+        signer = self._signers.get((sign_type, key))
+        if signer is None:
+            signer = self._signers[(sign_type, key)] = get_signer(sign_type, key)
+        return signer
 
     def unified_order(self, out_trade_no, total_fee, ip, body, expire_seconds,
                       notify_url=None, trade_type='JSAPI', openid=None):
@@ -113,7 +476,13 @@ class WXPay(object):
         :params openid: 用户openid, trade_type为JSAPI时需要
         :rtype: dict
         """
-        path = '/pay/unifiedorder'
+        data = self._unified_order_data(out_trade_no, total_fee, ip, body, expire_seconds,
+                                        notify_url, trade_type, openid)
+        result = self._post('/pay/unifiedorder', data)
+        return self._check_unified_order_result(result, data)
+
+    def _unified_order_data(self, out_trade_no, total_fee, ip, body, expire_seconds,
+                            notify_url=None, trade_type='JSAPI', openid=None):
         now = datetime.now()
         time_start = now.strftime('%Y%m%d%H%M%S')
         time_expire = (now + timedelta(seconds=expire_seconds)) \
@@ -133,9 +502,10 @@ class WXPay(object):
             if not openid:
                 raise WXPayError('微信内支付需要openid')
             data['openid'] = openid
+        return data
 
-        result = self._post(path, data)
-
+    @staticmethod
+    def _check_unified_order_result(result, data):
         if result['return_code'] != 'SUCCESS':
             msg = '统一下单错误, msg-{0},\ndata-{1}' \
                 .format(result['return_msg'], json.dumps(data))
@@ -143,11 +513,28 @@ class WXPay(object):
 
         return result
 
-    def query_order(self, out_trade_no=None, transaction_id=None):
+    def query_order(self, out_trade_no=None, transaction_id=None, use_cache=True):
         """`查询订单
         <https://pay.weixin.qq.com/wiki/doc/api/app/app.php?chapter=9_2&index=4>`_
+
+        开启WXPAY_QUERY_CACHE时, trade_state为终态(见 ``CACHEABLE_TRADE_STATES``)的结果缓存在
+        ``wxpay.query_cache``; 其他进程或者商户平台上的退款在缓存过期前查不到,
+        缓存中的SUCCESS可能已经变为REFUND
+
+        :params use_cache: 为False时不读取缓存, 总是请求接口
         """
         path = '/pay/orderquery'
+        data, key = self._query_order_data(out_trade_no, transaction_id)
+        if use_cache:
+            cached = self._get_cached(key, path)
+            if cached is not None:
+                return cached
+        result = self._post(path, data)
+        self._cache_order(result)
+        return result
+
+    def _query_order_data(self, out_trade_no=None, transaction_id=None):
+        """返回查询订单的请求数据和缓存key"""
         if not (transaction_id or out_trade_no):
             raise WXPayError('查询订单需要transaction_id or out_trade_no')
         data = dict()
@@ -155,18 +542,85 @@ class WXPay(object):
             data['transaction_id'] = transaction_id
         else:
             data['out_trade_no'] = out_trade_no
+        field, value = next(iter(data.items()))
+        return data, self._order_cache_key(field, value)
 
-        return self._post(path, data)
+    def _order_cache_key(self, field, value):
+        return 'order:{0}:{1}:{2}'.format(self.mch_id, field, value)
+
+    def _refund_cache_key(self, out_trade_no):
+        return 'refund:{0}:{1}'.format(self.mch_id, out_trade_no)
+
+    def _get_cached(self, key, path):
+        if self.query_cache is None:
+            return None
+        cached = self.query_cache.get(key)
+        if cached is None:
+            return None
+        # 缓存中保存dict, 返回副本, 调用者修改结果不影响缓存
+        return self._wrap_result(path, dict(cached))
+
+    def _cache_order(self, result):
+        if self.query_cache is None or result.get('trade_state') not in CACHEABLE_TRADE_STATES:
+            return
+        value = dict(result)
+        for field in ('out_trade_no', 'transaction_id'):
+            if result.get(field):
+                self.query_cache.set(self._order_cache_key(field, result[field]), value)
+
+    def _cache_refund(self, out_trade_no, result):
+        if self.query_cache is None:
+            return
+        count = int(result.get('refund_count') or 0)
+        if count and all(result.get('refund_status_{0}'.format(i)) in TERMINAL_REFUND_STATES
+                         for i in range(count)):
+            self.query_cache.set(self._refund_cache_key(out_trade_no), dict(result))
+
+    def _invalidate_cache(self, out_trade_no):
+        """退款后订单状态和退款查询结果都会变化"""
+        if self.query_cache is None:
+            return
+        key = self._order_cache_key('out_trade_no', out_trade_no)
+        cached = self.query_cache.get(key)
+        self.query_cache.delete(key)
+        if cached is not None and cached.get('transaction_id'):
+            self.query_cache.delete(self._order_cache_key('transaction_id', cached['transaction_id']))
+        self.query_cache.delete(self._refund_cache_key(out_trade_no))
+
+    def wait_for_payment(self, out_trade_no, timeout=30):
+        """等待订单支付完成或者进入其他终态, 返回 :meth:`query_order` 的结果
+
+        同一个订单的并发调用共用一个查询循环, 查询间隔从WXPAY_POLL_INITIAL_INTERVAL
+        逐渐增加到WXPAY_POLL_MAX_INTERVAL; :meth:`notify_handler` 处理支付通知后
+        立即返回通知数据(trade_state为SUCCESS)。
+
+        :params out_trade_no: 商户订单号
+        :params timeout: 最长等待时间(秒)
+        :return: 超时时返回最近一次查询的结果, 还没有查询结果时返回None
+        :raises ResultCodeFail: 订单不存在等重试也不会成功的错误
+        """
+        return self.payment_waiter.wait(out_trade_no, timeout)
 
-    def query_refund(self, out_trade_no):
+    def query_refund(self, out_trade_no, use_cache=True):
         """`查询退款
         <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_5>`_
+
+        开启WXPAY_QUERY_CACHE时, 所有退款都为终态(见 ``TERMINAL_REFUND_STATES``)的结果缓存在
+        ``wxpay.query_cache``, 缓存过期前查不到其他进程或者商户平台上发起的新退款
+
+        :params use_cache: 为False时不读取缓存, 总是请求接口
         """
         path = '/pay/refundquery'
         data = dict(
             out_trade_no=out_trade_no,
         )
-        return self._post(path, data)
+        if use_cache:
+            cached = self._get_cached(self._refund_cache_key(out_trade_no), path)
+            if cached is not None:
+                return cached
+        result = self._post(path, data)
+        self._cache_refund(out_trade_no, result)
+        return result
 
     def close_order(self, out_trade_no):
         """`关闭订单
@@ -176,6 +630,30 @@ class WXPay(object):
         data = dict(out_trade_no=out_trade_no)
         return self._post(path, data)
 
+    def query_orders(self, out_trade_nos, max_in_flight=None):
+        """批量 :meth:`query_order`, 按完成顺序产生 ``(out_trade_no, result)``,
+        查询失败时result为 :class:`~flask_wxpay.exceptions.WXPayError` 实例::
+
+            for out_trade_no, result in wxpay.query_orders(out_trade_nos):
+                if isinstance(result, WXPayError):
+                    ...
+
+        :params out_trade_nos: 商户订单号的可迭代对象
+        :params max_in_flight: 最大并发请求数, 默认使用WXPAY_BATCH_MAX_IN_FLIGHT的配置
+        """
+        return self._batch(self.query_order, out_trade_nos, max_in_flight)
+
+    def close_orders(self, out_trade_nos, max_in_flight=None):
+        """批量 :meth:`close_order`, 用法同 :meth:`query_orders`"""
+        return self._batch(self.close_order, out_trade_nos, max_in_flight)
+
+    def query_refunds(self, out_trade_nos, max_in_flight=None):
+        """批量 :meth:`query_refund`, 用法同 :meth:`query_orders`"""
+        return self._batch(self.query_refund, out_trade_nos, max_in_flight)
+
+    def _batch(self, func, keys, max_in_flight=None):
+        return imap_unordered(func, keys, max_in_flight or self.batch_max_in_flight)
+
     def refund(self, out_trade_no, out_refund_no, total_fee, refund_fee):
         """`退款 <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_4>`_
         """
@@ -186,7 +664,12 @@ class WXPay(object):
             total_fee=total_fee,
             refund_fee=refund_fee,
         )
-        return self._post(path, data, use_cert=True)
+        self._invalidate_cache(out_trade_no)
+        try:
+            return self._post(path, data, use_cert=True)
+        finally:
+            # 退款期间开始的查询可能缓存了退款前的结果
+            self._invalidate_cache(out_trade_no)
 
     def send_redpack(self, mch_billno, send_name, re_openid, total_amount,
                      wishing, client_ip, act_name, remark):
@@ -214,7 +697,7 @@ class WXPay(object):
             act_name=act_name,
             remark=remark
         )
-        return self._post(path, data, use_cert=True, sendredpack=True)
+        return self._post(path, data, use_cert=True)
 
     def get_redpack_info(self, mch_billno):
         """查询红包信息
@@ -227,11 +710,13 @@ class WXPay(object):
         )
         return self._post(path, data, use_cert=True)
 
-    def download_bill(self, bill_date, bill_type='ALL'):
+    def download_bill(self, bill_date, bill_type='ALL', tar_type=None, stream=False):
         """`现在对账单 <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_6>`_
 
         :params bill_date: 下载对账单的日期，格式：20140603
         :params bill_type: ALL, SUCCESS, REFUND, RECHARGE_REFUND
+        :params tar_type: 压缩账单, 目前仅支持GZIP, 默认不压缩
+        :params stream: 为True时不立即读取响应内容
         :return: response.Response对象
         """
         path = '/pay/downloadbill'
@@ -239,7 +724,79 @@ class WXPay(object):
             bill_date=bill_date,
             bill_type=bill_type,
         )
-        return self._post_resp(path, data)
+        if tar_type:
+            data['tar_type'] = tar_type
+        return self._post_resp(path, data, stream=stream)
+
+    def iter_bill(self, bill_date, bill_type='ALL', tar_type='GZIP', chunk_size=64 * 1024):
+        """流式下载并解析对账单, 不会把整个账单读入内存
+
+        :params bill_date: 下载对账单的日期，格式：20140603
+        :params bill_type: ALL, SUCCESS, REFUND, RECHARGE_REFUND
+        :params tar_type: 默认下载GZIP压缩的账单并增量解压, 为None时不压缩
+        :params chunk_size: 每次读取的字节数
+        :return: :class:`~flask_wxpay.bill.BillReader`, 迭代产生账单记录,
+            迭代结束后 ``summary`` 属性为汇总数据
+        """
+        r = self.download_bill(bill_date, bill_type, tar_type, stream=True)
+        return BillReader(r, chunk_size)
+
+    def download_fund_flow(self, bill_date, account_type='Basic', tar_type=None, stream=False):
+        """`下载资金账单 <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_18&index=7>`_
+
+        :params bill_date: 资金账单的日期，格式：20140603
+        :params account_type: 资金账户类型, Basic 基本账户, Operation 运营账户, Fees 手续费账户
+        :params tar_type: 压缩账单, 目前仅支持GZIP, 默认不压缩
+        :params stream: 为True时不立即读取响应内容
+        :return: response.Response对象
+        """
+        data = dict(
+            bill_date=bill_date,
+            account_type=account_type,
+        )
+        if tar_type:
+            data['tar_type'] = tar_type
+        return self._post_resp(FUND_FLOW_PATH, data, use_cert=True, stream=stream)
+
+    def iter_fund_flow(self, bill_date, account_type='Basic', tar_type='GZIP', chunk_size=64 * 1024):
+        """流式下载并解析资金账单, 参数见 :meth:`download_fund_flow`
+
+        :return: :class:`~flask_wxpay.bill.BillReader`, 迭代产生资金流水记录,
+            迭代结束后 ``summary`` 属性为汇总数据
+        """
+        r = self.download_fund_flow(bill_date, account_type, tar_type, stream=True)
+        return BillReader(r, chunk_size)
+
+    def iter_comments(self, begin_time, end_time, offset=0, limit=COMMENT_MAX_LIMIT):
+        """`拉取订单评价数据 <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_17&index=11>`_,
+        按页请求, 消费当前页时在后台请求下一页::
+
+            comments = wxpay.iter_comments('20170701000000', '20170710000000')
+            for comment in comments:
+                print(comment.transaction_id, comment.stars, comment.content)
+            # 中断后从comments.offset继续
+
+        :params begin_time: 开始时间，格式：20170701000000
+        :params end_time: 结束时间, 与开始时间的间隔不超过10天
+        :params offset: 从该位置开始拉取, 中断后传入上次的 ``offset`` 属性继续
+        :params limit: 每页条数, 最大200
+        :return: :class:`~flask_wxpay.comment.CommentReader`
+        """
+        fetch = functools.partial(self._comment_page, begin_time, end_time, limit=limit)
+        return CommentReader(fetch, offset, limit)
+
+    def _comment_page_data(self, begin_time, end_time, offset, limit):
+        return dict(
+            begin_time=begin_time,
+            end_time=end_time,
+            offset=offset,
+            limit=limit,
+        )
+
+    def _comment_page(self, begin_time, end_time, offset, limit=COMMENT_MAX_LIMIT):
+        data = self._comment_page_data(begin_time, end_time, offset, limit)
+        r = self._post_resp(COMMENT_PATH, data, use_cert=True)
+        return parse_comment_page(r.content)
 
     def transfers(self, partner_trade_no, openid, amount, desc, ip,
                   check_name='NO_CHECK', re_user_name=None):
@@ -285,9 +842,47 @@ class WXPay(object):
 
     def get_sandbox_signkey(self):
         """获取验签秘钥，沙箱环境下有效"""
-        path = '/sandboxnew/pay/getsignkey'
+        path = SANDBOX_SIGNKEY_PATH
         data = dict()
         j = self._post(path, data, check_result=False)
+        return self._parse_sandbox_signkey(j)
+
+    @property
+    def _sandbox_signkey_cache_key(self):
+        return 'sandbox_signkey:{0}:{1}'.format(self.mch_id, md5(self.merchant_key))
+
+    def _get_sandbox_signkey(self):
+        """依次从内存, sandbox_signkey_cache中获取sandbox_signkey, 都没有时请求接口获取"""
+        if self._sandbox_signkey is not None:
+            return self._sandbox_signkey
+        with self._sandbox_signkey_lock:
+            if self._sandbox_signkey is None:
+                key = self.sandbox_signkey_cache.get(self._sandbox_signkey_cache_key)
+                if key is None:
+                    # 子类的 :meth:`_post` 可能是异步的, 这里固定使用同步请求
+                    r = WXPay._post_resp(self, SANDBOX_SIGNKEY_PATH, dict())
+                    j = self._handle_result(r.content, check_result=False)
+                    key = self._parse_sandbox_signkey(j)
+                self._set_sandbox_signkey(key)
+        return self._sandbox_signkey
+
+    def _set_sandbox_signkey(self, key):
+        self.sandbox_signkey_cache.set(self._sandbox_signkey_cache_key, key,
+                                       self.sandbox_signkey_timeout)
+        self._sandbox_signkey = key
+
+    def _clear_sandbox_signkey(self):
+        self.sandbox_signkey_cache.delete(self._sandbox_signkey_cache_key)
+        self._sandbox_signkey = None
+
+    def _is_sandbox_sign_error(self, e):
+        """沙箱模式下的签名错误, 微信返回的签名错误是return_code为FAIL"""
+        if not self.sandbox:
+            return False
+        return isinstance(e, SignError) or u'签名' in (e.return_msg or '')
+
+    @staticmethod
+    def _parse_sandbox_signkey(j):
         if 'sandbox_signkey' not in j:
             raise WXPayError('获取signbox_signkey失败 {}'.format(json.dumps(j, ensure_ascii=False)))
         return j['sandbox_signkey']
@@ -322,7 +917,7 @@ class WXPay(object):
             timeStamp=str(int(time.time())),
             nonceStr=gen_random_str(),
             package='prepay_id={0}'.format(prepay_id),
-            signType='MD5',
+            signType=self.sign_type,
         )
         data['paySign'] = self.get_sign(data)
         return data
@@ -331,9 +926,7 @@ class WXPay(object):
         """检查微信支付回调签名是否正确"""
         if 'sign' not in data:
             return False
-        tmp_data = data.copy()
-        del tmp_data['sign']
-        sign = self.get_sign(tmp_data)
+        sign = self.get_sign(data, data.get('sign_type'))
         return data['sign'] == sign
 
     @staticmethod
@@ -341,6 +934,67 @@ class WXPay(object):
         """通知结果的返回"""
         return dict_to_xml(return_code=return_code, return_msg=return_msg)
 
+    def notify_handler(self, f):
+        """处理支付结果通知的装饰器, 校验数据并按transaction_id去重
+
+        被装饰的函数第一个参数为通知数据, 返回None时应答SUCCESS并记录该通知已处理,
+        微信重复发送的通知不会再调用被装饰的函数; 返回其他值时原样作为应答,
+        抛出异常时不会记录, 微信会重新发送通知::
+
+            @bp.route('/wxpay/notify', methods=['POST'])
+            @wxpay.notify_handler
+            def notify(data):
+                handle trade
+                ...
+
+        调用被装饰的函数之前用 ``add`` 把通知标记为处理中, 同时到达的重复通知应答FAIL,
+        微信稍后重发; 格式错误或者缺少字段的通知也应答FAIL。
+
+        去重缓存为 ``wxpay.notify_cache``, 默认为进程内的
+        :class:`~flask_wxpay.cache.LRUCache`, 多进程部署时可以替换为共享缓存,
+        需要实现原子的add(cachelib的缓存都支持)。
+        """
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            try:
+                data = xml_to_dict(request.get_data())
+                self.check_data(data)
+            except (ParseError, ValueError):
+                logger.warning('微信支付通知不是合法的xml: %r', request.get_data()[:200])
+                return self.notify_response('FAIL', '数据格式错误')
+            except SignError:
+                return self.notify_response('FAIL', '签名错误')
+            except (WXPayError, KeyError):
+                logger.error('微信支付数据错误', exc_info=True)
+                return self.notify_response('FAIL', '数据错误')
+
+            notify_id = data.get('transaction_id') or data.get('out_trade_no')
+            if not notify_id:
+                # 没有订单号无法去重, 否则所有这样的通知都会共用一个key
+                logger.error('微信支付通知缺少订单号: %r', data)
+                return self.notify_response('FAIL', '缺少订单号')
+            key = 'notify:{0}'.format(notify_id)
+            # 先原子地标记为处理中, 同时到达的重复通知不会再调用f
+            if not self.notify_cache.add(key, NOTIFY_PROCESSING, self.notify_processing_timeout):
+                if self.notify_cache.get(key) == NOTIFY_PROCESSING:
+                    # 还没处理完, 让微信稍后重试, 不能提前应答SUCCESS
+                    return self.notify_response('FAIL', '处理中')
+                return _NOTIFY_SUCCESS
+
+            try:
+                rv = f(data, *args, **kwargs)
+            except BaseException:
+                self.notify_cache.delete(key)
+                raise
+            if rv is not None:
+                self.notify_cache.delete(key)
+                return rv
+            self.notify_cache.set(key, True)
+            if data.get('out_trade_no'):
+                self.payment_waiter.resolve(data['out_trade_no'], dict(data, trade_state='SUCCESS'))
+            return _NOTIFY_SUCCESS
+        return decorated
+
     def check_data(self, data, check_sign=True):
         """检查请求结果或者支付通知数据的正确性
         如果结果不合法会抛出一个WXPayError的子类
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.aio
+~~~~~~~~~~~~~~~
+
+基于 `httpx <https://www.python-httpx.org/>`_ 的asyncio微信支付客户端,
+需要安装httpx: ``pip install Flask-WXPay[async]``
+"""
+
+import asyncio
+import functools
+import os
+import time
+import weakref
+
+from . import COMMENT_PATH, HEDGE_PATHS, SANDBOX_SIGNKEY_PATH, WXPay
+from .batch import aimap_unordered
+from .bill import AsyncBillReader
+from .comment import MAX_LIMIT as COMMENT_MAX_LIMIT
+from .comment import AsyncCommentReader, parse_comment_page
+from .compat import urljoin
+from .exceptions import ReturnCodeFail, SignError
+from .hedge import ahedged_call
+from .poll import AsyncPaymentWaiter
+from .transport import create_ssl_context
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+class AsyncTransport(object):
+    """持有 :class:`httpx.AsyncClient` 连接池, 与 :class:`~flask_wxpay.transport.Transport` 对应
+
+    :params max_connections: 最大并发连接数
+    :params max_keepalive_connections: 保持的keep-alive连接数
+    :params ssl_context: 加载了商户API证书的SSLContext
+    :params verify: 同requests的verify参数
+    """
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20,
+                 ssl_context=None, verify=True):
+        if httpx is None:
+            raise ImportError('AsyncWXPay需要安装httpx: pip install httpx')
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self.ssl_context = ssl_context
+        self.verify = create_ssl_context(verify=verify) if verify is not False else False
+        self._clients = weakref.WeakKeyDictionary()
+        self._pid = None
+
+    def get_client(self, use_cert=False):
+        """当前事件循环的AsyncClient
+
+        AsyncClient的连接绑定在创建它的事件循环上, 每个事件循环使用各自的AsyncClient,
+        例如Flask的async视图每个请求都在新的事件循环中执行; fork后全部重建
+        """
+        loop = asyncio.get_running_loop()
+        pid = os.getpid()
+        if self._pid != pid:
+            self._clients = weakref.WeakKeyDictionary()
+            self._pid = pid
+        clients = self._clients.get(loop)
+        if clients is None:
+            clients = self._clients[loop] = {}
+        client = clients.get(use_cert)
+        if client is None:
+            verify = self.ssl_context if use_cert else self.verify
+            client = clients[use_cert] = httpx.AsyncClient(verify=verify, limits=self.limits)
+        return client
+
+    async def post(self, url, use_cert=False, stream=False, **kwargs):
+        """stream为True时不读取响应内容, 需要调用方关闭响应"""
+        client = self.get_client(use_cert)
+        request = client.build_request('POST', url, **kwargs)
+        return await client.send(request, stream=stream)
+
+    async def aclose(self):
+        """关闭当前事件循环的AsyncClient, 其他事件循环的AsyncClient随事件循环一起释放"""
+        if self._pid != os.getpid():
+            return
+        clients = self._clients.pop(asyncio.get_running_loop(), None) or {}
+        for client in clients.values():
+            await client.aclose()
+
+
+class AsyncWXPay(WXPay):
+    """asyncio版本的微信支付类, 接口与 :class:`~flask_wxpay.WXPay` 相同,
+    发送请求的方法都需要 ``await``::
+
+        wxpay = AsyncWXPay(app)
+        result = await wxpay.query_order(out_trade_no)
+
+    签名、xml编解码、结果检查与同步版本共用。
+    """
+
+    def init_app(self, app):
+        super(AsyncWXPay, self).init_app(app)
+        max_connections = app.config.get('WXPAY_ASYNC_POOL_MAXSIZE', 100)
+        self.async_transport = AsyncTransport(
+            max_connections=max_connections,
+            max_keepalive_connections=app.config.get('WXPAY_POOL_MAXSIZE', 10),
+            ssl_context=self.transport.ssl_context,
+            verify=self.transport.verify,
+        )
+
+    def _create_payment_waiter(self, app, cls=AsyncPaymentWaiter):
+        return super(AsyncWXPay, self)._create_payment_waiter(app, cls)
+
+    async def wait_for_payment(self, out_trade_no, timeout=30):
+        return await self.payment_waiter.wait(out_trade_no, timeout)
+
+    wait_for_payment.__doc__ = WXPay.wait_for_payment.__doc__
+
+    async def _post(self, path, data, use_cert=False, check_result=True):
+        r = await self._send(path, data, use_cert)
+        try:
+            return self._handle_result(r.content, use_cert, check_result, path)
+        except (SignError, ReturnCodeFail) as e:
+            if not self._is_sandbox_sign_error(e):
+                raise
+        self._clear_sandbox_signkey()
+        r = await self._post_resp(path, data, use_cert)
+        return self._handle_result(r.content, use_cert, check_result, path)
+
+    async def _send(self, path, data, use_cert=False):
+        if self.hedge_policy is None or path not in HEDGE_PATHS:
+            return await self._post_resp(path, data, use_cert)
+
+        async def call():
+            start = time.time()
+            r = await self._post_resp(path, dict(data), use_cert)
+            self.hedge_policy.record(path, time.time() - start)
+            return r
+        return await ahedged_call(self.hedge_policy, path, call)
+
+    async def _post_resp(self, path, data, use_cert=False, stream=False):
+        """post发送请求，返回httpx.Response对象"""
+        self._check_cert(use_cert)
+        if self.rate_limiter is not None:
+            wait = self._reserve_rate_limit(path)
+            if wait:
+                await asyncio.sleep(wait)
+        metrics = self.metrics
+        if metrics is None:
+            return await self._send_request(path, data, use_cert, stream)
+        start = metrics.start(path)
+        error = None
+        try:
+            return await self._send_request(path, data, use_cert, stream)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(path, start, error, isinstance(error, httpx.TimeoutException))
+
+    async def _send_request(self, path, data, use_cert=False, stream=False):
+        # 不覆盖同步的_do_post_resp, 获取sandbox_signkey时仍然可以使用同步请求
+        if path != SANDBOX_SIGNKEY_PATH:
+            await self._ensure_sandbox_signkey()
+        tracer = self.tracer
+        api_path = path
+        path, xml_data = self._prepare_request(path, data, use_cert)
+        timeout = httpx.Timeout(self.request_timeout,
+                                connect=self.connect_timeout or self.request_timeout)
+        base_urls = self.hosts.candidates()
+        for i, base_url in enumerate(base_urls):
+            start = time.perf_counter()
+            try:
+                r = await self.async_transport.post(urljoin(base_url, path), use_cert=use_cert,
+                                                    content=xml_data, timeout=timeout,
+                                                    stream=stream)
+            except httpx.HTTPError as e:
+                self.hosts.report_failure(base_url)
+                connect_error = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if i + 1 == len(base_urls) or not self._can_retry(path, connect_error):
+                    raise
+                continue
+            finally:
+                if tracer is not None:
+                    tracer.record('network', api_path, start)
+            self.hosts.report_success(base_url, time.perf_counter() - start)
+            break
+        if r.encoding.lower() in ('iso-8859-1', 'latin-1', 'ascii'):
+            r.encoding = 'UTF-8'
+        return r
+
+    async def unified_order(self, out_trade_no, total_fee, ip, body, expire_seconds,
+                            notify_url=None, trade_type='JSAPI', openid=None):
+        data = self._unified_order_data(out_trade_no, total_fee, ip, body, expire_seconds,
+                                        notify_url, trade_type, openid)
+        result = await self._post('/pay/unifiedorder', data)
+        return self._check_unified_order_result(result, data)
+
+    unified_order.__doc__ = WXPay.unified_order.__doc__
+
+    async def query_order(self, out_trade_no=None, transaction_id=None, use_cache=True):
+        data, key = self._query_order_data(out_trade_no, transaction_id)
+        if use_cache:
+            cached = self._get_cached(key, '/pay/orderquery')
+            if cached is not None:
+                return cached
+        result = await self._post('/pay/orderquery', data)
+        self._cache_order(result)
+        return result
+
+    query_order.__doc__ = WXPay.query_order.__doc__
+
+    async def query_refund(self, out_trade_no, use_cache=True):
+        if use_cache:
+            cached = self._get_cached(self._refund_cache_key(out_trade_no), '/pay/refundquery')
+            if cached is not None:
+                return cached
+        result = await self._post('/pay/refundquery', dict(out_trade_no=out_trade_no))
+        self._cache_refund(out_trade_no, result)
+        return result
+
+    query_refund.__doc__ = WXPay.query_refund.__doc__
+
+    async def refund(self, out_trade_no, out_refund_no, total_fee, refund_fee):
+        data = dict(
+            out_trade_no=out_trade_no,
+            out_refund_no=out_refund_no,
+            total_fee=total_fee,
+            refund_fee=refund_fee,
+        )
+        self._invalidate_cache(out_trade_no)
+        try:
+            return await self._post('/secapi/pay/refund', data, use_cert=True)
+        finally:
+            self._invalidate_cache(out_trade_no)
+
+    refund.__doc__ = WXPay.refund.__doc__
+
+    async def _ensure_sandbox_signkey(self):
+        """异步获取sandbox_signkey, 避免在 :attr:`key` 中发送同步请求"""
+        if not self.sandbox or self._sandbox_signkey is not None:
+            return
+        key = self.sandbox_signkey_cache.get(self._sandbox_signkey_cache_key)
+        if key is None:
+            key = await self.get_sandbox_signkey()
+        self._set_sandbox_signkey(key)
+
+    async def get_sandbox_signkey(self):
+        path = SANDBOX_SIGNKEY_PATH
+        j = await self._post(path, dict(), check_result=False)
+        return self._parse_sandbox_signkey(j)
+
+    get_sandbox_signkey.__doc__ = WXPay.get_sandbox_signkey.__doc__
+
+    async def iter_bill(self, bill_date, bill_type='ALL', tar_type='GZIP', chunk_size=64 * 1024):
+        """流式下载并解析对账单, 返回 :class:`~flask_wxpay.bill.AsyncBillReader`::
+
+            bill = await wxpay.iter_bill('20140603')
+            async for row in bill:
+                ...
+        """
+        r = await self.download_bill(bill_date, bill_type, tar_type, stream=True)
+        return AsyncBillReader(r, chunk_size)
+
+    async def iter_fund_flow(self, bill_date, account_type='Basic', tar_type='GZIP',
+                             chunk_size=64 * 1024):
+        """流式下载并解析资金账单, 返回 :class:`~flask_wxpay.bill.AsyncBillReader`"""
+        r = await self.download_fund_flow(bill_date, account_type, tar_type, stream=True)
+        return AsyncBillReader(r, chunk_size)
+
+    def iter_comments(self, begin_time, end_time, offset=0, limit=COMMENT_MAX_LIMIT):
+        """拉取订单评价数据, 返回 :class:`~flask_wxpay.comment.AsyncCommentReader`::
+
+            async for comment in wxpay.iter_comments('20170701000000', '20170710000000'):
+                ...
+        """
+        fetch = functools.partial(self._comment_page, begin_time, end_time, limit=limit)
+        return AsyncCommentReader(fetch, offset, limit)
+
+    async def _comment_page(self, begin_time, end_time, offset, limit=COMMENT_MAX_LIMIT):
+        data = self._comment_page_data(begin_time, end_time, offset, limit)
+        r = await self._post_resp(COMMENT_PATH, data, use_cert=True)
+        return parse_comment_page(r.content)
+
+    def _batch(self, func, keys, max_in_flight=None):
+        """批量接口返回异步生成器, 使用 ``async for`` 迭代"""
+        return aimap_unordered(func, keys, max_in_flight or self.batch_max_in_flight,
+                               network_errors=(httpx.HTTPError,))
+
+    async def aclose(self):
+        """关闭连接池"""
+        await self.async_transport.aclose()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.batch
+~~~~~~~~~~~~~~~~~
+
+批量调用接口, 以有限的并发数执行并按完成顺序返回结果,
+单个请求的错误作为 :class:`~flask_wxpay.exceptions.WXPayError` 返回而不中断整个批次。
+"""
+
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from .exceptions import NetworkError, WXPayError
+
+
+def _call(func, key, network_errors):
+    try:
+        return func(key)
+    except WXPayError as e:
+        return e
+    except network_errors as e:
+        return NetworkError(e)
+
+
+def imap_unordered(func, keys, max_in_flight=10,
+                   network_errors=(requests.RequestException,)):
+    """在线程池中对每个key调用func, 同时进行的请求不超过max_in_flight,
+    按完成顺序产生 ``(key, result)``, 失败时result为WXPayError实例
+
+    :params network_errors: 需要捕获的网络异常类型, 包装成 :class:`NetworkError`
+    """
+    keys = iter(keys)
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        while True:
+            for key in keys:
+                pending[executor.submit(_call, func, key, network_errors)] = key
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+async def _acall(func, key, network_errors):
+    try:
+        return await func(key)
+    except WXPayError as e:
+        return e
+    except network_errors as e:
+        return NetworkError(e)
+
+
+async def aimap_unordered(func, keys, max_in_flight=100, network_errors=()):
+    """:func:`imap_unordered` 的asyncio版本, func为协程函数"""
+    keys = iter(keys)
+    pending = {}
+    try:
+        while True:
+            for key in keys:
+                pending[asyncio.ensure_future(_acall(func, key, network_errors))] = key
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield pending.pop(task), task.result()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.bench
+~~~~~~~~~~~~~~~~~
+
+端到端的压力测试, 按比例混合调用unified_order, query_order, close_order, refund,
+统计吞吐量、延迟百分位、按err_code分类的错误数和每次调用的客户端CPU时间。
+
+对本地模拟服务器(见 :mod:`flask_wxpay.mock`)压测::
+
+    python -m flask_wxpay.bench --mock --concurrency 32 --duration 30
+
+对指定地址按固定QPS压测::
+
+    python -m flask_wxpay.bench --base-url http://127.0.0.1:8000 --mch-key KEY \\
+        --qps 500 --mix unified_order=4,query_order=4,close_order=1,refund=1
+
+固定QPS时延迟从计划发送的时间开始计算, 服务变慢导致的排队时间也计入延迟。
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Flask
+
+from . import WXPay
+from .exceptions import ResultCodeFail, ReturnCodeFail
+from .utils import gen_random_str, now_str
+
+OPERATIONS = ('unified_order', 'query_order', 'close_order', 'refund')
+
+DEFAULT_MIX = 'unified_order=4,query_order=4,close_order=1,refund=1'
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def parse_mix(spec):
+    """解析 ``unified_order=4,query_order=4`` 格式的调用比例, 返回 [(操作, 权重)]"""
+    mix = []
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('不支持的操作: {0}'.format(name))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def outcome(error):
+    """错误的分类: 成功为OK, result_code为FAIL时为err_code"""
+    if error is None:
+        return 'OK'
+    if isinstance(error, ResultCodeFail):
+        return error.err_code
+    if isinstance(error, ReturnCodeFail):
+        return 'FAIL:{0}'.format(error.return_msg)
+    return type(error).__name__
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[index]
+
+
+class LoadGenerator(object):
+    """按比例混合调用接口的压测
+
+    :params wxpay: :class:`~flask_wxpay.WXPay` 实例
+    :params mix: [(操作, 权重)], 见 :func:`parse_mix`
+    :params concurrency: 并发线程数
+    :params qps: 目标QPS, None时每个线程连续调用
+    :params duration: 压测时间(秒)
+    :params requests: 总调用次数, 配置后优先于duration
+    :params openid: 统一下单使用的openid
+    """
+
+    def __init__(self, wxpay, mix, concurrency=10, qps=None, duration=10, requests=None,
+                 openid='oUpF8uMuAJO_M2pxb1Q9zNjWeS6o'):
+        self.wxpay = wxpay
+        self.operations = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.concurrency = concurrency
+        self.qps = qps
+        self.duration = duration
+        self.requests = requests
+        self.openid = openid
+        #: 已创建的订单 (out_trade_no, total_fee), 供查询、关单、退款使用
+        self.orders = []
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._next_slot = None
+        self._deadline = None
+
+    def _next(self):
+        """下一次调用的计划开始时间, 压测结束时返回None"""
+        with self._lock:
+            if self.requests is not None:
+                if self._issued >= self.requests:
+                    return None
+            self._issued += 1
+            if self.qps is None:
+                return time.time()
+            slot = self._next_slot
+            self._next_slot += 1.0 / self.qps
+        return slot
+
+    def _call(self, operation):
+        if operation != 'unified_order' and not self.orders:
+            operation = 'unified_order'
+        if operation == 'unified_order':
+            out_trade_no = now_str() + gen_random_str(6)
+            total_fee = random.randint(1, 10000)
+            self.wxpay.unified_order(out_trade_no, total_fee, '127.0.0.1',
+                                     'flask_wxpay bench', 600, openid=self.openid)
+            self.orders.append((out_trade_no, total_fee))
+            return operation
+        out_trade_no, total_fee = random.choice(self.orders)
+        if operation == 'query_order':
+            self.wxpay.query_order(out_trade_no)
+        elif operation == 'close_order':
+            self.wxpay.close_order(out_trade_no)
+        else:
+            self.wxpay.refund(out_trade_no, 'R' + out_trade_no, total_fee, total_fee)
+        return operation
+
+    def _worker(self, samples):
+        while True:
+            scheduled = self._next()
+            if scheduled is None:
+                return
+            now = time.time()
+            if scheduled > now:
+                time.sleep(scheduled - now)
+            if self.requests is None and scheduled >= self._deadline:
+                return
+            operation = random.choices(self.operations, self.weights)[0]
+            error = None
+            try:
+                operation = self._call(operation)
+            except Exception as e:
+                error = e
+            samples.append((operation, time.time() - scheduled, outcome(error)))
+
+    def run(self):
+        """执行压测, 返回 :class:`Report`"""
+        samples = [[] for _ in range(self.concurrency)]
+        threads = [threading.Thread(target=self._worker, args=(s,)) for s in samples]
+        start = time.time()
+        self._next_slot = start
+        self._deadline = start + self.duration
+        cpu_start = time.process_time()
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        cpu = time.process_time() - cpu_start
+        return Report([x for s in samples for x in s], elapsed, cpu)
+
+
+class Report(object):
+    """压测结果
+
+    :params samples: [(操作, 延迟秒数, 结果分类)]
+    :params elapsed: 压测时间(秒)
+    :params cpu: 客户端进程的CPU时间(秒)
+    """
+
+    def __init__(self, samples, elapsed, cpu):
+        self.samples = samples
+        self.elapsed = elapsed
+        self.cpu = cpu
+
+    def summary(self):
+        result = dict(
+            calls=len(self.samples),
+            elapsed=self.elapsed,
+            throughput=len(self.samples) / self.elapsed if self.elapsed else 0,
+            cpu_per_call_us=self.cpu / len(self.samples) * 1e6 if self.samples else 0,
+            operations={},
+        )
+        groups = {'total': self.samples}
+        for sample in self.samples:
+            groups.setdefault(sample[0], []).append(sample)
+        for name, samples in groups.items():
+            latencies = sorted(s[1] for s in samples)
+            stats = dict(
+                calls=len(samples),
+                throughput=len(samples) / self.elapsed if self.elapsed else 0,
+                outcomes=dict(Counter(s[2] for s in samples)),
+                max_ms=latencies[-1] * 1000,
+            )
+            for p in PERCENTILES:
+                stats['p{0:g}_ms'.format(p)] = percentile(latencies, p) * 1000
+            result['operations'][name] = stats
+        return result
+
+    def format(self):
+        summary = self.summary()
+        lines = [
+            '{0} calls in {1:.1f}s, {2:,.1f} calls/sec, client CPU {3:,.0f} us/call'.format(
+                summary['calls'], summary['elapsed'], summary['throughput'],
+                summary['cpu_per_call_us']),
+            '',
+            '{0:<14} {1:>8} {2:>10} '.format('operation', 'calls', 'calls/sec')
+            + ' '.join('{0:>9}'.format('p{0:g}'.format(p)) for p in PERCENTILES)
+            + ' {0:>9}'.format('max'),
+        ]
+        operations = summary['operations']
+        names = [name for name in OPERATIONS if name in operations] + ['total']
+        for name in names:
+            stats = operations[name]
+            lines.append(
+                '{0:<14} {1:>8} {2:>10,.1f} '.format(name, stats['calls'], stats['throughput'])
+                + ' '.join('{0:>7.1f}ms'.format(stats['p{0:g}_ms'.format(p)]) for p in PERCENTILES)
+                + ' {0:>7.1f}ms'.format(stats['max_ms']))
+        lines.append('')
+        lines.append('outcomes:')
+        for name in names:
+            outcomes = operations[name]['outcomes']
+            lines.append('  {0:<12} {1}'.format(name, ', '.join(
+                '{0}={1}'.format(k, v) for k, v in sorted(outcomes.items(), key=lambda x: -x[1]))))
+        return '\n'.join(lines)
+
+
+def start_mock(args):
+    """在子进程中启动模拟服务器, 避免服务器的CPU时间计入客户端"""
+    command = [sys.executable, '-m', 'flask_wxpay.mock', '--mch-key', args.mch_key,
+               '--port', '0', '--notify-delay', str(args.mock_pay_delay)]
+    if args.mock_latency:
+        command.extend(['--latency', args.mock_latency])
+    if args.mock_errors:
+        command.extend(['--errors', args.mock_errors])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith('Serving on '):
+        process.kill()
+        raise RuntimeError('模拟服务器启动失败')
+    return process, line.split()[-1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flask_wxpay.bench',
+                                     description=u'flask_wxpay端到端压力测试')
+    parser.add_argument('--base-url', help=u'接口地址, 与--mock二选一')
+    parser.add_argument('--mock', action='store_true', help=u'在子进程中启动本地模拟服务器')
+    parser.add_argument('--mock-latency', help=u'模拟服务器的延迟分布, 例如 lognormal:0.02,0.5')
+    parser.add_argument('--mock-errors', help=u'模拟服务器注入错误的概率, 例如 SYSTEMERROR=0.01')
+    parser.add_argument('--mock-pay-delay', type=float, default=0,
+                        help=u'模拟服务器在统一下单后多少秒模拟支付成功, 默认0')
+    parser.add_argument('--mch-key', default='0' * 32, help=u'商户支付密钥')
+    parser.add_argument('--appid', default='wx2421b1c4370ec43b')
+    parser.add_argument('--mch-id', default='10000100')
+    parser.add_argument('--sign-type', default='MD5')
+    parser.add_argument('--cert', help=u'商户证书路径, refund需要')
+    parser.add_argument('--cert-key', help=u'商户证书私钥路径')
+    parser.add_argument('--rootca', help=u'验证服务器证书的CA证书')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=u'调用比例, 默认 ' + DEFAULT_MIX)
+    parser.add_argument('--concurrency', type=int, default=10, help=u'并发线程数')
+    parser.add_argument('--qps', type=float, help=u'目标QPS, 默认不限制')
+    parser.add_argument('--duration', type=float, default=10, help=u'压测时间(秒)')
+    parser.add_argument('--requests', type=int, help=u'总调用次数, 配置后忽略--duration')
+    parser.add_argument('--pool-maxsize', type=int, help=u'连接池大小, 默认等于并发数')
+    parser.add_argument('--timeout', type=float, default=10, help=u'请求超时时间(秒)')
+    parser.add_argument('--json', action='store_true', help=u'以json格式输出结果')
+    args = parser.parse_args(argv)
+
+    if not args.base_url and not args.mock:
+        parser.error(u'需要--base-url或者--mock')
+    mix = parse_mix(args.mix)
+    if not args.cert and any(name == 'refund' for name, _ in mix):
+        mix = [(name, weight) for name, weight in mix if name != 'refund']
+        sys.stderr.write(u'未配置--cert, 不调用refund\n')
+
+    mock = None
+    base_url = args.base_url
+    if args.mock:
+        mock, base_url = start_mock(args)
+    try:
+        app = Flask(__name__)
+        app.config.update(
+            WX_APPID=args.appid,
+            WXPAY_MCHID=args.mch_id,
+            WXPAY_KEY=args.mch_key,
+            WXPAY_SIGN_TYPE=args.sign_type,
+            # 模拟服务器发送的支付通知直接被拒绝
+            WXPAY_NOTIFY_URL='http://127.0.0.1:9/notify',
+            WXPAY_BASE_URL=base_url,
+            WXPAY_REQUEST_TIMEOUT=args.timeout,
+            WXPAY_POOL_MAXSIZE=args.pool_maxsize or args.concurrency,
+            WXPAY_APICLIENT_CERT_PATH=args.cert,
+            WXPAY_APICLIENT_KEY_PATH=args.cert_key,
+            WXPAY_ROOTCA_PATH=args.rootca,
+            # 测量接口本身的延迟, 不测量查询缓存
+            WXPAY_QUERY_CACHE=False,
+        )
+        generator = LoadGenerator(WXPay(app), mix, args.concurrency, args.qps,
+                                  args.duration, args.requests)
+        report = generator.run()
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    if args.json:
+        print(json.dumps(report.summary(), indent=2, sort_keys=True))
+    else:
+        print(report.format())
+
+
+if __name__ == '__main__':
+    main()
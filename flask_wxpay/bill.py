@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.bill
+~~~~~~~~~~~~~~~~
+
+对账单和资金账单的流式解析, 按块读取响应内容并逐行产生记录, 内存占用与账单大小无关。
+
+对账单格式::
+
+    交易时间,公众账号ID,商户号,...
+    `2014-11-10 16:33:45,`wx2421b1c4370ec43b,`10000100,...
+    总交易单数,应结订单总金额,退款总金额,...
+    `48,`5.76,`1.35,...
+"""
+
+import mmap
+import os
+import zlib
+from collections import namedtuple
+
+from .exceptions import WXPayError
+from .utils import xml_to_dict
+
+#: 对账单表头到字段名的映射, 未知的表头使用 ``field_<列序号>``
+BILL_FIELDS = {
+    u'交易时间': 'trade_time',
+    u'公众账号ID': 'appid',
+    u'商户号': 'mch_id',
+    u'特约商户号': 'sub_mch_id',
+    u'子商户号': 'sub_mch_id',
+    u'设备号': 'device_info',
+    u'微信订单号': 'transaction_id',
+    u'商户订单号': 'out_trade_no',
+    u'用户标识': 'openid',
+    u'交易类型': 'trade_type',
+    u'交易状态': 'trade_state',
+    u'付款银行': 'bank_type',
+    u'货币种类': 'fee_type',
+    u'应结订单金额': 'settlement_total_fee',
+    u'总金额': 'total_fee',
+    u'代金券金额': 'coupon_fee',
+    u'企业红包金额': 'coupon_fee',
+    u'微信退款单号': 'refund_id',
+    u'商户退款单号': 'out_refund_no',
+    u'退款金额': 'settlement_refund_fee',
+    u'充值券退款金额': 'coupon_refund_fee',
+    u'企业红包退款金额': 'coupon_refund_fee',
+    u'退款类型': 'refund_channel',
+    u'退款状态': 'refund_status',
+    u'商品名称': 'body',
+    u'商户数据包': 'attach',
+    u'手续费': 'service_charge',
+    u'费率': 'rate',
+    u'订单金额': 'total_fee',
+    u'申请退款金额': 'refund_fee',
+    u'费率备注': 'rate_remark',
+    u'退款申请时间': 'refund_create_time',
+    u'退款成功时间': 'refund_success_time',
+    # 资金账单
+    u'记账时间': 'bill_time',
+    u'微信支付业务单号': 'biz_transaction_id',
+    u'资金流水单号': 'fund_flow_id',
+    u'业务名称': 'biz_name',
+    u'业务类型': 'biz_type',
+    u'收支类型': 'financial_type',
+    u'收支金额（元）': 'amount',
+    u'收支金额(元)': 'amount',
+    u'账户结余（元）': 'balance',
+    u'账户结余(元)': 'balance',
+    u'资金变更提交申请人': 'applicant',
+    u'备注': 'memo',
+    u'业务凭证号': 'biz_voucher_id',
+    # 汇总数据
+    u'总交易单数': 'total_count',
+    u'应结订单总金额': 'settlement_total_fee',
+    u'总交易额': 'total_fee',
+    u'退款总金额': 'settlement_refund_fee',
+    u'总退款金额': 'settlement_refund_fee',
+    u'充值券退款总金额': 'coupon_refund_fee',
+    u'企业红包退款总金额': 'coupon_refund_fee',
+    u'手续费总金额': 'service_charge',
+    u'订单总金额': 'total_fee',
+    u'申请退款总金额': 'refund_fee',
+    u'资金流水总笔数': 'total_count',
+    u'收入笔数': 'income_count',
+    u'收入金额': 'income_amount',
+    u'支出笔数': 'expenditure_count',
+    u'支出金额': 'expenditure_amount',
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _record_type(name, header):
+    """根据表头生成namedtuple类型"""
+    fields = []
+    for i, title in enumerate(header):
+        field = BILL_FIELDS.get(title, 'field_{0}'.format(i))
+        if field in fields:
+            field = '{0}_{1}'.format(field, i)
+        fields.append(field)
+    return namedtuple(name, fields)
+
+
+def _split(line):
+    """去掉每个字段前的`并分割"""
+    if line.startswith(u'`'):
+        line = line[1:]
+    return line.split(u',`')
+
+
+class BillParser(object):
+    """增量解析对账单, 与IO无关, 同步和异步读取共用
+
+    :params encoding: 账单编码
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.header = None
+        self.row_type = None
+        self.summary_header = None
+        self.summary_type = None
+        self.summary = None
+        self._buffer = b''
+        self._decompressor = None
+        self._started = False
+        self._error_xml = None
+
+    def feed(self, chunk):
+        """输入一块原始数据, 返回其中完整的账单行记录列表"""
+        if not chunk:
+            return []
+        if not self._started:
+            self._started = True
+            if chunk.startswith(GZIP_MAGIC):
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif chunk.lstrip().startswith(b'<xml>'):
+                self._error_xml = chunk
+                return []
+        if self._error_xml is not None:
+            self._error_xml += chunk
+            return []
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """数据输入完毕, 返回剩余的记录列表
+
+        :raises WXPayError: 微信返回错误信息时
+        """
+        if self._error_xml is not None:
+            data = xml_to_dict(self._error_xml)
+            raise WXPayError(u'下载对账单失败: {0}'.format(data.get('return_msg')))
+        if self._decompressor is not None:
+            self._buffer += self._decompressor.flush()
+        lines, self._buffer = [self._buffer], b''
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        rows = []
+        for line in lines:
+            line = line.rstrip(b'\r').decode(self.encoding)
+            if not line:
+                continue
+            if self.header is None:
+                self.header = line.lstrip(u'\ufeff').split(u',')
+                self.row_type = _record_type('BillRow', self.header)
+            elif line.startswith(u'`'):
+                values = _split(line)
+                if self.summary_header is None:
+                    rows.append(self.row_type(*values))
+                else:
+                    self.summary = self.summary_type(*values)
+            else:
+                # 数据行结束, 之后是汇总数据的表头
+                self.summary_header = line.split(u',')
+                self.summary_type = _record_type('BillSummary', self.summary_header)
+        return rows
+
+
+class BillReader(BillParser):
+    """对账单的迭代器, 逐行产生 ``BillRow`` namedtuple, 迭代结束后
+    ``summary`` 属性为汇总数据 ``BillSummary``::
+
+        bill = wxpay.iter_bill('20140603')
+        for row in bill:
+            print(row.out_trade_no, row.total_fee)
+        print(bill.summary.total_count)
+
+    :params response: stream模式的requests.Response对象
+    :params chunk_size: 每次读取的字节数
+    """
+
+    def __init__(self, response, chunk_size=64 * 1024, encoding='utf-8'):
+        super(BillReader, self).__init__(encoding)
+        self.response = response
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                for row in self.feed(chunk):
+                    yield row
+            for row in self.close():
+                yield row
+        finally:
+            self.response.close()
+
+
+class MappedBillReader(BillParser):
+    """从本地账单文件解析, 使用 :class:`BillReader` 相同的方式迭代
+
+    文件使用mmap映射, 每次只复制chunk_size字节, 多个进程读取同一个文件时共享页缓存
+
+    :params path: 账单文件路径
+    """
+
+    def __init__(self, path, chunk_size=64 * 1024, encoding='utf-8'):
+        super(MappedBillReader, self).__init__(encoding)
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            # 不能映射空文件, 空文件没有记录
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for start in range(0, len(m), self.chunk_size):
+                        for row in self.feed(m[start:start + self.chunk_size]):
+                            yield row
+        for row in self.close():
+            yield row
+
+
+class AsyncBillReader(BillParser):
+    """:class:`BillReader` 的异步版本, 使用 ``async for`` 迭代
+
+    :params response: stream模式的httpx.Response对象
+    """
+
+    def __init__(self, response, chunk_size=64 * 1024, encoding='utf-8'):
+        super(AsyncBillReader, self).__init__(encoding)
+        self.response = response
+        self.chunk_size = chunk_size
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.response.aiter_raw(self.chunk_size):
+                for row in self.feed(chunk):
+                    yield row
+            for row in self.close():
+                yield row
+        finally:
+            await self.response.aclose()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.billstore
+~~~~~~~~~~~~~~~~~~~~~
+
+已下载对账单的本地存储。历史日期的账单不会再变化, 下载一次后保存在本地, 之后直接读取文件。
+
+目录结构::
+
+    objects/ab/cdef...      账单内容(下载时的原始数据, 例如GZIP压缩的账单), 文件名为sha256
+    refs/<mch_id>/<bill_date>-<bill_type>-<tar_type>.json
+                            {"sha256": ..., "size": ...}
+
+内容和索引都是先写临时文件再原子替换, 多个进程同时下载同一份账单也不会读到不完整的文件。
+读取时使用mmap, 多个进程扫描同一份账单时共享操作系统的页缓存。
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+from .bill import BillParser, MappedBillReader
+
+
+class BillStore(object):
+    """按 (mch_id, bill_date, bill_type, tar_type) 保存对账单::
+
+        store = BillStore(wxpay, '/var/lib/wxpay/bills')
+        for row in store.iter_bill('20240501'):
+            ...
+
+    :params wxpay: 同步的 :class:`~flask_wxpay.WXPay` 实例
+    :params directory: 存储目录
+    :params chunk_size: 下载时每次读取的字节数
+    """
+
+    def __init__(self, wxpay, directory, chunk_size=64 * 1024):
+        self.wxpay = wxpay
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def _ref_path(self, bill_date, bill_type, tar_type):
+        return os.path.join(self.directory, 'refs', str(self.wxpay.mch_id), '{0}-{1}-{2}.json'.format(
+            bill_date, bill_type, tar_type or 'RAW'))
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:])
+
+    def _read_ref(self, bill_date, bill_type, tar_type):
+        try:
+            with open(self._ref_path(bill_date, bill_type, tar_type)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get(self, bill_date, bill_type='ALL', tar_type='GZIP', verify=False):
+        """返回本地保存的账单文件路径, 没有或者不完整时返回None
+
+        :params verify: 为True时重新计算sha256, 否则只检查文件大小
+        """
+        ref = self._read_ref(bill_date, bill_type, tar_type)
+        if ref is None:
+            return None
+        path = self._object_path(ref['sha256'])
+        try:
+            if os.path.getsize(path) != ref['size']:
+                return None
+        except OSError:
+            return None
+        if verify and _sha256_file(path) != ref['sha256']:
+            return None
+        return path
+
+    def fetch(self, bill_date, bill_type='ALL', tar_type='GZIP', verify=False):
+        """返回账单文件路径, 本地没有完整的账单时下载
+
+        :raises WXPayError: 微信返回错误信息, 例如当天没有账单(No Bill Exist)
+        """
+        path = self.get(bill_date, bill_type, tar_type, verify)
+        if path is None:
+            path = self._download(bill_date, bill_type, tar_type)
+        return path
+
+    def _download(self, bill_date, bill_type, tar_type):
+        objects = os.path.join(self.directory, 'objects')
+        if not os.path.isdir(objects):
+            os.makedirs(objects, 0o700, exist_ok=True)
+        r = self.wxpay.download_bill(bill_date, bill_type, tar_type, stream=True)
+        fd, tmp_path = tempfile.mkstemp(dir=objects)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                chunks = r.iter_content(self.chunk_size)
+                for chunk in chunks:
+                    if not size and chunk.lstrip().startswith(b'<xml>'):
+                        # 错误信息, 交给BillParser抛出异常
+                        parser = BillParser()
+                        parser.feed(chunk)
+                        for chunk in chunks:
+                            parser.feed(chunk)
+                        parser.close()
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = digest.hexdigest()
+            path = self._object_path(digest)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            r.close()
+        self._write_ref(bill_date, bill_type, tar_type, dict(sha256=digest, size=size))
+        return path
+
+    def _write_ref(self, bill_date, bill_type, tar_type, ref):
+        path = self._ref_path(bill_date, bill_type, tar_type)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(ref, f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def open(self, bill_date, bill_type='ALL', tar_type='GZIP', verify=False):
+        """返回只读的mmap对象, 本地没有时下载; 空文件不能映射, 返回空的memoryview"""
+        with open(self.fetch(bill_date, bill_type, tar_type, verify), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return memoryview(b'')
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def iter_bill(self, bill_date, bill_type='ALL', tar_type='GZIP', verify=False):
+        """与 :meth:`~flask_wxpay.WXPay.iter_bill` 相同, 但是从本地文件读取
+
+        :return: :class:`~flask_wxpay.bill.MappedBillReader`
+        """
+        return MappedBillReader(self.fetch(bill_date, bill_type, tar_type, verify), self.chunk_size)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                digest.update(m)
+    return digest.hexdigest()
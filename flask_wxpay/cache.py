@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.cache
+~~~~~~~~~~~~~~~~~
+
+缓存接口与进程内的LRU、基于文件的实现, 接口与 `cachelib <https://cachelib.readthedocs.io/>`_
+相同, 多进程或多机部署时可以直接使用cachelib的RedisCache等共享缓存。
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .utils import md5
+
+
+class BaseCache(object):
+    """缓存接口"""
+
+    def get(self, key):
+        """返回缓存的值, 不存在或者已过期时返回None"""
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        """设置缓存
+
+        :params timeout: 过期时间(秒), None时使用默认过期时间, 0为永不过期
+        """
+        raise NotImplementedError
+
+    def add(self, key, value, timeout=None):
+        """key不存在(或已过期)时设置缓存, 返回是否设置成功
+
+        默认实现不是原子的, 子类应该覆盖; cachelib的缓存都实现了原子的add
+        """
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LRUCache(BaseCache):
+    """线程安全的进程内LRU缓存, 超过maxsize时淘汰最久未使用的条目
+
+    :params maxsize: 最大条目数
+    :params default_timeout: 默认过期时间(秒), 0为永不过期
+    """
+
+    def __init__(self, maxsize=10000, default_timeout=0):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _set(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._data[key] = (time.time() + timeout if timeout else 0, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and not (item[0] and item[0] < time.time()):
+                return False
+            self._set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(BaseCache):
+    """基于文件的缓存, 同一台机器上的多个进程共享, 值需要能被json序列化
+
+    :params directory: 缓存文件目录
+    :params default_timeout: 默认过期时间(秒), 0为永不过期
+    """
+
+    def __init__(self, directory, default_timeout=0):
+        self.directory = directory
+        self.default_timeout = default_timeout
+
+    def _path(self, key):
+        return os.path.join(self.directory, md5(key) + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                item = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if item['expires'] and item['expires'] < time.time():
+            return None
+        return item['value']
+
+    def _write_temp(self, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(expires=expires, value=value), f)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def set(self, key, value, timeout=None):
+        # 先写临时文件再替换, 其他进程不会读到写了一半的文件
+        tmp_path = self._write_temp(value, timeout)
+        try:
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return True
+
+    def add(self, key, value, timeout=None):
+        # link在目标已存在时失败, 多个进程同时add只有一个成功
+        path = self._path(key)
+        tmp_path = self._write_temp(value, timeout)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, path)
+                    return True
+                except FileExistsError:
+                    if self.get(key) is not None:
+                        return False
+                    # 已过期, 删除后重试一次
+                    self.delete(key)
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            return False
+        return True
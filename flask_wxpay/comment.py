@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.comment
+~~~~~~~~~~~~~~~~~~~
+
+按offset分页拉取订单评价数据, 消费当前页时在后台请求下一页, 内存中最多保存两页。
+
+每页的格式, 第一行为下一页的offset::
+
+    100
+    `2017-07-01 10:00:05,`1001690740201411100005734289,`5,`赞
+"""
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import WXPayError
+from .utils import xml_to_dict
+
+#: 一条评价
+Comment = namedtuple('Comment', 'comment_time transaction_id stars content')
+
+#: 每页的最大条数
+MAX_LIMIT = 200
+
+
+def parse_comment_page(content, encoding='utf-8'):
+    """解析一页评价数据, 返回 ``(下一页的offset, Comment列表)``
+
+    :raises WXPayError: 微信返回错误信息时
+    """
+    if content.lstrip().startswith(b'<xml>'):
+        data = xml_to_dict(content)
+        raise WXPayError(u'拉取订单评价数据失败: {0}'.format(
+            data.get('err_code_des') or data.get('return_msg')))
+    lines = content.decode(encoding).splitlines()
+    if not lines:
+        raise WXPayError(u'拉取订单评价数据失败: 返回内容为空')
+    rows = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line.startswith(u'`'):
+            line = line[1:]
+        # 评价内容中可能有逗号
+        rows.append(Comment(*line.split(u',`', 3)))
+    return int(lines[0]), rows
+
+
+class CommentReader(object):
+    """评价数据的迭代器, 逐条产生 :class:`Comment`
+
+    ``offset`` 属性为已经完整消费的页之后的位置, 中断后把它传给
+    :meth:`~flask_wxpay.WXPay.iter_comments` 可以继续拉取, 中断所在的页会重新返回
+
+    :params fetch: 参数为offset, 返回 ``(下一页的offset, Comment列表)`` 的函数
+    :params offset: 开始的位置
+    :params limit: 每页条数, 返回的条数少于limit时为最后一页
+    """
+
+    def __init__(self, fetch, offset=0, limit=MAX_LIMIT):
+        self.fetch = fetch
+        self.offset = offset
+        self.limit = limit
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.fetch, self.offset)
+        try:
+            while future is not None:
+                next_offset, rows = future.result()
+                future = None
+                if len(rows) >= self.limit:
+                    future = executor.submit(self.fetch, next_offset)
+                for row in rows:
+                    yield row
+                self.offset = next_offset
+        finally:
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+class AsyncCommentReader(CommentReader):
+    """:class:`CommentReader` 的异步版本, fetch为协程函数, 使用 ``async for`` 迭代"""
+
+    def __iter__(self):
+        raise TypeError('请使用async for迭代')
+
+    async def __aiter__(self):
+        task = asyncio.ensure_future(self.fetch(self.offset))
+        try:
+            while task is not None:
+                next_offset, rows = await task
+                task = None
+                if len(rows) >= self.limit:
+                    task = asyncio.ensure_future(self.fetch(next_offset))
+                for row in rows:
+                    yield row
+                self.offset = next_offset
+        finally:
+            if task is not None:
+                task.cancel()
@@ -5,6 +5,16 @@ class WXPayError(Exception):
     """A WXPay error occurred."""
 
 
+class NetworkError(WXPayError):
+    """网络请求失败, 属性: error 原始异常"""
+
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self):
+        return 'network error: {!r}'.format(self.error)
+
+
 class CertError(WXPayError):
     """双向证书的接口， 使用证书的接口如果未配置证书时抛出"""
 
@@ -34,5 +44,18 @@ class ResultCodeFail(WXPayError):
             self.err_code_des)
 
 
+class RateLimited(WXPayError):
+    """超过本地限流的频率, 请求没有发送
+    属性: path, retry_after 需要等待的秒数
+    """
+
+    def __init__(self, path, retry_after):
+        self.path = path
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return 'rate limited: {}, retry after {:.3f}s'.format(self.path, self.retry_after)
+
+
 class SignError(WXPayError):
     """签名错误"""
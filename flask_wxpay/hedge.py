@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.hedge
+~~~~~~~~~~~~~~~~~
+
+查询类接口的对冲请求: 第一个请求超过该接口延迟的某个百分位仍未返回时,
+再发送一个相同的请求(重新生成nonce_str和sign), 使用先返回的结果。
+对冲请求的数量受预算限制, 不会超过总请求数的一定比例。
+"""
+
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+
+
+class LatencyWindow(object):
+    """最近若干次请求的延迟, 用于计算百分位
+
+    :params size: 保留的样本数
+    :params refresh: 每增加多少个样本重新计算一次百分位
+    """
+
+    def __init__(self, size=1000, refresh=50):
+        self.samples = deque(maxlen=size)
+        self.refresh = refresh
+        self._sorted = []
+        self._since_sort = 0
+
+    def record(self, latency):
+        self.samples.append(latency)
+        self._since_sort += 1
+        if self._since_sort >= self.refresh or len(self._sorted) < self.refresh:
+            self._sorted = sorted(self.samples)
+            self._since_sort = 0
+
+    def percentile(self, p):
+        values = self._sorted
+        if not values:
+            return None
+        index = min(len(values) - 1, int(len(values) * p / 100.0))
+        return values[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class HedgePolicy(object):
+    """对冲请求的延迟计算和预算控制
+
+    每个请求增加budget个令牌, 每个对冲请求消耗一个令牌,
+    因此对冲请求不会超过总请求数的budget比例。
+
+    :params percentile: 第一个请求超过该百分位的延迟后发送对冲请求
+    :params budget: 对冲请求占总请求数的最大比例
+    :params default_delay: 样本数不足min_samples时使用的延迟(秒)
+    :params min_delay: 最小的延迟(秒)
+    :params min_samples: 开始使用百分位延迟需要的样本数
+    """
+
+    def __init__(self, percentile=95, budget=0.05, default_delay=1.0, min_delay=0.01,
+                 min_samples=20, max_tokens=10):
+        self.percentile = percentile
+        self.budget = budget
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self._windows = {}
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        #: 统计: 请求数, 对冲请求数, 对冲请求先返回的次数
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self, path):
+        window = self._windows.get(path)
+        if window is None or len(window) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, window.percentile(self.percentile))
+
+    def record(self, path, latency):
+        window = self._windows.get(path)
+        if window is None:
+            window = self._windows.setdefault(path, LatencyWindow())
+        with self._lock:
+            window.record(latency)
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self.max_tokens, self._tokens + self.budget)
+
+    def withdraw(self):
+        """是否还有预算发送对冲请求"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedges += 1
+            return True
+
+
+def _discard(future):
+    """关闭落后的请求的响应, 连接回到连接池"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def hedged_call(executor, policy, path, func):
+    """在executor中执行func, 必要时发送对冲请求, 返回先成功的结果
+
+    requests的同步请求无法中途取消, 落后的请求返回后关闭其响应。
+    每个请求在调用者上下文的副本中执行, 线程中可以使用Flask的app context(例如记录耗时的g)
+    """
+    policy.deposit()
+    first = executor.submit(contextvars.copy_context().run, func)
+    try:
+        return first.result(timeout=policy.delay(path))
+    except TimeoutError:
+        pass
+    if not policy.withdraw():
+        return first.result()
+
+    second = executor.submit(contextvars.copy_context().run, func)
+    pending = set([first, second])
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        succeeded = [f for f in done if f.exception() is None]
+        if succeeded or not pending:
+            winner = succeeded[0] if succeeded else done.pop()
+            if winner is second:
+                policy.hedge_wins += 1
+            for other in pending:
+                if not other.cancel():
+                    other.add_done_callback(_discard)
+            return winner.result()
+
+
+async def ahedged_call(policy, path, func):
+    """:func:`hedged_call` 的asyncio版本, func为协程函数, 落后的请求会被取消"""
+    policy.deposit()
+    first = asyncio.ensure_future(func())
+    done, _ = await asyncio.wait([first], timeout=policy.delay(path))
+    if done or not policy.withdraw():
+        return await first
+
+    second = asyncio.ensure_future(func())
+    pending = set([first, second])
+    while True:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        succeeded = [t for t in done if t.exception() is None]
+        if succeeded or not pending:
+            winner = succeeded[0] if succeeded else done.pop()
+            if winner is second:
+                policy.hedge_wins += 1
+            for other in pending:
+                other.cancel()
+            return winner.result()
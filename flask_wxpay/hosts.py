@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.hosts
+~~~~~~~~~~~~~~~~~
+
+多个微信支付API域名的健康状态跟踪与选择, 例如::
+
+    WXPAY_BASE_URLS = ['https://api.mch.weixin.qq.com',
+                       'https://api2.mch.weixin.qq.com']
+
+根据请求结果计算每个域名延迟和错误率的EWMA, 连续失败的域名被降级,
+后台线程定期探测降级的域名, 探测成功后恢复。探测请求与接口请求的延迟不可比,
+探测结果只决定是否恢复, 不计入EWMA。
+"""
+
+import threading
+import time
+
+
+class HostState(object):
+    """单个域名的健康状态"""
+
+    def __init__(self, base_url, index):
+        self.base_url = base_url
+        self.index = index
+        #: 延迟的EWMA(秒), 没有数据时为None
+        self.latency = None
+        #: 错误率的EWMA
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.healthy = True
+
+    def score(self, error_penalty):
+        if self.latency is None:
+            # 没有数据的域名排在有数据的后面, 按配置顺序
+            return float('inf')
+        return self.latency * (1 + error_penalty * self.error_rate)
+
+    def __repr__(self):
+        return '<HostState {0} healthy={1} latency={2} error_rate={3:.3f}>'.format(
+            self.base_url, self.healthy, self.latency, self.error_rate)
+
+
+class HostPool(object):
+    """在多个域名之间按健康状态和延迟选择
+
+    :params base_urls: 域名列表, 第一个为主域名
+    :params alpha: EWMA的平滑系数
+    :params failure_threshold: 连续失败多少次后降级
+    :params probe_interval: 后台探测的间隔(秒)
+    :params probe: 探测函数, 参数为base_url, 返回True表示可用
+    :params error_penalty: 计算分数时错误率的权重
+    """
+
+    def __init__(self, base_urls, alpha=0.3, failure_threshold=3, probe_interval=30,
+                 probe=None, error_penalty=10):
+        self.hosts = [HostState(url, i) for i, url in enumerate(base_urls)]
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self.error_penalty = error_penalty
+        self._by_url = dict((h.base_url, h) for h in self.hosts)
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def candidates(self):
+        """按优先级排序的base_url列表, 健康的在前, 降级的在后
+
+        主域名有延迟数据之前, 按配置顺序选择
+        """
+        primary = self.hosts[0]
+        healthy = [h for h in self.hosts if h.healthy]
+        if primary.healthy and primary.latency is None:
+            healthy.sort(key=lambda h: h.index)
+        else:
+            healthy.sort(key=lambda h: (h.score(self.error_penalty), h.index))
+        down = [h for h in self.hosts if not h.healthy]
+        down.sort(key=lambda h: (h.consecutive_failures, h.index))
+        return [h.base_url for h in healthy + down]
+
+    def report_success(self, base_url, latency):
+        host = self._by_url[base_url]
+        with self._lock:
+            if host.latency is None:
+                host.latency = latency
+            else:
+                host.latency += self.alpha * (latency - host.latency)
+            host.error_rate -= self.alpha * host.error_rate
+            host.consecutive_failures = 0
+            host.healthy = True
+
+    def report_failure(self, base_url):
+        host = self._by_url[base_url]
+        with self._lock:
+            host.error_rate += self.alpha * (1 - host.error_rate)
+            host.consecutive_failures += 1
+            if host.healthy and host.consecutive_failures >= self.failure_threshold:
+                host.healthy = False
+                self._start_probe()
+
+    def report_probe(self, base_url, ok):
+        """记录探测结果, 只改变健康状态, 不影响延迟和错误率"""
+        host = self._by_url[base_url]
+        with self._lock:
+            if ok:
+                host.consecutive_failures = 0
+                host.healthy = True
+            else:
+                host.consecutive_failures += 1
+
+    def _start_probe(self):
+        if self.probe is None or len(self.hosts) < 2:
+            return
+        if self._probe_thread is not None and self._probe_thread.is_alive():
+            return
+        self._probe_thread = threading.Thread(target=self._probe_loop,
+                                              name='flask-wxpay-probe')
+        self._probe_thread.daemon = True
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        """有降级的域名时定期探测, 全部恢复后退出"""
+        while any(not h.healthy for h in self.hosts):
+            time.sleep(self.probe_interval)
+            self.probe_once()
+
+    def probe_once(self):
+        """探测一次所有降级的域名"""
+        for host in self.hosts:
+            if host.healthy:
+                continue
+            try:
+                ok = self.probe(host.base_url)
+            except Exception:
+                ok = False
+            self.report_probe(host.base_url, ok)
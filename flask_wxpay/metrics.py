@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.metrics
+~~~~~~~~~~~~~~~~~~~
+
+按接口path统计请求的延迟分布、return_code/result_code/err_code、超时次数、进行中的请求数
+和本地限流的等待时间。
+
+统计只在进程内进行, 多进程部署时每个进程分别导出。导出方式:
+
+- 拉取: :class:`PrometheusExporter` 生成Prometheus文本格式, 例如::
+
+    @app.route('/metrics')
+    def metrics():
+        exporter = PrometheusExporter(wxpay.metrics)
+        return exporter.render(), 200, {'Content-Type': exporter.content_type}
+
+- 推送: 实现 :class:`Exporter` 并调用 :meth:`Metrics.add_exporter`,
+  或者开启WXPAY_METRICS_SIGNALS后订阅 :data:`request_finished`, :data:`result_received` 信号。
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask.signals import Namespace
+
+from .compat import str
+
+#: 默认的延迟分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_signals = Namespace()
+
+#: 每个请求结束时发送, 参数: path, elapsed, error
+request_finished = _signals.signal('wxpay-request-finished')
+
+#: 解析到返回结果时发送, 参数: path, data
+result_received = _signals.signal('wxpay-result-received')
+
+
+class EndpointStats(object):
+    """单个接口的统计数据"""
+
+    __slots__ = ('counts', 'sum', 'count', 'in_flight', 'errors', 'timeouts', 'results',
+                 'limit_wait', 'limit_delayed', 'limit_rejected')
+
+    def __init__(self, nbuckets):
+        #: 每个分桶的请求数(不累加), 最后一个为超过最大分桶的请求数
+        self.counts = [0] * (nbuckets + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.in_flight = 0
+        #: 网络错误的次数, 包括超时
+        self.errors = 0
+        self.timeouts = 0
+        #: (return_code, result_code, err_code) -> 次数
+        self.results = {}
+        #: 本地限流等待的总秒数, 需要等待的请求数, 超过最长等待时间被拒绝的请求数
+        self.limit_wait = 0.0
+        self.limit_delayed = 0
+        self.limit_rejected = 0
+
+
+class Exporter(object):
+    """推送式导出器的接口, 在请求的线程中同步调用, 实现应尽量轻量"""
+
+    def observe(self, path, elapsed, error):
+        """请求结束
+
+        :params elapsed: 耗时(秒)
+        :params error: 请求失败时为异常, 否则为None
+        """
+
+    def observe_result(self, path, data):
+        """解析到返回结果, data为返回结果的dict"""
+
+
+class SignalExporter(Exporter):
+    """把统计事件作为Flask信号发送, 没有订阅者时不发送"""
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def observe(self, path, elapsed, error):
+        if request_finished.receivers:
+            request_finished.send(self.sender, path=path, elapsed=elapsed, error=error)
+
+    def observe_result(self, path, data):
+        if result_received.receivers:
+            result_received.send(self.sender, path=path, data=data)
+
+
+class Metrics(object):
+    """请求的统计数据
+
+    :params buckets: 延迟分桶的上界(秒), 升序
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.exporters = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def _get_stats(self, path):
+        stats = self._stats.get(path)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(path, EndpointStats(len(self.buckets)))
+        return stats
+
+    def start(self, path):
+        """请求开始, 返回传给 :meth:`finish` 的开始时间"""
+        stats = self._get_stats(path)
+        with self._lock:
+            stats.in_flight += 1
+        return time.perf_counter()
+
+    def finish(self, path, start, error=None, timeout=False):
+        """请求结束
+
+        :params start: :meth:`start` 的返回值
+        :params error: 请求失败时为异常
+        :params timeout: 是否为超时错误
+        """
+        elapsed = time.perf_counter() - start
+        index = bisect_left(self.buckets, elapsed)
+        stats = self._get_stats(path)
+        with self._lock:
+            stats.in_flight -= 1
+            stats.counts[index] += 1
+            stats.sum += elapsed
+            stats.count += 1
+            if error is not None:
+                stats.errors += 1
+                if timeout:
+                    stats.timeouts += 1
+        for exporter in self.exporters:
+            exporter.observe(path, elapsed, error)
+
+    def record_result(self, path, data):
+        """记录返回结果的return_code, result_code, err_code"""
+        key = (data.get('return_code'), data.get('result_code'), data.get('err_code'))
+        stats = self._get_stats(path)
+        with self._lock:
+            stats.results[key] = stats.results.get(key, 0) + 1
+        for exporter in self.exporters:
+            exporter.observe_result(path, data)
+
+    def record_limit(self, path, wait, rejected=False):
+        """记录本地限流
+
+        :params wait: 等待的秒数
+        :params rejected: 是否因为等待时间过长被拒绝
+        """
+        stats = self._get_stats(path)
+        with self._lock:
+            if rejected:
+                stats.limit_rejected += 1
+            elif wait > 0:
+                stats.limit_wait += wait
+                stats.limit_delayed += 1
+
+    def snapshot(self):
+        """所有接口统计数据的副本, path -> dict"""
+        with self._lock:
+            return dict(
+                (path, dict(
+                    buckets=self.buckets,
+                    counts=list(stats.counts),
+                    sum=stats.sum,
+                    count=stats.count,
+                    in_flight=stats.in_flight,
+                    errors=stats.errors,
+                    timeouts=stats.timeouts,
+                    results=dict(stats.results),
+                    limit_wait=stats.limit_wait,
+                    limit_delayed=stats.limit_delayed,
+                    limit_rejected=stats.limit_rejected,
+                ))
+                for path, stats in self._stats.items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in sorted(labels.items())) + '}'
+
+
+class PrometheusExporter(object):
+    """生成 `Prometheus文本格式
+    <https://prometheus.io/docs/instrumenting/exposition_formats/>`_ 的统计数据
+
+    :params metrics: :class:`Metrics`
+    :params prefix: 指标名的前缀
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, metrics, prefix='wxpay'):
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def render(self):
+        snapshot = sorted(self.metrics.snapshot().items())
+        p = self.prefix
+        lines = []
+
+        name = p + '_request_duration_seconds'
+        lines.append('# HELP {0} 请求耗时'.format(name))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for path, s in snapshot:
+            total = 0
+            for le, count in zip(s['buckets'] + ('+Inf',), s['counts']):
+                total += count
+                lines.append('{0}_bucket{1} {2}'.format(name, _labels(path=path, le=le), total))
+            lines.append('{0}_sum{1} {2!r}'.format(name, _labels(path=path), s['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(path=path), s['count']))
+
+        for suffix, key, kind, help in (
+                ('_requests_in_flight', 'in_flight', 'gauge', '进行中的请求数'),
+                ('_request_errors_total', 'errors', 'counter', '请求错误次数'),
+                ('_request_timeouts_total', 'timeouts', 'counter', '超时次数'),
+                ('_ratelimit_wait_seconds_total', 'limit_wait', 'counter', '本地限流等待的总时间'),
+                ('_ratelimit_delayed_total', 'limit_delayed', 'counter', '本地限流需要等待的请求数'),
+                ('_ratelimit_rejected_total', 'limit_rejected', 'counter', '本地限流拒绝的请求数')):
+            name = p + suffix
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for path, s in snapshot:
+                lines.append('{0}{1} {2}'.format(name, _labels(path=path), s[key]))
+
+        name = p + '_responses_total'
+        lines.append('# HELP {0} 按return_code, result_code, err_code统计的返回结果数'.format(name))
+        lines.append('# TYPE {0} counter'.format(name))
+        for path, s in snapshot:
+            for (return_code, result_code, err_code), count in sorted(
+                    s['results'].items(), key=lambda item: tuple(x or '' for x in item[0])):
+                labels = _labels(path=path, return_code=return_code or '',
+                                 result_code=result_code or '', err_code=err_code or '')
+                lines.append('{0}{1} {2}'.format(name, labels, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,782 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.mock
+~~~~~~~~~~~~~~~~
+
+本地模拟的微信支付服务器, 用于离线的集成测试和压力测试。
+
+实现了 :class:`~flask_wxpay.WXPay` 调用的接口, 使用商户key签名返回结果,
+订单、退款、企业付款和红包的状态保存在内存中。可以配置延迟分布、按概率注入错误,
+统一下单后可以自动模拟支付并发送支付通知。
+
+在测试中使用::
+
+    server = MockWXPayServer(key=app.config['WXPAY_KEY'], latency='lognormal:0.05,0.5',
+                             errors={'SYSTEMERROR': 0.01}, notify_delay=1)
+    server.start()
+    app.config['WXPAY_BASE_URL'] = server.url
+    ...
+    server.stop()
+
+或者在命令行启动::
+
+    python -m flask_wxpay.mock --mch-key KEY --port 8000 --latency lognormal:0.05,0.5 \\
+        --errors SYSTEMERROR=0.01,timeout=0.001
+
+配置了certfile和keyfile时使用https, 再配置client_ca时, 退款、企业付款、
+红包等需要证书的接口会检查客户端证书。
+"""
+
+import argparse
+import gzip
+import itertools
+import math
+import random
+import ssl
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+
+from .compat import urlparse
+from .sign import get_signer
+from .utils import dict_to_xml_bytes, gen_random_str, md5, xml_to_dict
+
+
+#: 需要商户证书的接口
+CERT_PATHS = frozenset([
+    '/secapi/pay/refund',
+    '/mmpaymkttransfers/sendredpack',
+    '/mmpaymkttransfers/gethbinfo',
+    '/mmpaymkttransfers/promotion/transfers',
+    '/mmpaymkttransfers/gettransferinfo',
+    '/billcommentsp/batchquerycomment',
+    '/pay/downloadfundflow',
+])
+
+#: 只支持HMAC-SHA256签名的接口
+HMAC_PATHS = frozenset([
+    '/billcommentsp/batchquerycomment',
+    '/pay/downloadfundflow',
+])
+
+#: 可以注入的错误:
+#:
+#: - SYSTEMERROR: result_code为FAIL, err_code为SYSTEMERROR, 不处理请求
+#: - FAIL: return_code为FAIL
+#: - malformed: 返回不合法的xml
+#: - timeout: 等待timeout_delay秒后断开连接, 不处理请求
+#: - lost: 处理请求后等待timeout_delay秒再断开连接, 用于模拟结果未知的请求
+ERRORS = ('SYSTEMERROR', 'FAIL', 'malformed', 'timeout', 'lost')
+
+BILL_HEADER = (u'交易时间,公众账号ID,商户号,特约商户号,设备号,微信订单号,商户订单号,用户标识,'
+               u'交易类型,交易状态,付款银行,货币种类,应结订单金额,代金券金额,微信退款单号,'
+               u'商户退款单号,退款金额,充值券退款金额,退款类型,退款状态,商品名称,商户数据包,'
+               u'手续费,费率,订单金额,申请退款金额,费率备注')
+
+BILL_SUMMARY_HEADER = u'总交易单数,应结订单总金额,退款总金额,充值券退款总金额,手续费总金额,订单总金额,申请退款总金额'
+
+FUND_FLOW_HEADER = (u'记账时间,微信支付业务单号,资金流水单号,业务名称,业务类型,收支类型,收支金额（元）,'
+                    u'账户结余（元）,资金变更提交申请人,备注,业务凭证号')
+
+FUND_FLOW_SUMMARY_HEADER = u'资金流水总笔数,收入笔数,收入金额,支出笔数,支出金额'
+
+
+def parse_latency(spec):
+    """把延迟配置转换成返回延迟秒数的函数
+
+    :params spec: None, 秒数, 可调用对象, 或者以下格式的字符串:
+
+        - ``fixed:0.05``
+        - ``uniform:0.01,0.1``
+        - ``exp:0.05`` 平均值为0.05的指数分布
+        - ``lognormal:0.05,0.5`` 中位数为0.05, 标准差(对数)为0.5的对数正态分布
+    """
+    if spec is None:
+        return lambda: 0
+    if callable(spec):
+        return spec
+    if isinstance(spec, (int, float)):
+        return lambda: spec
+    name, _, args = spec.partition(':')
+    args = [float(a) for a in args.split(',')] if args else []
+    if name == 'fixed':
+        return lambda: args[0]
+    if name == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if name == 'exp':
+        return lambda: random.expovariate(1.0 / args[0])
+    if name == 'lognormal':
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1])
+    raise ValueError('不支持的延迟分布: {0}'.format(spec))
+
+
+def parse_errors(spec):
+    """解析 ``SYSTEMERROR=0.01,timeout=0.001`` 格式的错误配置, 返回dict"""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        errors = dict(spec)
+    else:
+        errors = {}
+        for item in spec.split(','):
+            name, _, rate = item.partition('=')
+            errors[name.strip()] = float(rate)
+    for name in errors:
+        if name not in ERRORS:
+            raise ValueError('不支持的错误类型: {0}'.format(name))
+    return errors
+
+
+def _yuan(fen):
+    return '{0:.2f}'.format(int(fen) / 100.0)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分开写入, 避免Nagle算法与延迟ACK叠加造成40ms的延迟
+    disable_nagle_algorithm = True
+    mock = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        response = self.mock.handle(self.path, body, self._has_client_cert())
+        if response is None:
+            # 模拟超时, 不返回响应直接断开连接
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain' if response[:5] != b'<xml>' else 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _has_client_cert(self):
+        getpeercert = getattr(self.connection, 'getpeercert', None)
+        return bool(getpeercert and getpeercert())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockWXPayServer(object):
+    """模拟的微信支付服务器
+
+    :params key: 商户支付密钥
+    :params mch_id: 商户号, 配置后检查请求中的商户号
+    :params host: 监听地址
+    :params port: 监听端口, 0为随机端口
+    :params latency: 延迟分布, 见 :func:`parse_latency`, 也可以是path到延迟分布的dict,
+        其中None对应的延迟分布作为默认值
+    :params errors: 错误类型到概率的dict或者 ``SYSTEMERROR=0.01,timeout=0.001`` 格式的字符串,
+        见 :data:`ERRORS`
+    :params timeout_delay: 注入timeout, lost错误时断开连接前等待的秒数
+    :params notify_delay: 统一下单后多少秒模拟支付成功并发送支付通知, None时不自动支付
+    :params bill_rows: 对账单和资金账单中额外生成的随机记录数
+    :params comment_rows: 随机生成的订单评价数, 评价时间为最近10天
+    :params certfile: 服务器证书, 配置后使用https
+    :params keyfile: 服务器证书的私钥
+    :params client_ca: 验证商户证书的CA证书, 配置后需要证书的接口检查客户端证书
+    """
+
+    def __init__(self, key, mch_id=None, host='127.0.0.1', port=0, latency=None, errors=None,
+                 timeout_delay=30, notify_delay=None, bill_rows=0, comment_rows=0,
+                 certfile=None, keyfile=None, client_ca=None):
+        self.key = key
+        self.mch_id = mch_id
+        self.sandbox_signkey = md5('sandbox' + key)
+        if isinstance(latency, dict):
+            self._latency = dict((path, parse_latency(spec)) for path, spec in latency.items())
+        else:
+            self._latency = {None: parse_latency(latency)}
+        self.errors = parse_errors(errors)
+        self.timeout_delay = timeout_delay
+        self.notify_delay = notify_delay
+        self.bill_rows = bill_rows
+        self.require_client_cert = bool(client_ca)
+
+        #: 内存中的数据, 修改时需要持有lock
+        self.orders = {}
+        self.refunds = {}
+        self.transfers = {}
+        self.redpacks = {}
+        self._transaction_ids = {}
+        self.lock = threading.Lock()
+        #: 订单评价, (评价时间, 微信订单号, 星级, 内容), 按时间排序
+        now = time.time()
+        self.comments = sorted(
+            (datetime.fromtimestamp(now - random.uniform(0, 864000)).strftime('%Y-%m-%d %H:%M:%S'),
+             '4200{0:018d}'.format(i), str(random.randint(1, 5)), u'评价{0},很好'.format(i))
+            for i in range(comment_rows))
+        #: 统计: path的请求数, 注入的错误数, 最近发送的通知 (out_trade_no, 通知地址的返回内容或异常)
+        self.requests = Counter()
+        self.injected = Counter()
+        self.notifications = deque(maxlen=1000)
+        self._seq = itertools.count(1)
+
+        handler = type('Handler', (_Handler,), dict(mock=self))
+        self.httpd = _ThreadingHTTPServer((host, port), handler)
+        self.scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            if client_ca:
+                context.load_verify_locations(client_ca)
+                context.verify_mode = ssl.CERT_OPTIONAL
+            # 在处理请求的线程中握手, 不阻塞accept
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True,
+                                                    do_handshake_on_connect=False)
+            self.scheme = 'https'
+        self._thread = None
+
+        self.handlers = {
+            '/pay/unifiedorder': self.unified_order,
+            '/pay/orderquery': self.order_query,
+            '/pay/closeorder': self.close_order,
+            '/secapi/pay/refund': self.refund,
+            '/pay/refundquery': self.refund_query,
+            '/pay/downloadbill': self.download_bill,
+            '/pay/downloadfundflow': self.download_fund_flow,
+            '/billcommentsp/batchquerycomment': self.batch_query_comment,
+            '/mmpaymkttransfers/promotion/transfers': self.transfer,
+            '/mmpaymkttransfers/gettransferinfo': self.transfer_info,
+            '/mmpaymkttransfers/sendredpack': self.send_redpack,
+            '/mmpaymkttransfers/gethbinfo': self.redpack_info,
+            '/pay/getsignkey': self.get_signkey,
+        }
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return '{0}://{1}:{2}'.format(self.scheme, host, port)
+
+    def start(self):
+        """在后台线程中启动服务器"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='flask-wxpay-mock')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # ------------------------------------------------------------
+    # 请求处理
+    # ------------------------------------------------------------
+
+    def handle(self, path, body, has_client_cert=False):
+        """处理一个请求, 返回响应内容, 返回None时断开连接"""
+        path = urlparse(path).path
+        sandbox = path.startswith('/sandboxnew/')
+        if sandbox:
+            path = path[len('/sandboxnew'):]
+        with self.lock:
+            self.requests[path] += 1
+
+        latency = self._latency.get(path) or self._latency.get(None)
+        delay = latency() if latency else 0
+        if delay > 0:
+            time.sleep(delay)
+
+        error = self._pick_error()
+        if error == 'timeout':
+            time.sleep(self.timeout_delay)
+            return None
+        if error == 'malformed':
+            return b'<xml><return_code><![CDATA[SUCC'
+        if error == 'FAIL':
+            return self._fail(u'系统繁忙,请稍后再试')
+
+        handler = self.handlers.get(path)
+        if handler is None:
+            return self._fail(u'接口不存在')
+        try:
+            data = xml_to_dict(body)
+        except Exception:
+            return self._fail(u'XML格式错误')
+
+        sign_type = data.get('sign_type') or 'MD5'
+        key = self.sandbox_signkey if sandbox and path != '/pay/getsignkey' else self.key
+        try:
+            signer = get_signer(sign_type, key)
+        except Exception:
+            return self._fail(u'签名类型错误')
+        if data.get('sign') != signer.sign(data):
+            return self._fail(u'签名错误')
+        mch_id = data.get('mch_id') or data.get('mchid')
+        if self.mch_id and mch_id != self.mch_id:
+            return self._fail(u'mch_id参数错误')
+        if path in CERT_PATHS and self.require_client_cert and not has_client_cert:
+            return self._fail(u'证书错误')
+        if path in HMAC_PATHS and sign_type != 'HMAC-SHA256':
+            return self._fail(u'签名类型错误, 只支持HMAC-SHA256')
+
+        if error == 'SYSTEMERROR':
+            result = self._error('SYSTEMERROR', u'系统错误')
+        else:
+            result = handler(data)
+        if isinstance(result, bytes):
+            return result
+
+        result.setdefault('return_code', 'SUCCESS')
+        result.setdefault('return_msg', 'OK')
+        for name in ('appid', 'mch_id', 'mch_appid', 'mchid', 'wxappid'):
+            if name in data:
+                result.setdefault(name, data[name])
+        result['nonce_str'] = gen_random_str()
+        result['sign'] = signer.sign(result)
+        response = dict_to_xml_bytes(result)
+        if error == 'lost':
+            time.sleep(self.timeout_delay)
+            return None
+        return response
+
+    def _pick_error(self):
+        if not self.errors:
+            return None
+        r = random.random()
+        for name, rate in self.errors.items():
+            if r < rate:
+                with self.lock:
+                    self.injected[name] += 1
+                return name
+            r -= rate
+        return None
+
+    @staticmethod
+    def _fail(return_msg):
+        return dict_to_xml_bytes(return_code='FAIL', return_msg=return_msg)
+
+    @staticmethod
+    def _error(err_code, err_code_des):
+        return dict(result_code='FAIL', err_code=err_code, err_code_des=err_code_des)
+
+    def _next_id(self, prefix):
+        return '{0}{1}{2:010d}'.format(prefix, datetime.now().strftime('%Y%m%d'), next(self._seq))
+
+    # ------------------------------------------------------------
+    # 接口
+    # ------------------------------------------------------------
+
+    def get_signkey(self, data):
+        return dict(sandbox_signkey=self.sandbox_signkey)
+
+    def unified_order(self, data):
+        out_trade_no = data['out_trade_no']
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is None:
+                order = self.orders[out_trade_no] = dict(
+                    out_trade_no=out_trade_no,
+                    total_fee=int(data['total_fee']),
+                    body=data.get('body', ''),
+                    openid=data.get('openid', ''),
+                    trade_type=data.get('trade_type', 'JSAPI'),
+                    notify_url=data.get('notify_url'),
+                    appid=data.get('appid'),
+                    prepay_id='wx' + gen_random_str(30),
+                    trade_state='NOTPAY',
+                    refund_fee=0,
+                )
+                created = True
+            else:
+                created = False
+        if order['trade_state'] in ('SUCCESS', 'REFUND'):
+            return self._error('ORDERPAID', u'商户订单已支付')
+        if order['trade_state'] == 'CLOSED':
+            return self._error('ORDERCLOSED', u'订单已关闭')
+        if created and self.notify_delay is not None:
+            timer = threading.Timer(self.notify_delay, self.pay, (out_trade_no,))
+            timer.daemon = True
+            timer.start()
+        result = dict(result_code='SUCCESS', trade_type=order['trade_type'],
+                      prepay_id=order['prepay_id'])
+        if order['trade_type'] == 'NATIVE':
+            result['code_url'] = 'weixin://wxpay/bizpayurl?pr=' + gen_random_str(7)
+        return result
+
+    def pay(self, out_trade_no, notify=True):
+        """模拟用户支付成功, notify为True时发送支付通知"""
+        with self.lock:
+            order = self.orders[out_trade_no]
+            if order['trade_state'] != 'NOTPAY':
+                return
+            order['trade_state'] = 'SUCCESS'
+            order['time_end'] = datetime.now().strftime('%Y%m%d%H%M%S')
+            order['transaction_id'] = self._next_id('4200')
+            self._transaction_ids[order['transaction_id']] = out_trade_no
+        if notify and order['notify_url']:
+            self.notify(out_trade_no)
+
+    def notify(self, out_trade_no):
+        """向统一下单时的notify_url发送支付通知"""
+        order = self.orders[out_trade_no]
+        data = dict(
+            return_code='SUCCESS',
+            result_code='SUCCESS',
+            appid=order['appid'],
+            mch_id=self.mch_id or '',
+            nonce_str=gen_random_str(),
+            openid=order['openid'],
+            is_subscribe='N',
+            trade_type=order['trade_type'],
+            bank_type='CFT',
+            total_fee=order['total_fee'],
+            cash_fee=order['total_fee'],
+            fee_type='CNY',
+            transaction_id=order['transaction_id'],
+            out_trade_no=out_trade_no,
+            time_end=order['time_end'],
+        )
+        data['sign'] = get_signer('MD5', self.key).sign(data)
+        request = Request(order['notify_url'], data=dict_to_xml_bytes(data),
+                          headers={'Content-Type': 'text/xml'})
+        try:
+            result = urlopen(request, timeout=10).read()
+        except Exception as e:
+            result = e
+        self.notifications.append((out_trade_no, result))
+        return result
+
+    def _order_fields(self, order):
+        fields = dict(
+            out_trade_no=order['out_trade_no'],
+            trade_state=order['trade_state'],
+            total_fee=order['total_fee'],
+            trade_type=order['trade_type'],
+            openid=order['openid'],
+        )
+        if order.get('transaction_id'):
+            fields.update(transaction_id=order['transaction_id'], time_end=order['time_end'],
+                          cash_fee=order['total_fee'], bank_type='CFT', fee_type='CNY')
+        return fields
+
+    def _find_order(self, data):
+        if data.get('out_trade_no'):
+            return self.orders.get(data['out_trade_no'])
+        out_trade_no = self._transaction_ids.get(data.get('transaction_id'))
+        return self.orders.get(out_trade_no)
+
+    def order_query(self, data):
+        order = self._find_order(data)
+        if order is None:
+            return self._error('ORDERNOTEXIST', u'此交易订单号不存在')
+        result = dict(result_code='SUCCESS', trade_state_desc=order['trade_state'])
+        result.update(self._order_fields(order))
+        return result
+
+    def close_order(self, data):
+        with self.lock:
+            order = self.orders.get(data['out_trade_no'])
+            if order is None:
+                return self._error('ORDERNOTEXIST', u'订单不存在')
+            if order['trade_state'] in ('SUCCESS', 'REFUND'):
+                return self._error('ORDERPAID', u'订单已支付，不能发起关单')
+            order['trade_state'] = 'CLOSED'
+        return dict(result_code='SUCCESS')
+
+    def refund(self, data):
+        out_refund_no = data['out_refund_no']
+        refund_fee = int(data['refund_fee'])
+        with self.lock:
+            refund = self.refunds.get(out_refund_no)
+            if refund is None:
+                order = self._find_order(data)
+                if order is None:
+                    return self._error('ORDERNOTEXIST', u'订单不存在')
+                if order['trade_state'] not in ('SUCCESS', 'REFUND'):
+                    return self._error('TRADE_STATE_ERROR', u'订单状态错误')
+                if int(data['total_fee']) != order['total_fee']:
+                    return self._error('INVALID_REQUEST', u'订单金额不一致')
+                if order['refund_fee'] + refund_fee > order['total_fee']:
+                    return self._error('NOTENOUGH', u'订单可退金额不足')
+                order['refund_fee'] += refund_fee
+                order['trade_state'] = 'REFUND'
+                refund = self.refunds[out_refund_no] = dict(
+                    out_refund_no=out_refund_no,
+                    out_trade_no=order['out_trade_no'],
+                    refund_id=self._next_id('5030'),
+                    refund_fee=refund_fee,
+                    refund_status='SUCCESS',
+                    time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                )
+                order.setdefault('refunds', []).append(out_refund_no)
+        order = self.orders[refund['out_trade_no']]
+        return dict(
+            result_code='SUCCESS',
+            transaction_id=order['transaction_id'],
+            out_trade_no=order['out_trade_no'],
+            out_refund_no=out_refund_no,
+            refund_id=refund['refund_id'],
+            refund_fee=refund['refund_fee'],
+            total_fee=order['total_fee'],
+            cash_fee=order['total_fee'],
+        )
+
+    def refund_query(self, data):
+        order = self._find_order(data)
+        if order is None or not order.get('refunds'):
+            return self._error('REFUNDNOTEXIST', u'退款订单查询失败')
+        result = dict(
+            result_code='SUCCESS',
+            out_trade_no=order['out_trade_no'],
+            transaction_id=order['transaction_id'],
+            total_fee=order['total_fee'],
+            cash_fee=order['total_fee'],
+            refund_count=len(order['refunds']),
+        )
+        for i, out_refund_no in enumerate(order['refunds']):
+            refund = self.refunds[out_refund_no]
+            result['out_refund_no_{0}'.format(i)] = out_refund_no
+            result['refund_id_{0}'.format(i)] = refund['refund_id']
+            result['refund_fee_{0}'.format(i)] = refund['refund_fee']
+            result['refund_status_{0}'.format(i)] = refund['refund_status']
+            result['refund_success_time_{0}'.format(i)] = refund['time']
+        return result
+
+    def download_bill(self, data):
+        bill_date = data['bill_date']
+        bill_type = data.get('bill_type', 'ALL')
+        # 与真实账单相同: 支付成功的订单有一行SUCCESS的支付记录, 退款当天再有一行REFUND的退款记录
+        rows = []
+        with self.lock:
+            orders = list(self.orders.values())
+            refunds = list(self.refunds.values())
+        if bill_type in ('ALL', 'SUCCESS'):
+            for order in orders:
+                if order.get('time_end', '').startswith(bill_date):
+                    rows.append(self._bill_row(order))
+            for i in range(self.bill_rows):
+                rows.append(self._bill_row(dict(
+                    out_trade_no='mock{0}{1:08d}'.format(bill_date, i),
+                    transaction_id='4200{0}{1:010d}'.format(bill_date, i),
+                    openid='o' + md5(str(i))[:27],
+                    trade_type='JSAPI', total_fee=random.randint(1, 100000),
+                    time_end=bill_date + '120000', body=u'商品{0}'.format(i),
+                )))
+        if bill_type in ('ALL', 'REFUND'):
+            for refund in refunds:
+                if refund['time'].replace('-', '').startswith(bill_date):
+                    rows.append(self._refund_bill_row(self.orders[refund['out_trade_no']], refund))
+        if not rows:
+            return dict_to_xml_bytes(return_code='FAIL', return_msg='No Bill Exist',
+                                     error_code='20002')
+
+        total_fee = sum(r[1] for r in rows)
+        refund_fee = sum(r[2] for r in rows)
+        lines = [BILL_HEADER]
+        lines.extend(r[0] for r in rows)
+        lines.append(BILL_SUMMARY_HEADER)
+        lines.append(u'`' + u',`'.join([
+            str(len(rows)), _yuan(total_fee), _yuan(refund_fee), '0.00',
+            _yuan(total_fee * 6 // 1000), _yuan(total_fee), _yuan(refund_fee)]))
+        content = (u'\r\n'.join(lines) + u'\r\n').encode('utf-8')
+        if data.get('tar_type') == 'GZIP':
+            content = gzip.compress(content)
+        return content
+
+    def _bill_line(self, trade_time, order, trade_state, total_fee, refund_values, refund_fee):
+        values = [
+            trade_time, order.get('appid') or '', self.mch_id or '', '0', '',
+            order['transaction_id'], order['out_trade_no'], order['openid'],
+            order['trade_type'], trade_state, 'CFT', 'CNY',
+            _yuan(total_fee), '0.00'] + refund_values + [
+            order['body'], '', _yuan(total_fee * 6 // 1000), '0.60%',
+            _yuan(total_fee), _yuan(refund_fee), '',
+        ]
+        return u'`' + u',`'.join(values)
+
+    def _bill_row(self, order):
+        """支付记录, 返回 (行, 应结订单金额, 退款金额)"""
+        time_end = order['time_end']
+        trade_time = u'{0}-{1}-{2} {3}:{4}:{5}'.format(
+            time_end[:4], time_end[4:6], time_end[6:8], time_end[8:10], time_end[10:12],
+            time_end[12:14])
+        line = self._bill_line(trade_time, order, 'SUCCESS', order['total_fee'],
+                               ['0', '0', '0.00', '0.00', '', ''], 0)
+        return line, order['total_fee'], 0
+
+    def _refund_bill_row(self, order, refund):
+        """退款记录, 交易时间为退款时间, 应结订单金额为0"""
+        fee = refund['refund_fee']
+        line = self._bill_line(refund['time'], order, 'REFUND', 0, [
+            refund['refund_id'], refund['out_refund_no'], _yuan(fee), '0.00', 'ORIGINAL',
+            refund['refund_status']], fee)
+        return line, 0, fee
+
+    def download_fund_flow(self, data):
+        bill_date = data['bill_date']
+        rows = []
+        for order in list(self.orders.values()):
+            if order.get('time_end', '').startswith(bill_date):
+                rows.append((order['time_end'], order['transaction_id'], order['total_fee']))
+        for i in range(self.bill_rows):
+            rows.append((bill_date + '120000', '4200{0}{1:010d}'.format(bill_date, i),
+                         random.randint(1, 100000)))
+        if not rows:
+            return dict_to_xml_bytes(return_code='FAIL', return_msg='No Bill Exist',
+                                     error_code='20002')
+
+        lines = [FUND_FLOW_HEADER]
+        balance = 0
+        for i, (time_end, transaction_id, amount) in enumerate(rows):
+            balance += amount
+            lines.append(u'`' + u',`'.join([
+                u'{0}-{1}-{2} {3}:{4}:{5}'.format(time_end[:4], time_end[4:6], time_end[6:8],
+                                                  time_end[8:10], time_end[10:12], time_end[12:14]),
+                transaction_id, '{0}{1:08d}'.format(bill_date, i), u'交易', u'交易', u'收入',
+                _yuan(amount), _yuan(balance), 'system', '', transaction_id,
+            ]))
+        lines.append(FUND_FLOW_SUMMARY_HEADER)
+        lines.append(u'`' + u',`'.join([str(len(rows)), str(len(rows)), _yuan(balance), '0', '0.00']))
+        content = (u'\r\n'.join(lines) + u'\r\n').encode('utf-8')
+        if data.get('tar_type') == 'GZIP':
+            content = gzip.compress(content)
+        return content
+
+    def batch_query_comment(self, data):
+        begin = datetime.strptime(data['begin_time'], '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(data['end_time'], '%Y%m%d%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+        offset = int(data.get('offset') or 0)
+        limit = min(int(data.get('limit') or 200), 200)
+        lines = []
+        next_offset = offset
+        for i in range(offset, len(self.comments)):
+            if len(lines) >= limit:
+                break
+            comment = self.comments[i]
+            next_offset = i + 1
+            if begin <= comment[0] <= end:
+                lines.append(u'`' + u',`'.join(comment))
+        return (u'\r\n'.join([str(next_offset)] + lines) + u'\r\n').encode('utf-8')
+
+    def transfer(self, data):
+        partner_trade_no = data['partner_trade_no']
+        with self.lock:
+            transfer = self.transfers.get(partner_trade_no)
+            if transfer is None:
+                transfer = self.transfers[partner_trade_no] = dict(
+                    partner_trade_no=partner_trade_no,
+                    openid=data['openid'],
+                    amount=int(data['amount']),
+                    desc=data.get('desc', ''),
+                    payment_no=self._next_id('1000'),
+                    payment_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                )
+        return dict(result_code='SUCCESS', partner_trade_no=partner_trade_no,
+                    payment_no=transfer['payment_no'], payment_time=transfer['payment_time'])
+
+    def transfer_info(self, data):
+        transfer = self.transfers.get(data['partner_trade_no'])
+        if transfer is None:
+            return self._error('NOT_FOUND', u'指定单号数据不存在')
+        return dict(
+            result_code='SUCCESS',
+            partner_trade_no=transfer['partner_trade_no'],
+            detail_id=transfer['payment_no'],
+            status='SUCCESS',
+            openid=transfer['openid'],
+            payment_amount=transfer['amount'],
+            transfer_time=transfer['payment_time'],
+            payment_time=transfer['payment_time'],
+            desc=transfer['desc'],
+        )
+
+    def send_redpack(self, data):
+        mch_billno = data['mch_billno']
+        with self.lock:
+            redpack = self.redpacks.get(mch_billno)
+            if redpack is None:
+                redpack = self.redpacks[mch_billno] = dict(
+                    mch_billno=mch_billno,
+                    re_openid=data['re_openid'],
+                    total_amount=int(data['total_amount']),
+                    send_listid=self._next_id('1000041701'),
+                    send_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                )
+        return dict(result_code='SUCCESS', mch_billno=mch_billno,
+                    re_openid=redpack['re_openid'], total_amount=redpack['total_amount'],
+                    send_listid=redpack['send_listid'])
+
+    def redpack_info(self, data):
+        redpack = self.redpacks.get(data['mch_billno'])
+        if redpack is None:
+            return self._error('NOT_FOUND', u'指定单号数据不存在')
+        return dict(
+            result_code='SUCCESS',
+            mch_billno=redpack['mch_billno'],
+            detail_id=redpack['send_listid'],
+            status='SENT',
+            send_type='API',
+            hb_type='NORMAL',
+            total_num=1,
+            total_amount=redpack['total_amount'],
+            send_time=redpack['send_time'],
+            openid=redpack['re_openid'],
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flask_wxpay.mock',
+                                     description=u'本地模拟的微信支付服务器')
+    parser.add_argument('--mch-key', required=True, help=u'商户支付密钥')
+    parser.add_argument('--mch-id', help=u'商户号, 配置后检查请求中的商户号')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', help=u'延迟分布, 例如 lognormal:0.05,0.5')
+    parser.add_argument('--errors', help=u'注入错误的概率, 例如 SYSTEMERROR=0.01,timeout=0.001')
+    parser.add_argument('--timeout-delay', type=float, default=30)
+    parser.add_argument('--notify-delay', type=float, help=u'统一下单后多少秒发送支付通知')
+    parser.add_argument('--bill-rows', type=int, default=0, help=u'对账单中随机生成的记录数')
+    parser.add_argument('--comment-rows', type=int, default=0, help=u'随机生成的订单评价数')
+    parser.add_argument('--certfile', help=u'服务器证书, 配置后使用https')
+    parser.add_argument('--keyfile', help=u'服务器证书的私钥')
+    parser.add_argument('--client-ca', help=u'验证商户证书的CA证书')
+    args = parser.parse_args(argv)
+
+    latency = args.latency
+    if latency and ':' not in latency:
+        latency = float(latency)
+    server = MockWXPayServer(
+        args.mch_key, mch_id=args.mch_id, host=args.host, port=args.port, latency=latency,
+        errors=args.errors, timeout_delay=args.timeout_delay, notify_delay=args.notify_delay,
+        bill_rows=args.bill_rows, comment_rows=args.comment_rows, certfile=args.certfile, keyfile=args.keyfile,
+        client_ca=args.client_ca)
+    print('Serving on {0}'.format(server.url))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.payout
+~~~~~~~~~~~~~~~~~~
+
+批量企业付款和发红包的发件箱: 付款先写入本地SQLite数据库, 再按令牌桶限制的频率发送,
+结果不确定(超时, SYSTEMERROR等)时使用原单号查询确认, 进程重启后从数据库继续::
+
+    outbox = PayoutOutbox(wxpay, 'payouts.db', rate=10)
+    for user in users:
+        outbox.add_transfer('T' + user.id, user.openid, 100, '活动奖励', '10.0.0.1')
+    outbox.run(max_workers=4)
+    print(outbox.stats())
+
+付款状态:
+
+- PENDING: 等待发送
+- SENDING: 已经开始发送, 进程在这个状态退出时重启后转为UNKNOWN
+- UNKNOWN: 结果不确定, 等待查询确认, 查询结果为单号不存在时转为PENDING重新发送
+- SUCCESS: 付款成功
+- FAILED: 付款失败, ``error`` 为失败原因
+
+同一个单号重复发送时微信不会重复付款, 所以结果不确定的付款可以安全地重新发送;
+但同一个数据库同时只能有一个进程执行 :meth:`PayoutOutbox.run`。
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .exceptions import CertError, RateLimited, ResultCodeFail, ReturnCodeFail
+from .ratelimit import TokenBucket
+
+PENDING = 'PENDING'
+SENDING = 'SENDING'
+UNKNOWN = 'UNKNOWN'
+SUCCESS = 'SUCCESS'
+FAILED = 'FAILED'
+STATES = (PENDING, SENDING, UNKNOWN, SUCCESS, FAILED)
+
+#: 结果不确定, 需要查询确认的错误码
+AMBIGUOUS_ERRORS = frozenset(['SYSTEMERROR', 'PROCESSING', 'SEND_FAILED'])
+
+#: 没有付款, 稍后可以重新发送的错误码, return_code为FAIL时同样重新发送
+RETRY_ERRORS = frozenset(['FREQ_LIMIT'])
+
+#: 查询结果的status对应的付款状态, 其他status(处理中)需要稍后再次查询
+TRANSFER_STATUS = {'SUCCESS': SUCCESS, 'FAILED': FAILED}
+REDPACK_STATUS = {
+    'SENT': SUCCESS,
+    'RECEIVED': SUCCESS,
+    'RFUND_ING': SUCCESS,
+    'REFUND': SUCCESS,
+    'FAILED': FAILED,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payouts (
+    trade_no TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    checks INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payouts_due ON payouts (next_attempt_at)
+    WHERE state IN ('PENDING', 'UNKNOWN');
+"""
+
+
+class PayoutOutbox(object):
+    """企业付款和发红包的发件箱
+
+    :params wxpay: 同步的 :class:`~flask_wxpay.WXPay` 实例, 需要配置商户证书
+    :params path: SQLite数据库文件路径
+    :params rate: 每秒最多调用的接口次数, 包括查询
+    :params burst: 允许的突发调用次数
+    :params retry_interval: 第一次重试或查询的间隔(秒), 之后每次翻倍
+    :params max_retry_interval: 最大的重试间隔(秒)
+    :params max_attempts: FREQ_LIMIT等错误时最多发送的次数, 超过后标记为FAILED
+    """
+
+    def __init__(self, wxpay, path, rate=10, burst=1, retry_interval=1.0,
+                 max_retry_interval=60.0, max_attempts=10):
+        self.wxpay = wxpay
+        self.path = path
+        self.bucket = TokenBucket(rate, burst)
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # 开始发送前的状态必须落盘, 否则崩溃后无法知道哪些付款可能已经发出
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.executescript(SCHEMA)
+        self._recover()
+
+    def _recover(self):
+        """上次退出时正在发送的付款结果不确定, 转为UNKNOWN等待查询"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE payouts SET state=?, next_attempt_at=0, updated_at=? WHERE state=?',
+                (UNKNOWN, time.time(), SENDING))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_transfer(self, partner_trade_no, openid, amount, desc, ip,
+                     check_name='NO_CHECK', re_user_name=None):
+        """添加企业付款, 参数同 :meth:`~flask_wxpay.WXPay.transfers`
+
+        :return: 单号已存在时返回False
+        """
+        params = dict(partner_trade_no=partner_trade_no, openid=openid, amount=amount,
+                      desc=desc, ip=ip, check_name=check_name, re_user_name=re_user_name)
+        return self._add('transfers', partner_trade_no, amount, params)
+
+    def add_redpack(self, mch_billno, send_name, re_openid, total_amount,
+                    wishing, client_ip, act_name, remark):
+        """添加红包, 参数同 :meth:`~flask_wxpay.WXPay.send_redpack`
+
+        :return: 单号已存在时返回False
+        """
+        params = dict(mch_billno=mch_billno, send_name=send_name, re_openid=re_openid,
+                      total_amount=total_amount, wishing=wishing, client_ip=client_ip,
+                      act_name=act_name, remark=remark)
+        return self._add('redpack', mch_billno, total_amount, params)
+
+    def _add(self, kind, trade_no, amount, params):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO payouts (trade_no, kind, params, amount, state, '
+                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (trade_no, kind, json.dumps(params), amount, PENDING, now, now))
+        return cursor.rowcount == 1
+
+    def get(self, trade_no):
+        """返回付款记录的dict, 不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM payouts WHERE trade_no=?', (trade_no,)).fetchone()
+        return _to_dict(row) if row is not None else None
+
+    def iter_payouts(self, state=None):
+        """按添加顺序产生付款记录, state不为None时只返回该状态的记录"""
+        sql = 'SELECT * FROM payouts'
+        args = ()
+        if state is not None:
+            sql += ' WHERE state=?'
+            args = (state,)
+        with self._lock:
+            rows = self._conn.execute(sql + ' ORDER BY rowid', args).fetchall()
+        for row in rows:
+            yield _to_dict(row)
+
+    def stats(self):
+        """各状态的付款数量和金额(分), 例如 ``{'SUCCESS': {'count': 2, 'amount': 200}, ...}``"""
+        result = dict((state, dict(count=0, amount=0)) for state in STATES)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*), COALESCE(SUM(amount), 0) FROM payouts GROUP BY state'
+            ).fetchall()
+        for state, count, amount in rows:
+            result[state] = dict(count=count, amount=amount)
+        return result
+
+    def run(self, max_workers=4, stop=None, poll_interval=1.0):
+        """发送和确认付款, 直到所有付款都为SUCCESS或FAILED, 或者stop被设置
+
+        :params max_workers: 同时进行的请求数
+        :params stop: threading.Event, 可以在其他线程中设置以停止发送
+        :params poll_interval: 等待重试时检查stop的间隔(秒)
+        :return: :meth:`stats`
+        """
+        stop = stop or threading.Event()
+        in_flight = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while not stop.is_set():
+                if len(in_flight) >= max_workers:
+                    wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in [f for f in in_flight if f.done()]:
+                    del in_flight[future]
+                    future.result()
+                row = self._next_due(in_flight.values())
+                if row is None:
+                    if in_flight:
+                        wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                        continue
+                    delay = self._next_delay()
+                    if delay is None:
+                        break
+                    stop.wait(min(delay, poll_interval))
+                    continue
+                delay = self.bucket.reserve()
+                if delay and stop.wait(delay):
+                    break
+                in_flight[executor.submit(self._process, row)] = row['trade_no']
+            for future in in_flight:
+                future.result()
+        finally:
+            executor.shutdown(wait=True)
+        return self.stats()
+
+    def _next_due(self, exclude):
+        exclude = set(exclude)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM payouts WHERE state IN ('PENDING', 'UNKNOWN') "
+                'AND next_attempt_at <= ? ORDER BY next_attempt_at, rowid LIMIT ?',
+                (time.time(), len(exclude) + 1)).fetchall()
+        for row in rows:
+            if row['trade_no'] not in exclude:
+                return row
+        return None
+
+    def _next_delay(self):
+        """距离下一个需要重试的付款的秒数, 没有未完成的付款时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM payouts WHERE state IN ('PENDING', 'UNKNOWN')"
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0, row[0] - time.time())
+
+    def _update(self, trade_no, **values):
+        values['updated_at'] = time.time()
+        columns = ', '.join('{0}=?'.format(name) for name in values)
+        with self._lock:
+            self._conn.execute('UPDATE payouts SET {0} WHERE trade_no=?'.format(columns),
+                               tuple(values.values()) + (trade_no,))
+
+    def _backoff(self, n):
+        return time.time() + min(self.retry_interval * 2 ** max(n - 1, 0),
+                                 self.max_retry_interval)
+
+    def _process(self, row):
+        if row['state'] == PENDING:
+            self._send(row)
+        else:
+            self._confirm(row)
+
+    def _send(self, row):
+        trade_no = row['trade_no']
+        params = json.loads(row['params'])
+        attempts = row['attempts'] + 1
+        self._update(trade_no, state=SENDING, attempts=attempts)
+        try:
+            if row['kind'] == 'transfers':
+                result = self.wxpay.transfers(**params)
+            else:
+                result = self.wxpay.send_redpack(**params)
+        except ResultCodeFail as e:
+            error = '{0}: {1}'.format(e.err_code, e.err_code_des)
+            if e.err_code in AMBIGUOUS_ERRORS:
+                self._update(trade_no, state=UNKNOWN, error=error, checks=0,
+                             next_attempt_at=self._backoff(1))
+            elif e.err_code in RETRY_ERRORS:
+                self._retry(trade_no, attempts, error)
+            else:
+                self._update(trade_no, state=FAILED, error=error)
+        except ReturnCodeFail as e:
+            # return_code为FAIL时请求没有被处理
+            self._retry(trade_no, attempts, 'FAIL: {0}'.format(e.return_msg))
+        except RateLimited as e:
+            # 本地限流时请求没有发送, 不计入发送次数
+            self._update(trade_no, state=PENDING, attempts=attempts - 1,
+                         next_attempt_at=time.time() + e.retry_after)
+        except CertError:
+            self._update(trade_no, state=PENDING)
+            raise
+        except Exception as e:
+            # 超时等网络错误时请求可能已经被处理
+            self._update(trade_no, state=UNKNOWN, error=repr(e), checks=0,
+                         next_attempt_at=self._backoff(1))
+        else:
+            self._update(trade_no, state=SUCCESS, error=None, result=json.dumps(dict(result)))
+
+    def _retry(self, trade_no, attempts, error):
+        if attempts < self.max_attempts:
+            self._update(trade_no, state=PENDING, error=error,
+                         next_attempt_at=self._backoff(attempts))
+        else:
+            self._update(trade_no, state=FAILED, error=error)
+
+    def _confirm(self, row):
+        """查询结果不确定的付款"""
+        trade_no = row['trade_no']
+        checks = row['checks'] + 1
+        try:
+            if row['kind'] == 'transfers':
+                info = self.wxpay.get_transfers_info(trade_no)
+                state = TRANSFER_STATUS.get(info.get('status'))
+            else:
+                info = self.wxpay.get_redpack_info(trade_no)
+                state = REDPACK_STATUS.get(info.get('status'))
+        except ResultCodeFail as e:
+            if e.err_code == 'NOT_FOUND':
+                # 请求没有到达微信, 使用原单号重新发送
+                self._update(trade_no, state=PENDING, checks=checks, next_attempt_at=0)
+                return
+            self._update(trade_no, checks=checks, next_attempt_at=self._backoff(checks))
+            return
+        except CertError:
+            raise
+        except Exception:
+            self._update(trade_no, checks=checks, next_attempt_at=self._backoff(checks))
+            return
+        if state is None:
+            self._update(trade_no, checks=checks, next_attempt_at=self._backoff(checks))
+        elif state == SUCCESS:
+            self._update(trade_no, state=SUCCESS, checks=checks, error=None,
+                         result=json.dumps(dict(info)))
+        else:
+            self._update(trade_no, state=FAILED, checks=checks, result=json.dumps(dict(info)),
+                         error=info.get('reason') or info.get('err_code_des') or info.get('status'))
+
+
+def _to_dict(row):
+    data = dict(row)
+    data['params'] = json.loads(data['params'])
+    if data['result'] is not None:
+        data['result'] = json.loads(data['result'])
+    return data
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.poll
+~~~~~~~~~~~~~~~~
+
+等待订单支付结果: 同一个订单的多个等待者共用一个查询循环, 查询间隔逐渐增加,
+订单进入终态或者收到支付通知后立即把结果交给所有等待者。
+"""
+
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from .exceptions import ResultCodeFail, ReturnCodeFail
+
+#: 不会再变化的交易状态
+TERMINAL_TRADE_STATES = frozenset(['SUCCESS', 'REFUND', 'CLOSED', 'REVOKED', 'PAYERROR'])
+
+
+class _Flight(object):
+    """一个订单的查询循环"""
+
+    def __init__(self, future, deadline, wakeup):
+        self.future = future
+        #: 所有等待者中最晚的截止时间, 之后查询循环结束
+        self.deadline = deadline
+        self.wakeup = wakeup
+        #: 最近一次查询的结果
+        self.last = None
+
+
+class BasePaymentWaiter(object):
+    """查询间隔和错误处理, 同步和异步版本共用
+
+    :params query: 查询订单的函数, 参数为out_trade_no
+    :params initial_interval: 第一次查询后的等待时间, 用户支付中(USERPAYING)时恢复为该间隔
+    :params max_interval: 最大的查询间隔
+    :params factor: 每次查询后间隔乘以该系数
+    """
+
+    def __init__(self, query, initial_interval=1.0, max_interval=5.0, factor=1.5):
+        self.query = query
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _next_interval(self, interval, result):
+        if result is not None and result.get('trade_state') == 'USERPAYING':
+            return self.initial_interval
+        return min(interval * self.factor, self.max_interval)
+
+    def _sleep_time(self, interval, flight):
+        # 加上抖动, 避免同时下单的订单同时查询
+        return max(0, min(interval * random.uniform(0.8, 1.2), flight.deadline - time.time()))
+
+    @staticmethod
+    def _is_fatal(error):
+        """重试也不会成功的错误, 例如订单不存在"""
+        if isinstance(error, ResultCodeFail):
+            return error.err_code != 'SYSTEMERROR'
+        return isinstance(error, ReturnCodeFail)
+
+    def _finish(self, out_trade_no, flight, force=False):
+        """结束查询循环, 返回是否已结束
+
+        查询循环决定退出后, 移除flight之前可能有新的等待者加入并延长了deadline,
+        这时在_lock下发现deadline还没到, 返回False让查询循环继续;
+        wait也在_lock下延长deadline, 因此之后加入的等待者会创建新的查询循环
+        """
+        with self._lock:
+            if not force and not flight.future.done() and flight.deadline > time.time():
+                return False
+            if self._flights.get(out_trade_no) is flight:
+                del self._flights[out_trade_no]
+            return True
+
+
+class PaymentWaiter(BasePaymentWaiter):
+    """同步版本, 每个订单的查询循环在一个后台线程中执行"""
+
+    def wait(self, out_trade_no, timeout):
+        """等待订单进入终态, 返回查询结果
+
+        超时时返回最近一次查询的结果, 还没有查询结果时返回None
+
+        :raises WXPayError: 订单不存在等无法通过重试解决的错误
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            flight = self._flights.get(out_trade_no)
+            if flight is None:
+                flight = self._flights[out_trade_no] = _Flight(
+                    Future(), deadline, threading.Event())
+                thread = threading.Thread(target=self._poll, args=(out_trade_no, flight),
+                                          name='flask-wxpay-poll')
+                thread.daemon = True
+                thread.start()
+            else:
+                flight.deadline = max(flight.deadline, deadline)
+        try:
+            return flight.future.result(timeout)
+        except TimeoutError:
+            return flight.last
+
+    def resolve(self, out_trade_no, result):
+        """收到支付通知等途径得知订单结果时调用, 立即唤醒等待者"""
+        with self._lock:
+            flight = self._flights.get(out_trade_no)
+            if flight is None:
+                return
+            flight.last = result
+            if not flight.future.done():
+                flight.future.set_result(result)
+        flight.wakeup.set()
+
+    def _poll(self, out_trade_no, flight):
+        interval = self.initial_interval
+        try:
+            while not flight.future.done():
+                try:
+                    result = self.query(out_trade_no)
+                except Exception as e:
+                    if self._is_fatal(e):
+                        with self._lock:
+                            if not flight.future.done():
+                                flight.future.set_exception(e)
+                        return
+                    result = None
+                else:
+                    if result.get('trade_state') in TERMINAL_TRADE_STATES:
+                        self.resolve(out_trade_no, result)
+                        return
+                    flight.last = result
+                sleep_time = self._sleep_time(interval, flight)
+                while sleep_time <= 0:
+                    if self._finish(out_trade_no, flight):
+                        return
+                    sleep_time = self._sleep_time(interval, flight)
+                flight.wakeup.wait(sleep_time)
+                interval = self._next_interval(interval, result)
+        finally:
+            self._finish(out_trade_no, flight, force=True)
+
+
+class AsyncPaymentWaiter(BasePaymentWaiter):
+    """asyncio版本, query为协程函数, 查询循环是一个task"""
+
+    async def wait(self, out_trade_no, timeout):
+        """:meth:`PaymentWaiter.wait` 的asyncio版本"""
+        loop = asyncio.get_event_loop()
+        deadline = time.time() + timeout
+        with self._lock:
+            flight = self._flights.get(out_trade_no)
+            if flight is None or flight.future.get_loop() is not loop:
+                flight = self._flights[out_trade_no] = _Flight(
+                    loop.create_future(), deadline, asyncio.Event())
+                loop.create_task(self._poll(out_trade_no, flight))
+            else:
+                flight.deadline = max(flight.deadline, deadline)
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.future), timeout)
+        except asyncio.TimeoutError:
+            return flight.last
+
+    def resolve(self, out_trade_no, result):
+        """可以在其他线程中调用, 例如同步的通知处理函数"""
+        with self._lock:
+            flight = self._flights.get(out_trade_no)
+        if flight is not None:
+            flight.future.get_loop().call_soon_threadsafe(self._resolve, flight, result)
+
+    @staticmethod
+    def _resolve(flight, result):
+        flight.last = result
+        if not flight.future.done():
+            flight.future.set_result(result)
+        flight.wakeup.set()
+
+    async def _poll(self, out_trade_no, flight):
+        interval = self.initial_interval
+        try:
+            while not flight.future.done():
+                try:
+                    result = await self.query(out_trade_no)
+                except Exception as e:
+                    if self._is_fatal(e):
+                        if not flight.future.done():
+                            flight.future.set_exception(e)
+                        return
+                    result = None
+                else:
+                    if result.get('trade_state') in TERMINAL_TRADE_STATES:
+                        self._resolve(flight, result)
+                        return
+                    flight.last = result
+                sleep_time = self._sleep_time(interval, flight)
+                while sleep_time <= 0:
+                    if self._finish(out_trade_no, flight):
+                        return
+                    sleep_time = self._sleep_time(interval, flight)
+                try:
+                    await asyncio.wait_for(flight.wakeup.wait(), sleep_time)
+                except asyncio.TimeoutError:
+                    pass
+                interval = self._next_interval(interval, result)
+        finally:
+            self._finish(out_trade_no, flight, force=True)
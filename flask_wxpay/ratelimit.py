@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.ratelimit
+~~~~~~~~~~~~~~~~~~~~~
+
+令牌桶限流, 控制调用接口的频率, 避免触发微信的FREQ_LIMIT。
+
+:class:`RateLimiter` 按接口path限流, 状态保存在可替换的后端中:
+
+- :class:`FileBackend`: mmap映射的文件, 同一台机器上的多个进程(例如gunicorn的worker)共享
+- :class:`LocalBackend`: 进程内
+- :class:`RedisBackend`: 多台机器共享, 需要redis-py的客户端
+
+后端使用 `GCRA <https://en.wikipedia.org/wiki/Generic_cell_rate_algorithm>`_ 实现令牌桶,
+每个key只需要保存一个时间戳, 实现其他共享存储时只需要实现 :meth:`BaseBackend.reserve`。
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .exceptions import RateLimited
+from .utils import md5
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class TokenBucket(object):
+    """线程安全的令牌桶, 每秒补充rate个令牌, 最多积攒capacity个
+
+    :params rate: 每秒补充的令牌数
+    :params capacity: 桶的容量, 即允许的突发请求数, 默认为1(严格匀速)
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError('rate必须大于0')
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """预订令牌, 返回需要等待的秒数, 令牌不足时预支之后补充的令牌"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        """获取令牌, 令牌不足时阻塞, 返回等待的秒数"""
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+def gcra(tat, now, interval, burst, max_wait):
+    """计算一次请求需要等待的时间
+
+    :params tat: 上次保存的理论到达时间, 没有时为0
+    :params interval: 两次请求的最小间隔, 即1/rate
+    :params burst: 允许的突发请求数
+    :params max_wait: 最长等待时间, None为不限制
+    :return: ``(需要等待的秒数, 新的理论到达时间)``, 等待时间超过max_wait时新的理论到达时间为None
+    """
+    tat = max(tat, now)
+    wait = max(0.0, tat - now - (burst - 1) * interval)
+    if max_wait is not None and wait > max_wait:
+        return wait, None
+    return wait, tat + interval
+
+
+class BaseBackend(object):
+    """限流状态的存储"""
+
+    def reserve(self, key, interval, burst, max_wait=None):
+        """预订一次请求
+
+        :return: ``(是否预订成功, 需要等待的秒数)``, 等待时间超过max_wait时不预订
+        """
+        raise NotImplementedError
+
+
+class LocalBackend(BaseBackend):
+    """进程内的限流状态"""
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, interval, burst, max_wait=None):
+        with self._lock:
+            wait, tat = gcra(self._tats.get(key, 0.0), time.time(), interval, burst, max_wait)
+            if tat is None:
+                return False, wait
+            self._tats[key] = tat
+        return True, wait
+
+
+class FileBackend(BaseBackend):
+    """保存在mmap映射的文件中的限流状态, 同一台机器上的多个进程共享
+
+    每个key占用一个16字节的槽位: key的哈希和理论到达时间, 使用flock在进程间加锁。
+    文件按进程打开: flock锁的是打开的文件描述, fork出的子进程(例如gunicorn ``--preload``
+    的worker)共用继承来的文件描述时互相不排斥, 所以第一次使用时和fork后重新打开文件
+
+    :params path: 文件路径, 不存在时创建
+    :params slots: 槽位数, 即最多的key数量
+    """
+
+    _slot = struct.Struct('<Qd')
+
+    def __init__(self, path, slots=1024):
+        if fcntl is None:
+            raise RuntimeError('FileBackend需要fcntl, 当前平台请使用LocalBackend')
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700, exist_ok=True)
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._mmap = None
+        self._pid = None
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """打开当前进程的文件和mmap, 需要持有_lock"""
+        if self._fd is not None:
+            # 从父进程继承的副本, 关闭它不会释放父进程的锁和映射
+            self._mmap.close()
+            os.close(self._fd)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.slots * self._slot.size
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            # 其他进程可能用更大的slots创建了文件, 使用实际的大小保证槽位位置一致
+            size = os.fstat(fd).st_size
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.slots = size // self._slot.size
+        self._mmap = mmap.mmap(fd, self.slots * self._slot.size)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    def _hash(self, key):
+        h = self._hashes.get(key)
+        if h is None:
+            # 0表示空槽位
+            h = self._hashes[key] = int(md5(key)[:16], 16) | 1
+        return h
+
+    def _find(self, h):
+        """线性探测key所在的槽位, 返回 ``(偏移, 理论到达时间)``"""
+        size = self._slot.size
+        start = h % self.slots
+        for i in range(self.slots):
+            offset = (start + i) % self.slots * size
+            slot_hash, tat = self._slot.unpack_from(self._mmap, offset)
+            if slot_hash == h or slot_hash == 0:
+                return offset, tat
+        raise RuntimeError('限流文件{0}的槽位已用完'.format(self.path))
+
+    def reserve(self, key, interval, burst, max_wait=None):
+        h = self._hash(key)
+        # flock只在进程间互斥, 同一进程的线程使用线程锁
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, tat = self._find(h)
+                wait, tat = gcra(tat, time.time(), interval, burst, max_wait)
+                if tat is None:
+                    return False, wait
+                self._slot.pack_into(self._mmap, offset, h, tat)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return True, wait
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._mmap.close()
+                os.close(self._fd)
+            self._fd = self._mmap = self._pid = None
+
+
+_REDIS_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then tat = now end
+local wait = tat - now - (burst - 1) * interval
+if wait < 0 then wait = 0 end
+if max_wait >= 0 and wait > max_wait then
+    return {0, tostring(wait)}
+end
+tat = tat + interval
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return {1, tostring(wait)}
+"""
+
+
+class RedisBackend(BaseBackend):
+    """保存在Redis中的限流状态, 多台机器共享, 使用Redis服务器的时间
+
+    :params client: redis-py的 ``Redis`` 客户端
+    :params prefix: key前缀
+    """
+
+    def __init__(self, client, prefix='flask_wxpay:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(_REDIS_SCRIPT)
+
+    def reserve(self, key, interval, burst, max_wait=None):
+        allowed, wait = self._script(
+            keys=[self.prefix + key],
+            args=[repr(interval), burst, -1 if max_wait is None else repr(float(max_wait))])
+        return bool(int(allowed)), float(wait)
+
+
+class RateLimiter(object):
+    """按接口path限流
+
+    :params limits: path到每秒请求数的dict, 值也可以是 ``(每秒请求数, 突发请求数)``
+    :params backend: :class:`BaseBackend`, 默认为 :class:`LocalBackend`
+    :params timeout: 最长等待时间(秒), 需要等待更久时抛出 :class:`~flask_wxpay.exceptions.RateLimited`;
+        0为不等待, None为不限制
+    :params prefix: key前缀, 多个商户共享后端时用于区分
+    """
+
+    def __init__(self, limits, backend=None, timeout=1.0, prefix=''):
+        self.backend = backend if backend is not None else LocalBackend()
+        self.timeout = timeout
+        self.limits = {}
+        for path, limit in limits.items():
+            rate, burst = limit if isinstance(limit, (tuple, list)) else (limit, 1)
+            self.limits[path] = (prefix + path, 1.0 / rate, burst)
+
+    def reserve(self, path):
+        """预订一次请求, 返回需要等待的秒数, 没有限制的path返回None
+
+        :raises RateLimited: 需要等待的时间超过timeout
+        """
+        limit = self.limits.get(path)
+        if limit is None:
+            return None
+        key, interval, burst = limit
+        allowed, wait = self.backend.reserve(key, interval, burst, self.timeout)
+        if not allowed:
+            raise RateLimited(path, wait)
+        return wait
+
+    def acquire(self, path):
+        """:meth:`reserve` 并等待, 返回等待的秒数"""
+        wait = self.reserve(path)
+        if wait:
+            time.sleep(wait)
+        return wait
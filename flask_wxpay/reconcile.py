@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.reconcile
+~~~~~~~~~~~~~~~~~~~~~
+
+多日对账: 并行下载一段日期的对账单, 解析成按列存储的紧凑结构(金额为以分为单位的整数数组,
+订单号使用sys.intern), 按out_trade_no或transaction_id建立索引, 与本地订单一次遍历得到差异::
+
+    reconciler = Reconciler(wxpay)
+    bills = reconciler.load('20240501', '20240531')
+    result = bills.diff((o.out_trade_no, o.total_fee) for o in Order.query_paid(...))
+    for out_trade_no, amount in result.missing:
+        ...
+
+只有交易状态不为REFUND的行作为支付记录参与对账, 退款行计入每日的退款金额。
+"""
+
+import sys
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from .batch import imap_unordered
+from .exceptions import WXPayError
+
+#: 账单中的金额与本地金额不一致, 金额单位为分
+Mismatch = namedtuple('Mismatch', 'order_id local_amount bill_amount bill_date')
+
+#: 账单中有, 本地没有的支付记录
+Extra = namedtuple('Extra', 'out_trade_no transaction_id amount bill_date')
+
+#: 每日汇总, 金额单位为分
+DayTotal = namedtuple('DayTotal', 'bill_date count total_fee refund_count refund_fee')
+
+#: 当天没有交易时微信返回的错误信息
+NO_BILL_MSG = 'No Bill Exist'
+
+
+def yuan_to_fen(value):
+    """'12.34' -> 1234, 不经过浮点数避免精度问题"""
+    if not value:
+        return 0
+    negative = value.startswith('-')
+    if negative:
+        value = value[1:]
+    yuan, _, fen = value.partition('.')
+    result = int(yuan or 0) * 100 + int((fen + '00')[:2])
+    return -result if negative else result
+
+
+def date_range(start, end):
+    """start到end(包含)之间的日期, 参数和返回值为 ``YYYYMMDD`` 格式的字符串或者date"""
+    if not isinstance(start, str):
+        start = start.strftime('%Y%m%d')
+    if not isinstance(end, str):
+        end = end.strftime('%Y%m%d')
+    day = datetime.strptime(start, '%Y%m%d')
+    last = datetime.strptime(end, '%Y%m%d')
+    dates = []
+    while day <= last:
+        dates.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+class DayBill(object):
+    """一天的对账单, 按列存储"""
+
+    __slots__ = ('bill_date', 'out_trade_no', 'transaction_id', 'total_fee',
+                 'refund_out_trade_no', 'refund_fee')
+
+    def __init__(self, bill_date):
+        self.bill_date = bill_date
+        #: 支付记录
+        self.out_trade_no = []
+        self.transaction_id = []
+        self.total_fee = array('q')
+        #: 退款记录
+        self.refund_out_trade_no = []
+        self.refund_fee = array('q')
+
+    @classmethod
+    def from_rows(cls, bill_date, rows):
+        day = cls(bill_date)
+        intern = sys.intern
+        for row in rows:
+            if row.trade_state == 'REFUND':
+                day.refund_out_trade_no.append(intern(row.out_trade_no))
+                fee = getattr(row, 'refund_fee', None) or row.settlement_refund_fee
+                day.refund_fee.append(yuan_to_fen(fee))
+            else:
+                day.out_trade_no.append(intern(row.out_trade_no))
+                day.transaction_id.append(intern(row.transaction_id))
+                day.total_fee.append(yuan_to_fen(row.total_fee))
+        return day
+
+
+class Bills(object):
+    """多日的对账单, 按日期顺序把每天的列拼接在一起
+
+    :params days: :class:`DayBill` 列表
+    :params errors: 下载失败的日期到异常的dict
+    """
+
+    def __init__(self, days, errors=None):
+        self.errors = errors or {}
+        self.dates = []
+        self.out_trade_no = []
+        self.transaction_id = []
+        self.total_fee = array('q')
+        self.refund_out_trade_no = []
+        self.refund_fee = array('q')
+        #: 每天的支付记录和退款记录在列中的起始位置, 最后一项为总数
+        self.offsets = [0]
+        self.refund_offsets = [0]
+        for day in sorted(days, key=lambda day: day.bill_date):
+            self.dates.append(day.bill_date)
+            self.out_trade_no.extend(day.out_trade_no)
+            self.transaction_id.extend(day.transaction_id)
+            self.total_fee.extend(day.total_fee)
+            self.refund_out_trade_no.extend(day.refund_out_trade_no)
+            self.refund_fee.extend(day.refund_fee)
+            self.offsets.append(len(self.total_fee))
+            self.refund_offsets.append(len(self.refund_fee))
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.total_fee)
+
+    def index(self, key='out_trade_no'):
+        """订单号到行号的dict, key为out_trade_no或transaction_id"""
+        index = self._indexes.get(key)
+        if index is None:
+            column = getattr(self, key)
+            index = self._indexes[key] = dict(zip(column, range(len(column))))
+        return index
+
+    def bill_date(self, i):
+        """第i行支付记录的日期"""
+        return self.dates[bisect_right(self.offsets, i) - 1]
+
+    def daily_totals(self):
+        """每日的支付笔数, 金额, 退款笔数, 退款金额, 返回 :class:`DayTotal` 列表"""
+        totals = []
+        for n, bill_date in enumerate(self.dates):
+            start, end = self.offsets[n], self.offsets[n + 1]
+            refund_start, refund_end = self.refund_offsets[n], self.refund_offsets[n + 1]
+            totals.append(DayTotal(
+                bill_date, end - start, sum(self.total_fee[start:end]),
+                refund_end - refund_start, sum(self.refund_fee[refund_start:refund_end])))
+        return totals
+
+    def diff(self, local_orders, key='out_trade_no'):
+        """与本地订单对账
+
+        :params local_orders: 产生 ``(订单号, 金额)`` 的可迭代对象, 金额单位为分
+        :params key: 本地订单号对应账单的out_trade_no或transaction_id
+        :rtype: :class:`ReconcileResult`
+        """
+        index = self.index(key)
+        total_fee = self.total_fee
+        matched = bytearray(len(total_fee))
+        missing = []
+        mismatched = []
+        for order_id, amount in local_orders:
+            i = index.get(order_id)
+            if i is None:
+                missing.append((order_id, amount))
+                continue
+            matched[i] = 1
+            if total_fee[i] != amount:
+                mismatched.append(Mismatch(order_id, amount, total_fee[i], None))
+        # 不一致的记录通常很少, 最后再查找日期
+        mismatched = [m._replace(bill_date=self.bill_date(index[m.order_id])) for m in mismatched]
+
+        extra = []
+        for n, bill_date in enumerate(self.dates):
+            end = self.offsets[n + 1]
+            i = matched.find(0, self.offsets[n], end)
+            while i != -1:
+                extra.append(Extra(self.out_trade_no[i], self.transaction_id[i],
+                                   total_fee[i], bill_date))
+                i = matched.find(0, i + 1, end)
+        return ReconcileResult(missing, extra, mismatched, self.daily_totals(), self.errors)
+
+
+class ReconcileResult(object):
+    """对账结果
+
+    - missing: 本地有, 账单中没有的 ``(订单号, 金额)`` 列表
+    - extra: 账单中有, 本地没有的 :class:`Extra` 列表
+    - mismatched: 金额不一致的 :class:`Mismatch` 列表
+    - daily_totals: 账单的每日汇总, :class:`DayTotal` 列表
+    - errors: 下载失败的日期到异常的dict, 这些日期的本地订单会出现在missing中
+    """
+
+    def __init__(self, missing, extra, mismatched, daily_totals, errors):
+        self.missing = missing
+        self.extra = extra
+        self.mismatched = mismatched
+        self.daily_totals = daily_totals
+        self.errors = errors
+
+    @property
+    def ok(self):
+        """没有差异, 所有日期都下载成功"""
+        return not (self.missing or self.extra or self.mismatched or self.errors)
+
+
+class Reconciler(object):
+    """并行下载多日的对账单
+
+    :params wxpay: 同步的 :class:`~flask_wxpay.WXPay` 实例
+    :params max_workers: 同时下载的账单数
+    :params bill_type: ALL, SUCCESS, REFUND
+    :params tar_type: 默认下载GZIP压缩的账单
+    :params store: :class:`~flask_wxpay.billstore.BillStore`, 默认为 ``wxpay.bill_store``,
+        不为None时已下载的账单从本地读取
+    """
+
+    def __init__(self, wxpay, max_workers=8, bill_type='ALL', tar_type='GZIP', store=None):
+        self.wxpay = wxpay
+        self.max_workers = max_workers
+        self.bill_type = bill_type
+        self.tar_type = tar_type
+        self.store = store if store is not None else getattr(wxpay, 'bill_store', None)
+
+    def load_day(self, bill_date):
+        """下载并解析一天的对账单, 没有交易的日期返回空的 :class:`DayBill`"""
+        source = self.store if self.store is not None else self.wxpay
+        try:
+            return DayBill.from_rows(
+                bill_date, source.iter_bill(bill_date, self.bill_type, self.tar_type))
+        except WXPayError as e:
+            if NO_BILL_MSG in str(e):
+                return DayBill(bill_date)
+            raise
+
+    def load(self, start, end):
+        """下载start到end(包含)的对账单
+
+        :params start: 开始日期, ``YYYYMMDD`` 格式的字符串或者date
+        :params end: 结束日期
+        :rtype: :class:`Bills`
+        """
+        days = []
+        errors = {}
+        for bill_date, result in imap_unordered(self.load_day, date_range(start, end),
+                                                self.max_workers):
+            if isinstance(result, Exception):
+                errors[bill_date] = result
+            else:
+                days.append(result)
+        return Bills(days, errors)
+
+    def reconcile(self, local_orders, start, end, key='out_trade_no'):
+        """下载对账单并与本地订单对账, 参数见 :meth:`load` 和 :meth:`Bills.diff`
+
+        :rtype: :class:`ReconcileResult`
+        """
+        return self.load(start, end).diff(local_orders, key)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.results
+~~~~~~~~~~~~~~~~~~~
+
+按接口区分的返回结果类型, 开启WXPAY_TYPED_RESULTS后代替dict返回。
+
+每种结果使用 ``__slots__`` 保存已知字段, 比dict节省内存, 适合批量任务中保存大量结果;
+trade_state等取值有限的字段值会被intern, 多个结果共用同一个字符串。
+
+实现了 :class:`~collections.abc.MutableMapping`: ``result['total_fee']``, ``result.get('code_url')``,
+``dict(result)`` 等的值仍然是字符串; 属性访问时数字字段在访问时才转换成int, 不存在的字段为None::
+
+    result = wxpay.query_order(out_trade_no)
+    result['total_fee']     # '100'
+    result.total_fee        # 100
+    result.to_dict()        # 普通的dict
+
+结果类型不是dict的子类: ``isinstance(result, dict)`` 为False, ``json.dumps(result)``
+和 ``jsonify(result)`` 会失败, 需要先调用 :meth:`Result.to_dict`。
+(字段保存在slot中, 继承dict时json等直接读取dict内部存储的代码只能看到空dict)
+
+接口返回了未声明的字段(例如带序号的coupon_fee_0)时保存在额外的dict中, 只能通过下标访问。
+"""
+
+import sys
+from collections.abc import MutableMapping
+
+#: 所有接口共有的字段
+COMMON_FIELDS = ('return_code', 'return_msg', 'appid', 'mch_id', 'device_info', 'nonce_str',
+                 'sign', 'result_code', 'err_code', 'err_code_des')
+
+#: 取值有限的字段, 值会被intern
+INTERN_FIELDS = frozenset([
+    'return_code', 'return_msg', 'result_code', 'err_code', 'err_code_des', 'appid', 'mch_id',
+    'mchid', 'mch_appid', 'wxappid', 'device_info', 'trade_type', 'trade_state', 'fee_type',
+    'cash_fee_type', 'bank_type', 'is_subscribe', 'status', 'send_type', 'hb_type',
+])
+
+
+class _IntField(object):
+    """数字字段, 值以字符串保存在slot中, 访问时转换成int"""
+
+    __slots__ = ('member',)
+
+    def __init__(self, member):
+        self.member = member
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = self.member.__get__(obj, cls)
+        return int(value) if value is not None else None
+
+    def __set__(self, obj, value):
+        self.member.__set__(obj, str(value) if value is not None else None)
+
+
+class Result(MutableMapping):
+    """结果类型的基类, 子类由 :func:`result_class` 创建"""
+
+    __slots__ = ('_extra',)
+
+    #: 声明的字段名
+    _fields = ()
+    #: 字段名 -> slot的描述符
+    _members = {}
+
+    def __init__(self, data=None):
+        members = self._members
+        for member in members.values():
+            member.__set__(self, None)
+        self._extra = None
+        if data:
+            intern = sys.intern
+            for key, value in data.items():
+                member = members.get(key)
+                if member is None:
+                    if self._extra is None:
+                        self._extra = {}
+                    self._extra[intern(key)] = value
+                else:
+                    if key in INTERN_FIELDS:
+                        value = intern(value)
+                    member.__set__(self, value)
+
+    def __getitem__(self, key):
+        member = self._members.get(key)
+        if member is not None:
+            value = member.__get__(self)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        member = self._members.get(key)
+        if member is not None:
+            member.__set__(self, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[sys.intern(key)] = value
+
+    def __delitem__(self, key):
+        member = self._members.get(key)
+        if member is not None:
+            if member.__get__(self) is None:
+                raise KeyError(key)
+            member.__set__(self, None)
+            return
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __iter__(self):
+        for field, member in self._members.items():
+            if member.__get__(self) is not None:
+                yield field
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        count = sum(1 for member in self._members.values() if member.__get__(self) is not None)
+        return count + (len(self._extra) if self._extra else 0)
+
+    def __contains__(self, key):
+        member = self._members.get(key)
+        if member is not None:
+            return member.__get__(self) is not None
+        return bool(self._extra) and key in self._extra
+
+    def to_dict(self):
+        """所有字段的dict, 值为字符串, 可以传给json.dumps, jsonify等"""
+        return dict(self.items())
+
+    @property
+    def raw(self):
+        """同 :meth:`to_dict`"""
+        return self.to_dict()
+
+    def copy(self):
+        return type(self)(self.raw)
+
+    def __reduce__(self):
+        return type(self), (self.raw,)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.raw)
+
+
+def result_class(name, fields, int_fields=()):
+    """创建结果类型
+
+    :params fields: 字符串字段名, 会加上 :data:`COMMON_FIELDS`
+    :params int_fields: 数字字段名
+    """
+    str_fields = tuple(f for f in COMMON_FIELDS + tuple(fields) if f not in int_fields)
+    int_slots = tuple('_' + f for f in int_fields)
+    cls = type(name, (Result,), dict(__slots__=str_fields + int_slots, __module__=__name__))
+    members = dict((f, cls.__dict__[f]) for f in str_fields)
+    for field, slot in zip(int_fields, int_slots):
+        member = cls.__dict__[slot]
+        setattr(cls, field, _IntField(member))
+        # __getitem__等使用原始的字符串值
+        members[field] = member
+    cls._fields = str_fields + tuple(int_fields)
+    cls._members = members
+    return cls
+
+
+UnifiedOrderResult = result_class(
+    'UnifiedOrderResult',
+    ('trade_type', 'prepay_id', 'code_url', 'mweb_url'),
+)
+
+OrderQueryResult = result_class(
+    'OrderQueryResult',
+    ('openid', 'is_subscribe', 'trade_type', 'trade_state', 'bank_type', 'fee_type',
+     'cash_fee_type', 'transaction_id', 'out_trade_no', 'attach', 'time_end', 'trade_state_desc'),
+    ('total_fee', 'settlement_total_fee', 'cash_fee', 'coupon_fee', 'coupon_count'),
+)
+
+CloseOrderResult = result_class('CloseOrderResult', ('result_msg',))
+
+RefundResult = result_class(
+    'RefundResult',
+    ('transaction_id', 'out_trade_no', 'out_refund_no', 'refund_id', 'fee_type', 'cash_fee_type'),
+    ('refund_fee', 'settlement_refund_fee', 'total_fee', 'settlement_total_fee', 'cash_fee',
+     'cash_refund_fee', 'coupon_refund_fee', 'coupon_refund_count'),
+)
+
+RefundQueryResult = result_class(
+    'RefundQueryResult',
+    ('transaction_id', 'out_trade_no', 'fee_type'),
+    ('total_refund_count', 'total_fee', 'settlement_total_fee', 'cash_fee', 'refund_count'),
+)
+
+TransferResult = result_class(
+    'TransferResult',
+    ('mch_appid', 'mchid', 'partner_trade_no', 'payment_no', 'payment_time'),
+)
+
+TransferInfoResult = result_class(
+    'TransferInfoResult',
+    ('partner_trade_no', 'detail_id', 'status', 'reason', 'openid', 'transfer_name',
+     'transfer_time', 'payment_time', 'desc'),
+    ('payment_amount',),
+)
+
+RedpackResult = result_class(
+    'RedpackResult',
+    ('mch_billno', 'wxappid', 're_openid', 'send_listid'),
+    ('total_amount',),
+)
+
+RedpackInfoResult = result_class(
+    'RedpackInfoResult',
+    ('mch_billno', 'detail_id', 'status', 'send_type', 'hb_type', 'reason', 'send_time',
+     'refund_time', 'wishing', 'remark', 'act_name', 'openid'),
+    ('total_num', 'total_amount', 'refund_amount'),
+)
+
+#: 接口path到结果类型
+RESULT_TYPES = {
+    '/pay/unifiedorder': UnifiedOrderResult,
+    '/pay/orderquery': OrderQueryResult,
+    '/pay/closeorder': CloseOrderResult,
+    '/secapi/pay/refund': RefundResult,
+    '/pay/refundquery': RefundQueryResult,
+    '/mmpaymkttransfers/promotion/transfers': TransferResult,
+    '/mmpaymkttransfers/gettransferinfo': TransferInfoResult,
+    '/mmpaymkttransfers/sendredpack': RedpackResult,
+    '/mmpaymkttransfers/gethbinfo': RedpackInfoResult,
+}
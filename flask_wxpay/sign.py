@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.sign
+~~~~~~~~~~~~~~~~
+
+`签名算法 <https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=4_3>`_,
+支持MD5和HMAC-SHA256两种签名类型。
+"""
+
+import hashlib
+import hmac
+
+from .compat import str
+from .exceptions import WXPayError
+
+
+def sign_string(data):
+    """参数按字典序排序后拼接成 ``key1=value1&key2=value2`` 的形式,
+    值为空的参数和sign不参与签名
+    """
+    return '&'.join([
+        k + '=' + str(data[k])
+        for k in sorted(data)
+        if k != 'sign' and data[k] is not None and data[k] != ''
+    ])
+
+
+class Signer(object):
+    """签名器基类, 子类实现 :meth:`_digest`
+
+    :params key: 商户支付密钥
+    """
+
+    #: 对应请求参数sign_type的值
+    sign_type = None
+
+    def __init__(self, key):
+        self.key = key
+        self._key_suffix = '&key={0}'.format(key).encode('utf-8')
+
+    def sign(self, data):
+        """返回大写的签名"""
+        s = sign_string(data).encode('utf-8') + self._key_suffix
+        return self._digest(s).upper()
+
+    def _digest(self, s):
+        raise NotImplementedError
+
+
+class MD5Signer(Signer):
+    sign_type = 'MD5'
+
+    def _digest(self, s):
+        return hashlib.md5(s).hexdigest()
+
+
+class HMACSHA256Signer(Signer):
+    sign_type = 'HMAC-SHA256'
+
+    def __init__(self, key):
+        super(HMACSHA256Signer, self).__init__(key)
+        # 密钥只处理一次, 每次签名复制已经初始化好的hmac对象
+        self._hmac = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def _digest(self, s):
+        h = self._hmac.copy()
+        h.update(s)
+        return h.hexdigest()
+
+
+SIGNERS = {
+    MD5Signer.sign_type: MD5Signer,
+    HMACSHA256Signer.sign_type: HMACSHA256Signer,
+}
+
+
+def get_signer(sign_type, key):
+    """根据签名类型创建签名器
+
+    :params sign_type: MD5, HMAC-SHA256
+    :params key: 商户支付密钥
+    """
+    try:
+        return SIGNERS[sign_type](key)
+    except KeyError:
+        raise WXPayError('不支持的签名类型: {0}'.format(sign_type))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.tracing
+~~~~~~~~~~~~~~~~~~~
+
+记录每次接口调用各阶段的耗时:
+
+- sign: 生成签名
+- encode: 请求数据转换成xml
+- network: 发送请求到收到响应, 故障切换时每个域名记录一次
+- decode: 解析返回的xml
+- verify: 检查return_code, result_code和签名
+
+在Flask请求中调用时, 耗时记录在 ``g.wxpay_timings``, 每项为 :class:`Timing`;
+开启WXPAY_SERVER_TIMING时汇总到响应的 ``Server-Timing`` 头。
+安装了 `OpenTelemetry <https://opentelemetry.io/>`_ 时可以同时为每个阶段创建span。
+"""
+
+import time
+from collections import namedtuple
+
+from flask import g, has_app_context
+
+#: 单个阶段的耗时
+Timing = namedtuple('Timing', 'phase path duration')
+
+PHASES = ('sign', 'encode', 'network', 'decode', 'verify')
+
+
+class PhaseTracer(object):
+    """记录各阶段的耗时
+
+    :params otel_tracer: OpenTelemetry的tracer, 或者其他实现了
+        ``start_span(name, start_time=None, attributes=None)`` 的对象
+    """
+
+    def __init__(self, otel_tracer=None):
+        self.otel_tracer = otel_tracer
+
+    now = staticmethod(time.perf_counter)
+
+    def record(self, phase, path, start):
+        """记录从start到现在的耗时, 返回现在的时间, 可以作为下一个阶段的start"""
+        end = time.perf_counter()
+        duration = end - start
+        if has_app_context():
+            timings = g.get('wxpay_timings')
+            if timings is None:
+                timings = g.wxpay_timings = []
+            timings.append(Timing(phase, path, duration))
+        if self.otel_tracer is not None:
+            end_ns = time.time_ns()
+            span = self.otel_tracer.start_span(
+                'wxpay.' + phase, start_time=end_ns - int(duration * 1e9),
+                attributes={'wxpay.path': path})
+            span.end(end_time=end_ns)
+        return end
+
+
+def get_timings():
+    """当前Flask请求中记录的耗时列表"""
+    return g.get('wxpay_timings') or []
+
+
+def server_timing(timings):
+    """按阶段汇总耗时, 返回Server-Timing头的值, 单位为毫秒"""
+    totals = {}
+    for timing in timings:
+        totals[timing.phase] = totals.get(timing.phase, 0) + timing.duration
+    return ', '.join(
+        'wxpay-{0};dur={1:.3f}'.format(phase, totals[phase] * 1000)
+        for phase in PHASES if phase in totals
+    )
+
+
+def add_server_timing(response):
+    """after_request的处理函数, 添加Server-Timing头"""
+    timings = g.get('wxpay_timings')
+    if timings:
+        value = server_timing(timings)
+        existing = response.headers.get('Server-Timing')
+        response.headers['Server-Timing'] = existing + ', ' + value if existing else value
+    return response
+
+
+def get_otel_tracer():
+    """安装了opentelemetry-api时返回flask_wxpay的tracer, 否则返回None"""
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace.get_tracer('flask_wxpay')
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+flask_wxpay.transport
+~~~~~~~~~~~~~~~~~~~~~
+
+HTTP传输层, 每个WXPay实例持有一个带连接池的keep-alive session,
+避免每次请求都重新建立TCP连接和TLS握手。
+"""
+
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from contextlib import ExitStack, contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+from .compat import bytes, urlparse
+
+
+def _write_all(fd, content):
+    view = memoryview(content)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+@contextmanager
+def _pem_file(content):
+    """把内存中的PEM放到可以传给ssl模块的路径上, 退出时释放
+
+    Linux上使用memfd_create创建只存在于内存中的匿名文件, 通过 ``/proc/self/fd/N`` 加载,
+    证书和私钥不会写入磁盘; 其他平台只能写入权限为0600的临时文件, 加载后立即删除,
+    但是进程在写入和删除之间退出时文件会留在临时目录中。
+    """
+    if hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd'):
+        fd = os.memfd_create('flask_wxpay_pem', os.MFD_CLOEXEC)
+        try:
+            _write_all(fd, content)
+            yield '/proc/self/fd/{0}'.format(fd)
+        finally:
+            os.close(fd)
+        return
+    fd, path = tempfile.mkstemp(suffix='.pem')
+    try:
+        try:
+            _write_all(fd, content)
+        finally:
+            os.close(fd)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def create_ssl_context(cert=None, key=None, verify=True):
+    """加载商户API证书, 创建可复用的 :class:`ssl.SSLContext`
+
+    :params cert: apiclient_cert.pem的路径或者PEM格式的bytes, 为None时不加载客户端证书;
+        bytes在Linux上通过memfd加载, 不写入磁盘, 其他平台会短暂写入临时文件
+    :params key: apiclient_key.pem的路径或者PEM格式的bytes
+    :params verify: 同requests的verify参数, 为字符串时作为CA证书路径
+    :rtype: ssl.SSLContext
+    """
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        cafile = verify if isinstance(verify, str) else DEFAULT_CA_BUNDLE_PATH
+        if os.path.isdir(cafile):
+            context = ssl.create_default_context(capath=cafile)
+        else:
+            context = ssl.create_default_context(cafile=cafile)
+
+    if cert is None:
+        return context
+
+    # ssl模块只能从文件加载证书, 内存中的证书见 _pem_file
+    with ExitStack() as stack:
+        if isinstance(cert, bytes):
+            cert = stack.enter_context(_pem_file(cert))
+        if isinstance(key, bytes):
+            key = stack.enter_context(_pem_file(key))
+        context.load_cert_chain(cert, key)
+    return context
+
+
+class ClientCertAdapter(HTTPAdapter):
+    """使用预先加载好证书的SSLContext的HTTPAdapter
+
+    requests传入cert参数时每个新连接都会重新读取并解析证书文件,
+    这里所有连接共用同一个SSLContext。
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(ClientCertAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(ClientCertAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(ClientCertAdapter, self).proxy_manager_for(*args, **kwargs)
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, _ = super(ClientCertAdapter, self) \
+            .build_connection_pool_key_attributes(request, verify, cert)
+        return host_params, {'ssl_context': self.ssl_context}
+
+    def cert_verify(self, conn, url, verify, cert):
+        # CA和客户端证书都已经加载到ssl_context中
+        pass
+
+
+class Transport(object):
+    """持有连接池的 :class:`requests.Session`
+
+    session按进程创建, 在gunicorn ``--preload`` 等fork场景下,
+    子进程第一次使用时会丢弃从父进程继承的连接池并重新创建。
+    需要双向证书的接口使用单独的session和连接池。
+
+    :params pool_connections: 缓存的连接池个数(按host区分)
+    :params pool_maxsize: 每个连接池保存的最大连接数
+    :params pool_block: 连接数达到pool_maxsize时是否阻塞等待
+    :params ssl_context: 加载了商户API证书的SSLContext, 见 :func:`create_ssl_context`
+    :params verify: 同requests的verify参数
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 ssl_context=None, verify=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.ssl_context = ssl_context
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = None
+
+    def _create_adapter(self, use_cert):
+        kwargs = dict(pool_connections=self.pool_connections,
+                      pool_maxsize=self.pool_maxsize,
+                      pool_block=self.pool_block)
+        if use_cert:
+            return ClientCertAdapter(self.ssl_context, **kwargs)
+        return HTTPAdapter(**kwargs)
+
+    def _create_session(self, use_cert):
+        session = requests.Session()
+        session.verify = self.verify
+        adapter = self._create_adapter(use_cert)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_session(self, use_cert=False):
+        """当前进程的session, fork后自动重建"""
+        pid = os.getpid()
+        if self._pid != pid or use_cert not in self._sessions:
+            with self._lock:
+                if self._pid != pid:
+                    # 不关闭继承来的session, 其socket仍被父进程使用
+                    self._sessions = {}
+                    self._pid = pid
+                if use_cert not in self._sessions:
+                    self._sessions[use_cert] = self._create_session(use_cert)
+        return self._sessions[use_cert]
+
+    @property
+    def session(self):
+        return self.get_session()
+
+    @property
+    def cert_session(self):
+        return self.get_session(use_cert=True)
+
+    def post(self, url, use_cert=False, **kwargs):
+        # 设置了REQUESTS_CA_BUNDLE环境变量时requests会忽略session.verify, 每个请求显式传入
+        kwargs.setdefault('verify', self.verify)
+        return self.get_session(use_cert).post(url, **kwargs)
+
+    def warm_up(self, url, timeout=None, connections=1):
+        """预先解析DNS并建立连接, 失败时静默忽略
+
+        :params url: 需要预热的地址
+        :params timeout: 每个连接的超时时间
+        :params connections: 预先建立的连接数
+        """
+        parsed = urlparse(url)
+        try:
+            socket.getaddrinfo(parsed.hostname, parsed.port or 443)
+        except socket.error:
+            return
+
+        def head(session):
+            try:
+                session.head(url, timeout=timeout).close()
+            except requests.RequestException:
+                pass
+
+        sessions = [self.session]
+        if self.ssl_context is not None:
+            sessions.append(self.cert_session)
+        # 并发请求才能建立多个不同的连接
+        threads = [threading.Thread(target=head, args=(session,))
+                   for session in sessions
+                   for _ in range(min(connections, self.pool_maxsize))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                for session in self._sessions.values():
+                    session.close()
+            self._sessions = {}
+            self._pid = None
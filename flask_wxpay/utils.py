@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import random
+import re
 import string
 from datetime import datetime
 
@@ -9,9 +10,52 @@ import defusedxml.ElementTree as ElementTree
 from .compat import bytes, numeric_types, str
 
 
+# 微信支付的xml都是 <xml><key>value</key>...</xml> 这种单层结构
+_FLAT_XML_FIELD = re.compile(br'\s*<(\w+)>(?:<!\[CDATA\[(.*?)\]\]>|([^<&]*))</\1>', re.S)
+_FLAT_XML_END = re.compile(br'\s*</xml>\s*$')
+
+
+def _flat_xml_to_dict(xml):
+    """快速解析单层结构的xml, 不符合时返回None
+
+    DTD, 实体引用, 嵌套节点等都不会匹配, 交给defusedxml处理
+    """
+    pos = len(xml) - len(xml.lstrip())
+    if not xml.startswith(b'<xml>', pos):
+        return None
+    pos += 5
+    data = {}
+    match = _FLAT_XML_FIELD.match
+    while True:
+        m = match(xml, pos)
+        if m is None:
+            break
+        tag, cdata, text = m.groups()
+        if cdata is None:
+            value = text
+        elif b']]>' in cdata:  # 被拆分成多段的CDATA
+            return None
+        else:
+            value = cdata
+        if value:
+            data[tag.decode('ascii')] = value.decode('utf-8')
+        pos = m.end()
+    if _FLAT_XML_END.match(xml, pos) is None:
+        return None
+    return data
+
+
 def xml_to_dict(xml):
+    """xml转换成dict, 只处理第一层节点
+
+    :params xml: bytes或者str, 直接传入响应的原始bytes可以省去解码
+    """
     if isinstance(xml, str):
         xml = xml.encode('utf-8')
+    data = _flat_xml_to_dict(xml)
+    if data is not None:
+        return data
+
     data = {}
     root = ElementTree.fromstring(xml)
     for child in root:
@@ -23,17 +67,54 @@ def xml_to_dict(xml):
     return data
 
 
-def dict_to_xml(*args, **kwargs):
-    """参数形式参照flask.jsonify"""
+# tag -> (数字节点开始, 数字节点结束, CDATA节点开始, CDATA节点结束)
+_TAG_FRAGMENTS = {}
+_TAG_FRAGMENTS_MAXSIZE = 1024
+
+
+def _tag_fragments(tag):
+    fragments = _TAG_FRAGMENTS.get(tag)
+    if fragments is None:
+        tag_bytes = tag.encode('utf-8')
+        fragments = (b'<' + tag_bytes + b'>',
+                     b'</' + tag_bytes + b'>',
+                     b'<' + tag_bytes + b'><![CDATA[',
+                     b']]></' + tag_bytes + b'>')
+        if len(_TAG_FRAGMENTS) < _TAG_FRAGMENTS_MAXSIZE:
+            _TAG_FRAGMENTS[tag] = fragments
+    return fragments
+
+
+def dict_to_xml_bytes(*args, **kwargs):
+    """同 :func:`dict_to_xml`, 直接返回utf-8编码的bytes"""
     data = dict(*args, **kwargs)
-    xml = ['<xml>']
+    parts = [b'<xml>']
+    append = parts.append
+    get_fragments = _TAG_FRAGMENTS.get
     for k, v in data.items():
-        if isinstance(v, numeric_types):
-            xml.append('<{0}>{1}</{0}>'.format(k, v))
-        else:
-            xml.append('<{0}><![CDATA[{1}]]></{0}>'.format(k, v))
-    xml.append('</xml>')
-    return ''.join(xml)
+        fragments = get_fragments(k) or _tag_fragments(k)
+        cls = type(v)
+        if cls is not str and isinstance(v, numeric_types):
+            append(fragments[0])
+            append(str(v).encode('ascii'))
+            append(fragments[1])
+            continue
+        if cls is str:
+            v = v.encode('utf-8')
+        elif cls is not bytes:
+            v = str(v).encode('utf-8')
+        if b']]>' in v:  # CDATA中不能出现]]>, 拆成两段CDATA
+            v = v.replace(b']]>', b']]]]><![CDATA[>')
+        append(fragments[2])
+        append(v)
+        append(fragments[3])
+    append(b'</xml>')
+    return b''.join(parts)
+
+
+def dict_to_xml(*args, **kwargs):
+    """参数形式参照flask.jsonify"""
+    return dict_to_xml_bytes(*args, **kwargs).decode('utf-8')
 
 
 def gen_random_str(size=16):
@@ -20,6 +20,8 @@ setup(
     author_email='me@codeif.com',
     url='https://github.com/codeif/Flask-WXPay',
     license='MIT',
-    install_requires=['requests', 'defusedxml'],
+    python_requires='>=3.7',
+    install_requires=['Flask', 'requests', 'defusedxml'],
+    extras_require={'async': ['httpx']},
     packages=find_packages(),
 )
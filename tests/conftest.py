@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+from collections import namedtuple
+
+import pytest
+from flask import Flask
+
+from flask_wxpay import WXPay
+from flask_wxpay.mock import MockWXPayServer
+
+KEY = '192006250b4c09247ec02edce69f6a2d'
+MCH_ID = '1900000109'
+
+Certs = namedtuple('Certs', 'server_cert server_key client_cert client_key')
+
+
+def _self_signed(directory, name):
+    cert = os.path.join(directory, name + '_cert.pem')
+    key = os.path.join(directory, name + '_key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost',
+         '-keyout', key, '-out', cert],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+@pytest.fixture(scope='session')
+def certs(tmp_path_factory):
+    """服务器证书和商户证书, 都是自签名的"""
+    if shutil.which('openssl') is None:
+        pytest.skip('需要openssl生成测试证书')
+    directory = str(tmp_path_factory.mktemp('certs'))
+    return Certs(*(_self_signed(directory, 'server') + _self_signed(directory, 'client')))
+
+
+@pytest.fixture
+def server(certs):
+    server = MockWXPayServer(KEY, mch_id=MCH_ID, certfile=certs.server_cert,
+                             keyfile=certs.server_key, client_ca=certs.client_cert)
+    with server:
+        yield server
+
+
+@pytest.fixture
+def app(server, certs, tmp_path):
+    app = Flask(__name__)
+    app.config.update(
+        WX_APPID='wx2421b1c4370ec43b',
+        WXPAY_MCHID=MCH_ID,
+        WXPAY_KEY=KEY,
+        WXPAY_NOTIFY_URL='http://localhost/notify',
+        WXPAY_BASE_URL=server.url,
+        WXPAY_APICLIENT_CERT_PATH=certs.client_cert,
+        WXPAY_APICLIENT_KEY_PATH=certs.client_key,
+        WXPAY_ROOTCA_PATH=certs.server_cert,
+        WXPAY_SANDBOX_SIGNKEY_CACHE_DIR=str(tmp_path / 'signkey'),
+    )
+    return app
+
+
+@pytest.fixture
+def wxpay(app):
+    wxpay = WXPay(app)
+    yield wxpay
+    wxpay.transport.close()
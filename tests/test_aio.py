@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+pytest.importorskip('httpx')
+
+from flask_wxpay.aio import AsyncWXPay  # noqa: E402
+
+
+@pytest.fixture
+def async_wxpay(app):
+    return AsyncWXPay(app)
+
+
+def test_client_per_event_loop(async_wxpay, server):
+    server.unified_order(dict(out_trade_no='o1', total_fee='100', body='b', trade_type='NATIVE'))
+
+    async def query():
+        return await async_wxpay.query_order('o1', use_cache=False), \
+            async_wxpay.async_transport.get_client()
+
+    # 每次asyncio.run都是新的事件循环, 与Flask的async视图相同
+    first, client1 = asyncio.run(query())
+    second, client2 = asyncio.run(query())
+    assert first['trade_state'] == second['trade_state'] == 'NOTPAY'
+    assert client1 is not client2
+
+
+def test_client_reused_within_loop(async_wxpay):
+    async def clients():
+        transport = async_wxpay.async_transport
+        result = transport.get_client(), transport.get_client(), transport.get_client(True)
+        await transport.aclose()
+        return result
+
+    plain, again, cert = asyncio.run(clients())
+    assert plain is again
+    assert plain is not cert
+    assert plain.is_closed and cert.is_closed
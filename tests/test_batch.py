@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from flask_wxpay import WXPay
+from flask_wxpay.exceptions import NetworkError, WXPayError
+
+NOT_UTF8 = b'<xml><return_code>SUCCESS</return_code><a>\xff\xfe</a></xml>'
+KEYS = ['o{0}'.format(i) for i in range(6)]
+
+
+@pytest.fixture
+def orders(server):
+    for out_trade_no in KEYS:
+        server.unified_order(dict(out_trade_no=out_trade_no, total_fee='100', body='b',
+                                  trade_type='NATIVE'))
+    order_query = server.handlers['/pay/orderquery']
+
+    def handler(data):
+        if data['out_trade_no'] == 'o3':
+            return NOT_UTF8
+        return order_query(data)
+    server.handlers['/pay/orderquery'] = handler
+    return KEYS
+
+
+def _check(results):
+    assert sorted(results) == KEYS
+    assert isinstance(results.pop('o3'), WXPayError)
+    assert all(r['trade_state'] == 'NOTPAY' for r in results.values())
+
+
+def test_query_orders_keeps_going(wxpay, orders):
+    _check(dict(wxpay.query_orders(orders, max_in_flight=2)))
+
+
+def test_network_error_is_returned(app, orders):
+    app.config.update(WXPAY_BASE_URL='http://127.0.0.1:9', WXPAY_REQUEST_TIMEOUT=1)
+    wxpay = WXPay(app)
+    results = dict(wxpay.query_orders(orders))
+    assert sorted(results) == KEYS
+    assert all(isinstance(r, NetworkError) for r in results.values())
+
+
+def test_async_query_orders_keeps_going(app, orders):
+    pytest.importorskip('httpx')
+    from flask_wxpay.aio import AsyncWXPay
+    wxpay = AsyncWXPay(app)
+
+    async def run():
+        try:
+            return dict([item async for item in wxpay.query_orders(orders, max_in_flight=2)])
+        finally:
+            await wxpay.aclose()
+    _check(asyncio.run(run()))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from flask_wxpay.bill import MappedBillReader
+from flask_wxpay.billstore import BillStore
+from flask_wxpay.exceptions import WXPayError
+
+BILL_PATH = '/pay/downloadbill'
+DAY = '20240501'
+
+
+@pytest.fixture
+def store(wxpay, tmp_path):
+    return BillStore(wxpay, str(tmp_path / 'bills'), chunk_size=128)
+
+
+@pytest.fixture
+def bill_date(wxpay, server):
+    for out_trade_no in ('o1', 'o2'):
+        wxpay.unified_order(out_trade_no, 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+        server.pay(out_trade_no, notify=False)
+        # 固定的日期, 不受运行测试的时间影响
+        with server.lock:
+            server.orders[out_trade_no]['time_end'] = DAY + '120000'
+    return DAY
+
+
+def test_downloads_once(store, server, bill_date):
+    rows = list(store.iter_bill(bill_date))
+    assert sorted(r.out_trade_no for r in rows) == ['o1', 'o2']
+    assert list(store.iter_bill(bill_date)) == rows
+    assert server.requests[BILL_PATH] == 1
+    with store.open(bill_date) as m:
+        assert m[:2] == b'\x1f\x8b'
+
+
+def test_corrupted_bill_is_downloaded_again(store, server, bill_date):
+    path = store.fetch(bill_date)
+    with open(path, 'r+b') as f:
+        f.write(b'xx')
+    assert store.get(bill_date, verify=True) is None
+    assert len(list(store.iter_bill(bill_date, verify=True))) == 2
+    assert server.requests[BILL_PATH] == 2
+
+
+def test_error_is_not_stored(store, server):
+    with pytest.raises(WXPayError):
+        store.fetch('20000101')
+    assert store.get('20000101') is None
+
+
+def test_empty_bill(store, server, tmp_path):
+    server.handlers[BILL_PATH] = lambda data: b''
+    reader = store.iter_bill('20240501', tar_type=None)
+    assert list(reader) == []
+    assert reader.summary is None
+    assert len(store.open('20240501', tar_type=None)) == 0
+
+    empty = tmp_path / 'empty'
+    empty.write_bytes(b'')
+    assert list(MappedBillReader(str(empty))) == []
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from flask_wxpay import comment as comment_module
+from flask_wxpay.comment import Comment, parse_comment_page
+from flask_wxpay.exceptions import WXPayError
+
+COMMENT_PATH = '/billcommentsp/batchquerycomment'
+BEGIN, END = '20170701000000', '20170710000000'
+
+
+@pytest.fixture
+def comments(server):
+    server.comments = [('2017-07-0{0} 10:00:00'.format(i + 1), '4200{0:018d}'.format(i), '5',
+                        u'评价{0},很好'.format(i)) for i in range(5)]
+    # 时间范围外的评价占用offset但不返回
+    server.comments.append(('2017-07-20 10:00:00', '4200999', '1', u'范围外'))
+    return [Comment(*c) for c in server.comments[:5]]
+
+
+def test_parse_comment_page():
+    content = (u'100\r\n`2017-07-01 10:00:05,`1001690740201411100005734289,`5,`赞,好评\r\n'
+               u'\r\n').encode('utf-8')
+    assert parse_comment_page(content) == (100, [
+        Comment(u'2017-07-01 10:00:05', u'1001690740201411100005734289', u'5', u'赞,好评')])
+    assert parse_comment_page(b'0\r\n') == (0, [])
+    with pytest.raises(WXPayError):
+        parse_comment_page(b'')
+    with pytest.raises(WXPayError) as exc_info:
+        parse_comment_page(u'<xml><return_code>FAIL</return_code>'
+                           u'<return_msg>签名错误</return_msg></xml>'.encode('utf-8'))
+    assert u'签名错误' in str(exc_info.value)
+
+
+def test_offset_paging(wxpay, server, comments):
+    reader = wxpay.iter_comments(BEGIN, END, limit=2)
+    assert list(reader) == comments
+    # 2 + 2 + 最后一页(1条和范围外的1条)
+    assert server.requests[COMMENT_PATH] == 3
+    assert reader.offset == 6
+
+
+def test_resume_from_offset(wxpay, comments):
+    reader = wxpay.iter_comments(BEGIN, END, limit=2)
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) == 3:
+            break
+    # 中断所在的页会重新返回
+    assert reader.offset == 2
+    assert list(wxpay.iter_comments(BEGIN, END, offset=reader.offset, limit=2)) == comments[2:]
+
+
+def test_executor_shutdown_on_early_stop(wxpay, server, comments, monkeypatch):
+    executors = []
+
+    class Executor(ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super(Executor, self).__init__(*args, **kwargs)
+            self.shut_down = False
+            executors.append(self)
+
+        def shutdown(self, *args, **kwargs):
+            self.shut_down = True
+            super(Executor, self).shutdown(*args, **kwargs)
+    monkeypatch.setattr(comment_module, 'ThreadPoolExecutor', Executor)
+
+    it = iter(wxpay.iter_comments(BEGIN, END, limit=2))
+    assert next(it) == comments[0]
+    assert not executors[0].shut_down
+    it.close()
+    assert executors[0].shut_down
+    # 最多预取了下一页
+    executors[0].shutdown(wait=True)
+    assert server.requests[COMMENT_PATH] <= 2
+
+
+def test_error_page(wxpay, server):
+    server.handlers[COMMENT_PATH] = lambda data: server._error('SYSTEMERROR', u'系统错误')
+    with pytest.raises(WXPayError):
+        list(wxpay.iter_comments(BEGIN, END))
+
+
+def test_async_paging(app, server, comments):
+    pytest.importorskip('httpx')
+    from flask_wxpay.aio import AsyncWXPay
+    wxpay = AsyncWXPay(app)
+
+    async def run():
+        try:
+            reader = wxpay.iter_comments(BEGIN, END, limit=2)
+            rows = [row async for row in reader]
+            return rows, reader.offset
+        finally:
+            await wxpay.aclose()
+    assert asyncio.run(run()) == (comments, 6)
+    assert server.requests[COMMENT_PATH] == 3
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from flask_wxpay import WXPay
+from flask_wxpay.tracing import get_timings
+
+
+def test_hedged_calls_keep_app_context(app, server):
+    app.config.update(WXPAY_TRACING=True, WXPAY_HEDGE=True, WXPAY_HEDGE_DELAY=0.05,
+                      WXPAY_HEDGE_BUDGET=1)
+    wxpay = WXPay(app)
+    server.unified_order(dict(out_trade_no='o1', total_fee='100', body='b', trade_type='NATIVE'))
+    server._latency['/pay/orderquery'] = lambda: 0.2
+
+    with app.test_request_context():
+        assert wxpay.query_order('o1')['trade_state'] == 'NOTPAY'
+        phases = [t.phase for t in get_timings()]
+    assert wxpay.hedge_policy.hedges == 1
+    # 两个请求都在executor的线程中执行, 至少先返回的请求记录了network
+    assert 'network' in phases
+    assert 'sign' in phases
+    wxpay.transport.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import pytest
+import requests
+
+from flask_wxpay import WXPay
+from flask_wxpay.hosts import HostPool
+
+A, B = 'https://a.example.com', 'https://b.example.com'
+
+
+def test_demotion_after_threshold():
+    pool = HostPool([A, B], failure_threshold=3)
+    for _ in range(2):
+        pool.report_failure(A)
+    assert pool.candidates() == [A, B]
+    pool.report_failure(A)
+    assert pool.candidates() == [B, A]
+    assert not pool.hosts[0].healthy
+
+
+def test_latency_ordering():
+    pool = HostPool([A, B])
+    # 主域名没有延迟数据前按配置顺序
+    pool.report_success(B, 0.01)
+    assert pool.candidates() == [A, B]
+    pool.report_success(A, 0.2)
+    assert pool.candidates() == [B, A]
+    for _ in range(10):
+        pool.report_success(A, 0.001)
+    assert pool.candidates() == [A, B]
+
+
+def test_probe_recovery():
+    up = set()
+    pool = HostPool([A, B], failure_threshold=1, probe=lambda url: url in up)
+    pool.report_success(A, 0.05)
+    pool.report_failure(A)
+    state = pool.hosts[0]
+    latency, error_rate = state.latency, state.error_rate
+
+    pool.probe_once()
+    assert not state.healthy and state.consecutive_failures == 2
+    up.add(A)
+    pool.probe_once()
+    assert state.healthy and state.consecutive_failures == 0
+    # 探测结果不计入延迟和错误率
+    assert (state.latency, state.error_rate) == (latency, error_rate)
+
+
+def test_probe_only_demoted_hosts():
+    probed = []
+    pool = HostPool([A, B], failure_threshold=1, probe=probed.append)
+    pool.report_failure(B)
+    pool.probe_once()
+    assert probed == [B]
+
+
+@pytest.fixture
+def dead_url():
+    """没有监听的端口, 连接被拒绝"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:{0}'.format(port)
+
+
+@pytest.fixture
+def blackhole_url():
+    """接受连接但是不返回响应"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    yield 'http://127.0.0.1:{0}'.format(sock.getsockname()[1])
+    sock.close()
+
+
+def _wxpay(app, server, first_url):
+    app.config.update(WXPAY_BASE_URLS=[first_url, server.url], WXPAY_HOST_PROBE_INTERVAL=3600,
+                      WXPAY_REQUEST_TIMEOUT=0.5)
+    return WXPay(app)
+
+
+def test_connect_error_fails_over(app, server, dead_url):
+    wxpay = _wxpay(app, server, dead_url)
+    # 连接没有建立, 不能重试的接口也切换到其他域名
+    wxpay.unified_order('o1', 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    assert server.requests['/pay/unifiedorder'] == 1
+    assert wxpay.hosts.hosts[0].consecutive_failures == 1
+
+
+def test_read_timeout_on_unsafe_path_is_not_retried(app, server, blackhole_url):
+    wxpay = _wxpay(app, server, blackhole_url)
+    with pytest.raises(requests.ReadTimeout):
+        wxpay.unified_order('o1', 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    # 请求可能已经被处理, 不能在其他域名重复下单
+    assert server.requests['/pay/unifiedorder'] == 0
+
+    server.unified_order(dict(out_trade_no='o2', total_fee='100', body='b', trade_type='NATIVE'))
+    assert wxpay.query_order('o2')['trade_state'] == 'NOTPAY'
+    assert server.requests['/pay/orderquery'] == 1
+
+
+def test_demoted_host_is_skipped(app, server, dead_url):
+    app.config['WXPAY_HOST_FAILURE_THRESHOLD'] = 2
+    wxpay = _wxpay(app, server, dead_url)
+    for out_trade_no in ('o1', 'o2'):
+        wxpay.unified_order(out_trade_no, 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    assert wxpay.hosts.candidates() == [server.url, dead_url]
+    wxpay.unified_order('o3', 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    assert wxpay.hosts.hosts[0].consecutive_failures == 2
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+
+from flask_wxpay import WXPay
+from flask_wxpay.exceptions import CertError
+
+QUERY_PATH = '/pay/orderquery'
+
+
+@pytest.fixture
+def order(server):
+    server.unified_order(dict(out_trade_no='o1', total_fee='100', body='b', trade_type='NATIVE'))
+    return 'o1'
+
+
+def test_success(wxpay, order):
+    wxpay.query_order(order)
+    stats = wxpay.metrics.snapshot()[QUERY_PATH]
+    assert stats['count'] == 1 and sum(stats['counts']) == 1
+    assert stats['errors'] == stats['timeouts'] == stats['in_flight'] == 0
+    assert stats['results'] == {('SUCCESS', 'SUCCESS', None): 1}
+
+
+def test_cert_error_is_not_a_request(app, server):
+    del app.config['WXPAY_APICLIENT_CERT_PATH'], app.config['WXPAY_APICLIENT_KEY_PATH']
+    wxpay = WXPay(app)
+    with pytest.raises(CertError):
+        wxpay.refund('o1', 'r1', 100, 100)
+    assert '/secapi/pay/refund' not in wxpay.metrics.snapshot()
+    assert server.requests['/secapi/pay/refund'] == 0
+
+
+@pytest.mark.parametrize('exc, timeout', [
+    (requests.ReadTimeout('timeout'), True),
+    (requests.ConnectionError('refused'), False),
+    (RuntimeError('boom'), False),
+])
+def test_errors(wxpay, order, monkeypatch, exc, timeout):
+    def post(*args, **kwargs):
+        raise exc
+    monkeypatch.setattr(wxpay.transport, 'post', post)
+    with pytest.raises(type(exc)):
+        wxpay.query_order(order)
+    stats = wxpay.metrics.snapshot()[QUERY_PATH]
+    assert stats['count'] == stats['errors'] == 1
+    assert stats['timeouts'] == int(timeout)
+    assert stats['in_flight'] == 0
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+DAY = '20240501'
+
+
+def _paid_order(wxpay, server, out_trade_no, total_fee):
+    wxpay.unified_order(out_trade_no, total_fee, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    server.pay(out_trade_no, notify=False)
+    # 固定的日期, 不受运行测试的时间影响
+    with server.lock:
+        server.orders[out_trade_no]['time_end'] = DAY + '120000'
+
+
+def test_refunded_order_has_payment_and_refund_rows(wxpay, server):
+    _paid_order(wxpay, server, 'o1', 1000)
+    _paid_order(wxpay, server, 'o2', 200)
+    wxpay.refund('o1', 'r1', 1000, 300)
+    with server.lock:
+        server.refunds['r1']['time'] = '2024-05-01 15:00:00'
+
+    reader = wxpay.iter_bill(DAY)
+    rows = sorted(((r.out_trade_no, r.trade_state) for r in reader))
+    assert rows == [('o1', 'REFUND'), ('o1', 'SUCCESS'), ('o2', 'SUCCESS')]
+    assert reader.summary.settlement_total_fee == '12.00'
+    assert reader.summary.settlement_refund_fee == '3.00'
+
+    refunds = list(wxpay.iter_bill(DAY, 'REFUND'))
+    assert [(r.out_refund_no, r.refund_fee) for r in refunds] == [('r1', '3.00')]
+    payments = list(wxpay.iter_bill(DAY, 'SUCCESS'))
+    assert sorted(r.total_fee for r in payments) == ['10.00', '2.00']
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from flask_wxpay import WXPay, dict_to_xml, xml_to_dict
+from flask_wxpay.cache import FileCache
+
+
+@pytest.fixture
+def notify_app(app):
+    wxpay = WXPay(app)
+    app.handled = []
+    app.started = threading.Event()
+    app.release = threading.Event()
+    app.release.set()
+
+    @app.route('/notify', methods=['POST'])
+    @wxpay.notify_handler
+    def notify(data):
+        app.started.set()
+        app.release.wait(5)
+        if data.get('attach') == 'error':
+            raise RuntimeError('boom')
+        app.handled.append(data['transaction_id'])
+
+    app.wxpay = wxpay
+    return app
+
+
+def _notification(wxpay, **kwargs):
+    data = dict(return_code='SUCCESS', result_code='SUCCESS', appid=wxpay.appid,
+                mch_id=wxpay.mch_id, nonce_str='abc', out_trade_no='o1',
+                transaction_id='4200000001', total_fee='100', **kwargs)
+    data['sign'] = wxpay.get_sign(data)
+    return dict_to_xml(data)
+
+
+def _post(client, body):
+    r = client.post('/notify', data=body)
+    assert r.status_code == 200
+    return xml_to_dict(r.data)
+
+
+@pytest.mark.parametrize('body', [
+    b'not xml',
+    b'<xml><return_code>SUCCESS</return_code>',
+    b'<!DOCTYPE xml [<!ENTITY a "b">]><xml><return_code>&a;</return_code></xml>',
+    b'<xml><return_code>\xff\xfe</return_code></xml>',
+    b'<xml><nonce_str>abc</nonce_str></xml>',
+    b'<xml><return_code>SUCCESS</return_code></xml>',
+])
+def test_malformed_notification(notify_app, body):
+    result = _post(notify_app.test_client(), body)
+    assert result['return_code'] == 'FAIL'
+    assert notify_app.handled == []
+
+
+def test_bad_sign(notify_app):
+    body = _notification(notify_app.wxpay).replace('abc', 'abd')
+    assert _post(notify_app.test_client(), body)['return_msg'] == u'签名错误'
+
+
+def test_notification_without_ids(notify_app):
+    wxpay = notify_app.wxpay
+    data = dict(return_code='SUCCESS', result_code='SUCCESS', appid=wxpay.appid,
+                mch_id=wxpay.mch_id, nonce_str='abc', total_fee='100')
+    data['sign'] = wxpay.get_sign(data)
+    client = notify_app.test_client()
+    # 不能共用一个去重key, 第二个通知也不能被当作已处理
+    for _ in range(2):
+        assert _post(client, dict_to_xml(data))['return_code'] == 'FAIL'
+    assert len(wxpay.notify_cache) == 0
+
+
+def test_duplicate_notification(notify_app):
+    client = notify_app.test_client()
+    body = _notification(notify_app.wxpay)
+    assert _post(client, body)['return_code'] == 'SUCCESS'
+    assert _post(client, body)['return_code'] == 'SUCCESS'
+    assert notify_app.handled == ['4200000001']
+
+
+def test_concurrent_duplicate_notification(notify_app):
+    body = _notification(notify_app.wxpay)
+    notify_app.release.clear()
+    results = []
+    first = threading.Thread(target=lambda: results.append(_post(notify_app.test_client(), body)))
+    first.start()
+    assert notify_app.started.wait(5)
+
+    # 第一个通知还在处理中, 重复的通知不能调用处理函数, 也不能应答SUCCESS
+    second = _post(notify_app.test_client(), body)
+    assert second['return_code'] == 'FAIL'
+
+    notify_app.release.set()
+    first.join()
+    assert results[0]['return_code'] == 'SUCCESS'
+    assert _post(notify_app.test_client(), body)['return_code'] == 'SUCCESS'
+    assert notify_app.handled == ['4200000001']
+
+
+def test_handler_error_allows_retry(notify_app):
+    client = notify_app.test_client()
+    body = _notification(notify_app.wxpay, attach='error')
+    assert client.post('/notify', data=body).status_code == 500
+    assert notify_app.wxpay.notify_cache.get('notify:4200000001') is None
+
+
+def test_file_cache_add(tmp_path):
+    cache = FileCache(str(tmp_path))
+    assert cache.add('k', 1)
+    assert not cache.add('k', 2)
+    assert cache.get('k') == 1
+    cache.set('k', 3, timeout=-1)
+    assert cache.add('k', 4)
+    assert cache.get('k') == 4
+    assert len(list(tmp_path.iterdir())) == 1
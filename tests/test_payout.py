@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from flask_wxpay import WXPay
+from flask_wxpay.mock import parse_errors
+from flask_wxpay.payout import FAILED, PENDING, SENDING, SUCCESS, UNKNOWN, PayoutOutbox
+
+TRANSFER_PATH = '/mmpaymkttransfers/promotion/transfers'
+
+
+@pytest.fixture
+def outbox(wxpay, tmp_path):
+    outbox = PayoutOutbox(wxpay, str(tmp_path / 'payouts.db'), rate=1000, retry_interval=0.01,
+                          max_retry_interval=0.05)
+    yield outbox
+    outbox.close()
+
+
+@pytest.fixture
+def resends(server):
+    """记录已经付款成功的单号又被发送的次数"""
+    resends = []
+    handler = server.handlers[TRANSFER_PATH]
+
+    def transfer(data):
+        if data['partner_trade_no'] in server.transfers:
+            resends.append(data['partner_trade_no'])
+        return handler(data)
+    server.handlers[TRANSFER_PATH] = transfer
+    return resends
+
+
+def _add(outbox, trade_no, amount=100):
+    return outbox.add_transfer(trade_no, 'openid-' + trade_no, amount, u'奖励', '10.0.0.1')
+
+
+def test_add_is_idempotent(outbox, server, tmp_path):
+    assert _add(outbox, 'T1')
+    assert not _add(outbox, 'T1', amount=999)
+    assert outbox.get('T1')['amount'] == 100
+
+    stats = outbox.run()
+    assert stats[SUCCESS] == dict(count=1, amount=100)
+    assert server.requests[TRANSFER_PATH] == 1
+
+    # 重新打开后已经完成的付款不会再次添加或发送
+    reopened = PayoutOutbox(outbox.wxpay, outbox.path)
+    assert not _add(reopened, 'T1')
+    reopened.run()
+    reopened.close()
+    assert server.requests[TRANSFER_PATH] == 1
+
+
+def test_ambiguous_results_are_confirmed_not_resent(outbox, server, app, resends):
+    random.seed(1)
+    app.config['WXPAY_REQUEST_TIMEOUT'] = 0.2
+    outbox.wxpay = WXPay(app)
+    server.timeout_delay = 0.3
+    server.errors = parse_errors('SYSTEMERROR=0.2,FAIL=0.1,malformed=0.05,lost=0.1')
+    for i in range(40):
+        _add(outbox, 'T{0}'.format(i), 100 + i)
+
+    stats = outbox.run(max_workers=4)
+    assert stats[SUCCESS]['count'] == 40
+    assert sum(t['amount'] for t in server.transfers.values()) == stats[SUCCESS]['amount']
+    assert server.injected['lost'] and server.injected['SYSTEMERROR']
+    # 结果不确定的付款先查询确认, 已经付款的单号不会被再次发送
+    assert resends == []
+
+
+def test_recover_sent_before_crash(outbox, server, resends):
+    _add(outbox, 'T1')
+    _add(outbox, 'T2')
+    # T1发送到了微信, T2还没有发出, 进程在两者都为SENDING时崩溃
+    outbox.wxpay.transfers(**outbox.get('T1')['params'])
+    outbox._update('T1', state=SENDING, attempts=1)
+    outbox._update('T2', state=SENDING, attempts=1)
+    outbox.close()
+
+    outbox = PayoutOutbox(outbox.wxpay, outbox.path, rate=1000, retry_interval=0.01)
+    assert outbox.get('T1')['state'] == UNKNOWN
+    assert outbox.get('T2')['state'] == UNKNOWN
+    stats = outbox.run()
+    outbox.close()
+
+    assert stats[SUCCESS]['count'] == 2
+    assert resends == []
+    # T1一次, T2查询不存在后重新发送一次
+    assert server.requests[TRANSFER_PATH] == 2
+
+
+def test_business_error_fails(outbox, server):
+    def transfer(data):
+        return dict(result_code='FAIL', err_code='NOTENOUGH', err_code_des=u'余额不足')
+    server.handlers[TRANSFER_PATH] = transfer
+    _add(outbox, 'T1')
+    stats = outbox.run()
+    assert stats[FAILED]['count'] == 1
+    assert outbox.get('T1')['error'].startswith('NOTENOUGH')
+    assert stats[PENDING]['count'] == 0
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from flask_wxpay.poll import PaymentWaiter
+
+
+def test_waiter_joining_while_poll_loop_exits():
+    state = dict(trade_state='NOTPAY')
+    waiter = PaymentWaiter(lambda out_trade_no: dict(state), initial_interval=0.05,
+                           max_interval=0.05)
+    sleep_time = waiter._sleep_time
+    joined = {}
+    started = threading.Event()
+
+    def racing_sleep_time(interval, flight):
+        # 查询循环已经决定退出, 还没有移除flight时加入新的等待者
+        t = sleep_time(interval, flight)
+        if t <= 0 and not joined:
+            deadline = flight.deadline
+
+            def join():
+                joined['result'] = waiter.wait('o1', 2)
+                joined['at'] = time.time()
+            joined['thread'] = threading.Thread(target=join)
+            joined['thread'].start()
+            started.set()
+            while flight.deadline == deadline:
+                time.sleep(0.001)
+            state['trade_state'] = 'SUCCESS'
+        return t
+    waiter._sleep_time = racing_sleep_time
+
+    start = time.time()
+    assert waiter.wait('o1', 0.2)['trade_state'] == 'NOTPAY'
+    # 第一个等待者超时返回时查询线程可能还没有走到退出的判断
+    assert started.wait(5)
+    joined['thread'].join(5)
+    # 新的等待者得到查询结果, 而不是阻塞到自己的超时时间
+    assert joined['result']['trade_state'] == 'SUCCESS'
+    assert joined['at'] - start < 1
+    assert waiter._flights == {}
+
+
+def test_waiter_times_out_with_last_result():
+    waiter = PaymentWaiter(lambda out_trade_no: dict(trade_state='NOTPAY'),
+                           initial_interval=0.02, max_interval=0.02)
+    start = time.time()
+    assert waiter.wait('o1', 0.1)['trade_state'] == 'NOTPAY'
+    assert time.time() - start < 0.5
+    time.sleep(0.1)
+    assert waiter._flights == {}
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import time
+
+from flask_wxpay import WXPay
+
+
+def _paid_order(wxpay, server, out_trade_no):
+    wxpay.unified_order(out_trade_no, 100, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    server.pay(out_trade_no, notify=False)
+
+
+def test_query_cache_off_by_default(wxpay, server):
+    assert wxpay.query_cache is None
+    _paid_order(wxpay, server, 'o1')
+    wxpay.query_order('o1')
+    wxpay.query_order('o1')
+    assert server.requests['/pay/orderquery'] == 2
+
+
+def test_query_cache_expires(app, server):
+    app.config.update(WXPAY_QUERY_CACHE=True, WXPAY_QUERY_CACHE_TIMEOUT=0.2)
+    wxpay = WXPay(app)
+    _paid_order(wxpay, server, 'o1')
+    assert wxpay.query_order('o1')['trade_state'] == 'SUCCESS'
+    assert wxpay.query_order('o1')['trade_state'] == 'SUCCESS'
+    assert server.requests['/pay/orderquery'] == 1
+
+    # 其他进程的退款, 当前进程的缓存没有被清除, 过期后才能查到
+    other = WXPay(app)
+    other.refund('o1', 'r1', 100, 100)
+    assert wxpay.query_order('o1')['trade_state'] == 'SUCCESS'
+    time.sleep(0.25)
+    assert wxpay.query_order('o1')['trade_state'] == 'REFUND'
+    assert server.requests['/pay/orderquery'] == 2
+
+
+def test_refund_invalidates_cache(app, server):
+    app.config.update(WXPAY_QUERY_CACHE=True)
+    wxpay = WXPay(app)
+    _paid_order(wxpay, server, 'o1')
+    wxpay.query_order('o1')
+    wxpay.refund('o1', 'r1', 100, 50)
+    assert wxpay.query_order('o1')['trade_state'] == 'REFUND'
+    assert wxpay.query_refund('o1')['refund_status_0'] == 'SUCCESS'
+    wxpay.query_refund('o1')
+    assert server.requests['/pay/refundquery'] == 1
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from flask_wxpay.exceptions import RateLimited
+from flask_wxpay.ratelimit import (FileBackend, LocalBackend, RateLimiter, RedisBackend, fcntl,
+                                   gcra)
+
+needs_fcntl = pytest.mark.skipif(fcntl is None, reason='需要fcntl')
+needs_fork = pytest.mark.skipif(not hasattr(os, 'fork'), reason='需要fork')
+
+
+def test_gcra_boundary():
+    # 每秒1次, 突发3次: 同一时刻前3次不需要等待, 第4次需要等1秒
+    tat = 0.0
+    for _ in range(3):
+        wait, tat = gcra(tat, 100.0, 1.0, 3, 0)
+        assert wait == 0
+    assert gcra(tat, 100.0, 1.0, 3, 0) == (1.0, None)
+    assert gcra(tat, 100.0, 1.0, 3, 0.999)[1] is None
+    assert gcra(tat, 100.0, 1.0, 3, 1.0) == (1.0, tat + 1.0)
+    # 1秒后恢复一个令牌
+    assert gcra(tat, 101.0, 1.0, 3, 0)[0] == 0
+
+
+def _redis_backend():
+    redis = pytest.importorskip('redis')
+    client = redis.Redis()
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip('需要本地的redis服务器')
+    client.delete('flask_wxpay:test:k')
+    return RedisBackend(client, prefix='flask_wxpay:test:')
+
+
+@pytest.fixture(params=['local', pytest.param('file', marks=needs_fcntl), 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'local':
+        yield LocalBackend()
+    elif request.param == 'file':
+        backend = FileBackend(str(tmp_path / 'ratelimit'))
+        yield backend
+        backend.close()
+    else:
+        yield _redis_backend()
+
+
+def test_backend_allows_burst_then_denies(backend):
+    for _ in range(3):
+        assert backend.reserve('k', 10.0, 3, max_wait=0) == (True, 0.0)
+    allowed, wait = backend.reserve('k', 10.0, 3, max_wait=0)
+    assert not allowed
+    assert 9.9 < wait <= 10.0
+    # 拒绝的请求不占用令牌, 允许等待时预订之后的令牌
+    allowed, wait = backend.reserve('k', 10.0, 3, max_wait=None)
+    assert allowed and 9.9 < wait <= 10.0
+    allowed, wait = backend.reserve('k', 10.0, 3, max_wait=15)
+    assert not allowed and 19.9 < wait <= 20.0
+
+
+def test_backend_keys_are_independent(backend):
+    assert backend.reserve('k', 10.0, 1, max_wait=0)[0]
+    assert not backend.reserve('k', 10.0, 1, max_wait=0)[0]
+    assert backend.reserve('other', 10.0, 1, max_wait=0)[0]
+
+
+def test_rate_limiter():
+    limiter = RateLimiter({'/pay/orderquery': (1, 2)}, timeout=0, prefix='m1:')
+    assert limiter.reserve('/pay/unifiedorder') is None
+    assert limiter.reserve('/pay/orderquery') == 0
+    assert limiter.reserve('/pay/orderquery') == 0
+    with pytest.raises(RateLimited) as exc_info:
+        limiter.reserve('/pay/orderquery')
+    assert exc_info.value.path == '/pay/orderquery'
+    assert 0.9 < exc_info.value.retry_after <= 1.0
+
+
+def _hold_lock(backend, ready, release):
+    with backend._lock:
+        backend._open()
+    fcntl.flock(backend._fd, fcntl.LOCK_EX)
+    ready.set()
+    release.wait(5)
+    fcntl.flock(backend._fd, fcntl.LOCK_UN)
+
+
+@needs_fcntl
+@needs_fork
+def test_file_backend_lock_excludes_forked_process(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    backend = FileBackend(str(tmp_path / 'ratelimit'))
+    # 父进程先打开文件, 子进程继承打开的文件描述, 相当于gunicorn --preload
+    backend.reserve('k', 0.001, 1)
+    ready, release = ctx.Event(), ctx.Event()
+    child = ctx.Process(target=_hold_lock, args=(backend, ready, release))
+    child.start()
+    try:
+        assert ready.wait(5)
+        start = time.time()
+        timer = ctx.Process(target=lambda: (time.sleep(0.3), release.set()))
+        timer.start()
+        backend.reserve('k', 0.001, 1)
+        # 子进程持有锁时父进程必须等待
+        assert time.time() - start >= 0.25
+        timer.join()
+    finally:
+        release.set()
+        child.join(5)
+        backend.close()
+
+
+def _count_allowed(backend, duration, counts):
+    deadline = time.time() + duration
+    allowed = 0
+    while time.time() < deadline:
+        if backend.reserve('k', 0.01, 1, max_wait=0)[0]:
+            allowed += 1
+    counts.put(allowed)
+
+
+@needs_fcntl
+@needs_fork
+def test_file_backend_limit_shared_by_forked_processes(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    backend = FileBackend(str(tmp_path / 'ratelimit'))
+    backend.reserve('warm-up', 1.0, 1)
+    counts = ctx.Queue()
+    duration = 0.5
+    workers = [ctx.Process(target=_count_allowed, args=(backend, duration, counts))
+               for _ in range(4)]
+    for w in workers:
+        w.start()
+    total = sum(counts.get(timeout=10) for _ in workers)
+    for w in workers:
+        w.join(5)
+    backend.close()
+    # 每秒100次, 4个进程合计不超过一个进程的限制(启动时间不同, 留一些余量)
+    assert 10 <= total <= duration * 100 + 5
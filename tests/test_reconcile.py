@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from flask_wxpay.reconcile import Extra, Mismatch, Reconciler, date_range, yuan_to_fen
+
+
+@pytest.mark.parametrize('value, fen', [
+    ('12.34', 1234), ('0.01', 1), ('5', 500), ('5.1', 510), ('-3.00', -300), ('', 0),
+])
+def test_yuan_to_fen(value, fen):
+    assert yuan_to_fen(value) == fen
+
+
+def test_date_range():
+    assert date_range('20240130', '20240202') == ['20240130', '20240131', '20240201', '20240202']
+    assert date_range('20240102', '20240101') == []
+
+
+# 固定的日期, 不受运行测试的时间影响
+DAY = '20240501'
+
+
+def _paid_order(wxpay, server, out_trade_no, total_fee):
+    wxpay.unified_order(out_trade_no, total_fee, '127.0.0.1', 'b', 600, trade_type='NATIVE')
+    server.pay(out_trade_no, notify=False)
+    with server.lock:
+        order = server.orders[out_trade_no]
+        order['time_end'] = DAY + '120000'
+    return order['transaction_id']
+
+
+def test_reconcile_against_mock_bill(wxpay, server):
+    _paid_order(wxpay, server, 'o1', 1000)
+    _paid_order(wxpay, server, 'o2', 200)
+    tx4 = _paid_order(wxpay, server, 'o4', 50)
+    wxpay.refund('o1', 'r1', 1000, 300)
+    with server.lock:
+        server.refunds['r1']['time'] = '2024-05-01 15:00:00'
+
+    local_orders = [('o1', 1000), ('o2', 250), ('o3', 700)]
+    result = Reconciler(wxpay, max_workers=2).reconcile(
+        local_orders, datetime(2024, 4, 30), datetime(2024, 5, 1))
+
+    # 退款的订单按支付记录对账, 不会被当作缺失
+    assert result.missing == [('o3', 700)]
+    assert result.mismatched == [Mismatch('o2', 250, 200, DAY)]
+    assert result.extra == [Extra('o4', tx4, 50, DAY)]
+    assert result.errors == {}
+    assert not result.ok
+    # 没有账单(No Bill Exist)的日期为空
+    empty, day = result.daily_totals
+    assert (empty.count, empty.total_fee) == (0, 0)
+    assert (day.count, day.total_fee, day.refund_count, day.refund_fee) == (3, 1250, 1, 300)
+
+
+def test_reconcile_by_transaction_id(wxpay, server):
+    tx1 = _paid_order(wxpay, server, 'o1', 1000)
+    bills = Reconciler(wxpay).load(DAY, DAY)
+    assert len(bills) == 1
+    assert bills.diff([(tx1, 1000)], key='transaction_id').ok
+
+
+def test_reconcile_records_download_errors(wxpay, server):
+    _paid_order(wxpay, server, 'o1', 1000)
+    server.handlers['/pay/downloadbill'] = lambda data: dict(
+        result_code='FAIL', err_code='SYSTEMERROR', err_code_des=u'系统错误')
+    result = Reconciler(wxpay).reconcile([('o1', 1000)], DAY, DAY)
+    assert list(result.errors) == [DAY]
+    assert result.missing == [('o1', 1000)]
+    assert not result.ok
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+import sys
+
+import pytest
+
+from flask_wxpay import WXPay
+from flask_wxpay.results import OrderQueryResult, RefundQueryResult, Result
+
+DATA = {'return_code': 'SUCCESS', 'result_code': 'SUCCESS', 'trade_state': 'SUCCESS',
+        'out_trade_no': 'o1', 'total_fee': '100', 'coupon_fee_0': '10'}
+
+
+def test_known_fields_use_slots():
+    result = OrderQueryResult(DATA)
+    assert not hasattr(result, '__dict__')
+    assert result.out_trade_no == 'o1'
+    assert result.transaction_id is None
+    assert result._extra == {'coupon_fee_0': '10'}
+    assert result.trade_state is sys.intern('SUCCESS')
+
+
+def test_int_fields():
+    result = OrderQueryResult(DATA)
+    assert result.total_fee == 100
+    assert result['total_fee'] == '100'
+    assert result.cash_fee is None
+    result.cash_fee = 90
+    assert result['cash_fee'] == '90' and result.cash_fee == 90
+
+
+def test_extra_fields():
+    result = OrderQueryResult(DATA)
+    assert result['coupon_fee_0'] == '10'
+    assert not hasattr(result, 'coupon_fee_0')
+    result['coupon_id_0'] = 'c1'
+    del result['coupon_fee_0']
+    assert result._extra == {'coupon_id_0': 'c1'}
+    assert OrderQueryResult({'out_trade_no': 'o1'})._extra is None
+
+
+def test_mapping_protocol():
+    result = OrderQueryResult(DATA)
+    assert isinstance(result, Result) and not isinstance(result, dict)
+    assert dict(result) == DATA == result.to_dict() == result.raw
+    assert len(result) == len(DATA)
+    assert sorted(result) == sorted(DATA)
+    assert 'total_fee' in result and 'cash_fee' not in result and 'missing' not in result
+    assert result.get('cash_fee') is None and result.get('missing', 1) == 1
+    with pytest.raises(KeyError):
+        result['cash_fee']
+    with pytest.raises(KeyError):
+        del result['cash_fee']
+    result['out_trade_no'] = 'o2'
+    del result['total_fee']
+    assert result.out_trade_no == 'o2' and result.total_fee is None
+    assert 'total_fee' not in result and len(result) == len(DATA) - 1
+
+
+def test_copy_and_serialize():
+    result = OrderQueryResult(DATA)
+    copied = result.copy()
+    copied['out_trade_no'] = 'o2'
+    assert result['out_trade_no'] == 'o1'
+    assert pickle.loads(pickle.dumps(result)).to_dict() == DATA
+    assert json.loads(json.dumps(result.to_dict())) == DATA
+    with pytest.raises(TypeError):
+        json.dumps(result)
+
+
+def test_typed_results(app, server):
+    app.config.update(WXPAY_TYPED_RESULTS=True, WXPAY_QUERY_CACHE=True)
+    wxpay = WXPay(app)
+    server.unified_order(dict(out_trade_no='o1', total_fee='100', body='b', trade_type='NATIVE'))
+    server.pay('o1', notify=False)
+    result = wxpay.query_order('o1')
+    assert type(result) is OrderQueryResult
+    assert result.total_fee == 100 and result.trade_state == 'SUCCESS'
+    # 缓存中保存dict, 命中时也返回结果类型
+    cached = wxpay.query_order('o1')
+    assert server.requests['/pay/orderquery'] == 1
+    assert type(cached) is OrderQueryResult and cached is not result
+    assert cached.to_dict() == result.to_dict()
+    wxpay.refund('o1', 'r1', 100, 30)
+    refund = wxpay.query_refund('o1')
+    assert type(refund) is RefundQueryResult
+    assert refund.refund_count == 1 and refund['refund_fee_0'] == '30'
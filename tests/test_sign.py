@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from flask_wxpay import WXPay
+from flask_wxpay.exceptions import WXPayError
+from flask_wxpay.sign import get_signer, sign_string
+
+# 微信支付文档签名算法中的示例
+KEY = '192006250b4c09247ec02edce69f6a2d'
+DATA = dict(appid='wxd930ea5d5a258f4f', mch_id='10000100', device_info='1000', body='test',
+            nonce_str='ibuaiVcKdpRxkhJA')
+MD5_SIGN = '9A0A8659F005D6984697E2CA0A9CF3B7'
+HMAC_SIGN = '6A9AE1657590FD6257D693A078E1C3E4BB6BA4DC30B23E0EE2496E54170DACD6'
+
+
+def test_sign_string():
+    assert sign_string(dict(DATA, sign='x', attach='', detail=None)) == (
+        'appid=wxd930ea5d5a258f4f&body=test&device_info=1000&mch_id=10000100'
+        '&nonce_str=ibuaiVcKdpRxkhJA')
+
+
+@pytest.mark.parametrize('sign_type, expected', [('MD5', MD5_SIGN), ('HMAC-SHA256', HMAC_SIGN)])
+def test_known_answer(sign_type, expected):
+    signer = get_signer(sign_type, KEY)
+    assert signer.sign(DATA) == expected
+    # sign和空值不参与签名
+    assert signer.sign(dict(DATA, sign='x', attach='', detail=None)) == expected
+    # 复制的hmac对象不会被上一次签名修改
+    assert signer.sign(dict(DATA, body='other')) != expected
+    assert signer.sign(DATA) == expected
+
+
+def test_unknown_sign_type():
+    with pytest.raises(WXPayError):
+        get_signer('SHA1', KEY)
+
+
+def test_check_sign(app):
+    app.config['WXPAY_KEY'] = KEY
+    wxpay = WXPay(app)
+    assert wxpay.get_sign(DATA, 'MD5') == MD5_SIGN
+    assert wxpay.get_sign(DATA, 'HMAC-SHA256') == HMAC_SIGN
+    assert wxpay.check_sign(dict(DATA, sign=MD5_SIGN))
+    assert not wxpay.check_sign(dict(DATA, sign=HMAC_SIGN))
+    assert not wxpay.check_sign(DATA)
+
+    # 带sign_type时按sign_type校验, sign_type本身也参与签名
+    data = dict(DATA, sign_type='HMAC-SHA256')
+    data['sign'] = get_signer('HMAC-SHA256', KEY).sign(data)
+    assert data['sign'] != HMAC_SIGN
+    assert wxpay.check_sign(data)
+    assert not wxpay.check_sign(dict(data, body='other'))
+    assert not wxpay.check_sign(dict(data, sign_type='MD5'))
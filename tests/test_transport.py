@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+import ssl
+import tempfile
+
+import pytest
+
+from flask_wxpay.transport import create_ssl_context
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.skipif(not hasattr(os, 'memfd_create'), reason='需要memfd_create')
+def test_pem_bytes_not_written_to_disk(certs, monkeypatch):
+    def mkstemp(*args, **kwargs):
+        raise AssertionError('证书不应写入临时文件')
+    monkeypatch.setattr(tempfile, 'mkstemp', mkstemp)
+
+    context = create_ssl_context(_read(certs.client_cert), _read(certs.client_key))
+    assert isinstance(context, ssl.SSLContext)
+
+
+def test_pem_bytes_fallback_removes_temp_files(certs, monkeypatch, tmp_path):
+    monkeypatch.delattr(os, 'memfd_create', raising=False)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+
+    create_ssl_context(_read(certs.client_cert), _read(certs.client_key))
+    assert os.listdir(str(tmp_path)) == []
+
+    with pytest.raises(ssl.SSLError):
+        create_ssl_context(_read(certs.client_cert), b'not a key')
+    assert os.listdir(str(tmp_path)) == []
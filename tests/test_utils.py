@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from flask_wxpay import WXPay, dict_to_xml_bytes, xml_to_dict
+from flask_wxpay.exceptions import WXPayError
+
+DTD = b'<!DOCTYPE xml [<!ENTITY a "b">]><xml><return_code>&a;</return_code></xml>'
+NOT_UTF8 = b'<xml><return_code>SUCCESS</return_code><a>\xff\xfe</a></xml>'
+
+
+def test_xml_to_dict():
+    xml = (b'<xml>\n  <a><![CDATA[\xe4\xb8\xad]]></a><b>1</b><c></c>'
+           b'<d><![CDATA[x]]]]><![CDATA[>y]]></d></xml>')
+    assert xml_to_dict(xml) == {'a': u'中', 'b': '1', 'd': 'x]]>y'}
+    assert xml_to_dict(xml.decode('utf-8')) == xml_to_dict(xml)
+    data = {'a': u'中', 'b': 1, 'c': 'x]]>y'}
+    assert xml_to_dict(dict_to_xml_bytes(data)) == {'a': u'中', 'b': '1', 'c': 'x]]>y'}
+
+
+@pytest.mark.parametrize('xml', [DTD, NOT_UTF8, b'<xml><a>', b'not xml'])
+def test_handle_result_invalid_xml(app, xml):
+    wxpay = WXPay(app)
+    with pytest.raises(WXPayError):
+        wxpay._handle_result(xml, path='/pay/orderquery')
+
+
+def test_query_invalid_xml(wxpay, server):
+    server.handlers['/pay/orderquery'] = lambda data: NOT_UTF8
+    with pytest.raises(WXPayError):
+        wxpay.query_order('o1')